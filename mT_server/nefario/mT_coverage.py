@@ -49,7 +49,7 @@ def executeSQL(sql, conn):
 
 
 
-def incrementHash(_hash, valsarray, refid, refid_, posn, base):
+def incrementHash(_hash, valsarray, refid, refid_, posn, base, refbase=None):
 
         #if refid_ not in _hash.keys(): # == []:
         #    _hash[refid_]={}
@@ -66,12 +66,43 @@ def incrementHash(_hash, valsarray, refid, refid_, posn, base):
             _hash[refid_][posn]['reference'] = base
             for val in valsarray:
                 _hash[refid_][posn][val] = 0
+            if refbase is not None: # after the loop, which zeroes 'reference' too
+                _hash[refid_][posn]['reference'] = refbase
 
 
         _hash[refid_][posn][base] +=1
 
         return _hash
 
+#-------------------------------------------------------------------------------
+# Reference bases come from the 2-bit store minup writes next to its validated
+# fasta (<refhash>.2bit). The format and its reader are in minup_twobit.py,
+# which is in the minup folder of the minoTour directory ...
+
+def openReferenceStore(mT_params, conn):
+    # Sets refstore and refnames (refid -> refname) when the run has a store we can read
+    global refstore, refnames
+    if 'reference_store_dir' not in mT_params: return
+    # reference_seq_info tables made by an older minup don't have refhash ...
+    sql = "SELECT column_name FROM information_schema.columns WHERE \
+            table_schema = '" + dbname + "' AND \
+            table_name = 'reference_seq_info' AND column_name = 'refhash'"
+    if numRows(selectDF(sql, conn)) == 0: return
+    try:
+        refs = selectDF("SELECT refid, refname, refhash FROM reference_seq_info", conn)
+    except Exception, e:
+        output2("No reference store for this run ", str(e))
+        return
+    if numRows(refs) == 0 or refs.refhash[0] is None: return
+    path = os.path.join(mT_params['reference_store_dir'], refs.refhash[0] + ".2bit")
+    if not os.path.isfile(path + ".json"):
+        output2("No reference store at ", path)
+        return
+    sys.path.insert(0, os.path.join(mT_params['directory'], 'minup'))
+    import minup_twobit
+    refstore = minup_twobit.reference_store(path)
+    refnames = dict(zip(refs.refid, refs.refname))
+
 def hash2array(d, valsarray):
     array = []
     for refid in sorted(d.keys())  :
@@ -270,14 +301,24 @@ def processDF(bc, ref, checkreads, tbl_check_barcode, memd):
         output2("The refstart is ", refstart )
         output2("The reflength is" , reflength)
         output2("The refstring is",refstring)
-        
+
+        # The reference bases the alignment covers are read from the store once
+        # for the read. An insertion at the start counts against the base before refstart.
+        refbases = None
+        if refid in refnames:
+            refspan_start = max(refstart-1, 0)
+            refbases = refstore.bases(refnames[refid], refspan_start, refstart+reflength-refstring.count("-"))
+
         for x in xrange(reflength):
             if refstring[x] != "-":
                 posn+=1
 
             # Check if the strings match ...
 	    #print _hash
-            inc = lambda x: incrementHash(_hash, valsarray, refid, refid_, posn, x)
+            refbase = None
+            if refbases is not None and 0 <= posn-1-refspan_start < len(refbases):
+                refbase = refbases[posn-1-refspan_start]
+            inc = lambda x: incrementHash(_hash, valsarray, refid, refid_, posn, x, refbase)
 
             if refstring[x] == querystring[x]:
                  _hash = inc(refstring[x])
@@ -569,6 +610,9 @@ def main():
          output("Error %d: %s" % (e.args[0], e.args[1]))
          sys.exit (1)
 
+    # Reference bases come from minup's 2-bit store when it's reachable from here ...
+    openReferenceStore(mT_params, conn)
+
 
     # TODO FOCUS HERE ....
     if checkingrunning is None or not checkingrunning == "1" : 
@@ -670,6 +714,8 @@ if __name__ == '__main__':
     # No buffering on stdout ...
     sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
     valsarray=('reference','A','T','G','C','i','d')
+    refstore = None
+    refnames = {}
     main()
         
         
@@ -0,0 +1,48 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# --------------------------------------------------
+# File Name: mT_telemetry.py
+# Purpose: read back the events minup -t --telemetry-blob stored in telemetry_blobs
+# Creation Date: 18-10-2026
+# Author(s): The DeepSEQ Team, University of Nottingham UK
+# Copyright 2016 The Author(s) All Rights Reserved
+# Credits:
+# --------------------------------------------------
+
+## Each telemetry_blobs row holds one read's events (or 2D alignment) as the
+## bytes of a numpy structured array, compressed with zlib or as an lz4 frame
+## (the codec column), with the array's dtype as repr() of
+## numpy.lib.format.dtype_to_descr. The field names are the columns of the
+## caller_ table named in caller_table.
+##
+##     import mT_telemetry
+##     events = mT_telemetry.fetch_telemetry(cursor, basenameid, "basecalled_template")
+
+import ast
+import zlib
+import numpy as np
+try:
+    import lz4.frame as lz4frame # only needed for blobs written with --telemetry-compression lz4
+except ImportError:
+    lz4frame = None
+
+
+def decode_telemetry_blob(dtype, codec, data):
+    ## the dtype, codec and data columns of a telemetry_blobs row back to the structured array
+    if (codec == "lz4"):
+        if (lz4frame is None):
+            raise ImportError("the lz4 python package is needed for telemetry blobs compressed with lz4")
+        raw = lz4frame.decompress(data)
+    else:
+        raw = zlib.decompress(data)
+    return np.frombuffer(raw, dtype=np.dtype(ast.literal_eval(dtype)))
+
+
+def fetch_telemetry(cursor, basenameid, readtype):
+    ## cursor on the run database; None if the read has no blob of that readtype
+    cursor.execute("SELECT dtype, codec, data FROM telemetry_blobs WHERE basename_id=%s AND readtype=%s", (basenameid, readtype))
+    row = cursor.fetchone()
+    if (row is None):
+        return None
+    return decode_telemetry_blob(row[0], row[1], row[2])
@@ -6,18 +6,42 @@ import logging
 from watchdog.observers.polling import PollingObserver as Observer
 from watchdog.events import FileSystemEventHandler
 import threading, thread
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import signal
 import h5py
 from Bio import SeqIO
-from StringIO import StringIO
 import MySQLdb
+from MySQLdb.constants import CLIENT
 import subprocess
 import string
 import configargparse
 from warnings import filterwarnings
 import socket
 import hashlib
+import heapq
+import Queue
 import xmltodict
 import numpy
+from minup_twobit import encode_2bit, reference_store_writer, reference_store
+import collections
+import tempfile
+import zlib
+import json
+import shutil
+import contextlib
+try:
+    import fcntl # locks the reference manifest against other minup processes, not on windows
+except ImportError:
+    fcntl = None
+try:
+    from scandir import scandir # much faster folder listing on python 2, if it's installed
+except ImportError:
+    scandir = None
+try:
+    import lz4.frame as lz4frame # only needed for --telemetry-compression lz4
+except ImportError:
+    lz4frame = None
 
 ## minup: a program to process & upload MinION fast5 files in to the minoTour website in real-time or post-run.
 ## written & designed by Martin J. Blythe, Fei Sang & Matt W. Loose. DeepSeq, The University of Nottingham 2014. UK
@@ -80,11 +104,34 @@ parser.add('-last-opts', '--last-align-options',type=str, required=False, help="
 parser.add('-pin', '--security-pin', type=str, required=False, default=False, help="pin number for remote control", dest='pin')
 parser.add('-ip', '--ip-address', type=str, required=False, default=False, help="Used for remote control with option '-pin'. Provide IP address of the computer running minKNOW. The default is the IP address of this computer", dest='ip_address')
 parser.add('-t', '--insert-tel-true', action='store_true', help="Store all the telemetry data from the read files online. This feature is currently in development.", default=False,dest='telem')
+parser.add('-tel-blob', '--telemetry-blob', action='store_true', help="With -t, store the events (and 2D alignment) of each read as one compressed row in the telemetry_blobs table instead of one row per event in the caller_ tables. mT_server/nefario/mT_telemetry.py reads them back.", default=False, dest='tel_blob')
+parser.add('-tel-compression', '--telemetry-compression', type=str, required=False, default='zlib', choices=['zlib','lz4'], help="The compression used for --telemetry-blob. lz4 needs the lz4 python package. The default is zlib.", dest='tel_codec')
+parser.add('-drop-templates', '--drop-schema-templates', action='store_true', help="Drop the minup_schema_* databases at start up. New run databases are copied from these templates, one per schema version and set of table options, and they are kept on the server for later runs. Those still needed are made again. Don't use this while another minup is making run databases on the same server.", default=False, dest='drop_templates')
 parser.add('-d', '--drop-db-true', action='store_true', help="Drop existing database if it already exists.", default=False, dest='drop_db')
 parser.add('-v', '--verbose-true', action='store_true', help="Print detailed messages while processing files.", default=False, dest='verbose')
 parser.add('-name', '--name-custom', type=str, required=False, default="", help="Provide a modifier to the database name. This allows you to upload the same dataset to minoTour more than once. The additional string should be as short as possible.", dest='custom_name')
 parser.add('-cs', '--commment-string', nargs='+', type=str, dest='added_comment', help="Add given string to the comments field for this run", default='', ) # MS
-parser.add('-res', '--resume-upload', action='store_true', help="Add files to a partially uploaded database", default=False, dest='resume')
+parser.add('-res', '--resume-upload', action='store_true', help="Add files to a partially uploaded database. Files already listed in the run's journal in the minup_run_logs folder are skipped.", default=False, dest='resume')
+parser.add('-workers', '--workers', type=int, required=False, default=1, help="The number of worker processes used to read and upload fast5 files in parallel. Database creation and Gru registration are still done once per run by the main process. The default is 1 (no worker processes).", dest='workers')
+parser.add('-bulk', '--bulk-insert-rows', type=int, required=False, default=1, help="Buffer the per-read table rows and write them as multi-row INSERTs once this many reads have been collected. The default is 1 (every row is written and committed straight away).", dest='bulk_rows')
+parser.add('-bulk-secs', '--bulk-insert-interval', type=float, required=False, default=5, help="With --bulk-insert-rows, write out buffered rows after this many seconds even if fewer reads have been collected. The default is 5.", dest='bulk_interval')
+parser.add('-scan', '--scan-threads', type=int, required=False, default=8, help="The number of threads used to look through the watch-dir for existing fast5 files when minup starts. The default is 8.", dest='scan_threads')
+parser.add('-txn', '--transaction-reads', type=int, required=False, default=0, help="Write all the rows of a read in one transaction, so a read that fails is rolled back completely, and commit once this many reads have been written (or after --bulk-insert-interval seconds). The default is 0 (every statement is committed on its own).", dest='txn_reads')
+parser.add('-parse-threads', '--parse-threads', type=int, required=False, default=2, help="Ingest pipeline: the number of threads reading fast5 files. The default is 2.", dest='parse_threads')
+parser.add('-align-threads', '--align-threads', type=int, required=False, default=2, help="Ingest pipeline: the number of threads running the aligners. The default is 2.", dest='align_threads')
+parser.add('-align-write-threads', '--align-write-threads', type=int, required=False, default=2, help="Ingest pipeline: the number of threads writing alignments to the database. The default is 2.", dest='align_write_threads')
+parser.add('-align-batch', '--align-batch-size', type=int, required=False, default=20, help="Ingest pipeline and --workers: align this many sequences with one lastal/bwa run, so the index is loaded once per batch instead of once per read. 1 runs the aligner for every sequence. The default is 20.", dest='align_batch')
+parser.add('-align-batch-secs', '--align-batch-interval', type=float, required=False, default=1, help="Ingest pipeline and --workers: start an alignment batch after this many seconds even if it isn't full. The default is 1.", dest='align_batch_secs')
+parser.add('-align-procs', '--align-processes', type=int, required=False, default=1, help="Ingest pipeline and --workers: the number of lastal/bwa processes that may run at the same time for each reference. The default is 1.", dest='align_procs')
+parser.add('-align-workers', '--align-workers', type=int, required=False, default=3, help="With --workers: the number of threads in each worker process loading the results of the alignment batches. Reads are handed over and the worker moves on to the next file. The default is 3.", dest='align_workers')
+parser.add('-align-flush', '--align-flush-reads', type=int, required=False, default=25, help="Collect the alignment results (align flags, MAF/SAM and 5'/3' rows) of this many reads and write them together. 1 writes every read's alignments straight away. The default is 25.", dest='align_flush_reads')
+parser.add('-align-flush-secs', '--align-flush-interval', type=float, required=False, default=2, help="Write the collected alignment results after this many seconds even if fewer reads have been aligned. The default is 2.", dest='align_flush_secs')
+parser.add('-tel-threads', '--telemetry-threads', type=int, required=False, default=1, help="The number of background threads writing telemetry, each with its own MySQL connection per run database. The default is 1.", dest='tel_threads')
+parser.add('-tel-batch', '--telemetry-batch-reads', type=int, required=False, default=10, help="The telemetry threads write up to this many reads at a time and commit them together. The default is 10.", dest='tel_batch')
+parser.add('-stage-queue', '--stage-queue-size', type=int, required=False, default=50, help="Ingest pipeline: how many items may wait in front of each stage (and in the telemetry and --align-workers queues) before the stage before it has to wait. The default is 50.", dest='stage_queue')
+parser.add('-kmer-threads', '--kmer-threads', type=int, required=False, default=4, help="With -t and a reference: the number of threads counting the kmers of the reference sequences. The default is 4.", dest='kmer_threads')
+parser.add('-pool', '--db-pool-size', type=int, required=False, default=3, help="The number of extra MySQL connections per run database used for alignments and telemetry uploads. With --workers every worker process has its own pool. The default is 3.", dest='pool_size')
+parser.add('-pool-retries', '--db-pool-retries', type=int, required=False, default=2, help="How many times an alignment or telemetry upload is retried on a new connection when the MySQL connection is lost. The default is 2.", dest='pool_retries')
 parser.add('-ver', '--version', action='store_true', help="Report the current version of minUP.", default=False, dest='version') # ML
 args = parser.parse_args()
 
@@ -111,12 +158,67 @@ comments=dict()
 global connection_pool
 connection_pool=dict()
 
+global ingest_pool
+ingest_pool=None
+
+global ingest_stages
+ingest_stages=None
+
+global alignment_pool
+alignment_pool=None
+alignment_pool_lock=threading.Lock()
+
+global aligner_batchers
+aligner_batchers=dict()
+aligner_batchers_lock=threading.Lock()
+
+global alignment_sinks
+alignment_sinks=dict()
+alignment_sinks_lock=threading.Lock()
+
+global telemetry_writer
+telemetry_writer=None
+telemetry_writer_lock=threading.Lock()
+
+global ingest_lock
+ingest_lock=threading.Lock()
+
+global bulk_writers
+bulk_writers=dict()
+
+global bulk_flush_hooks
+bulk_flush_hooks=list()
+
+global id_allocators
+id_allocators=dict()
+
+global ingest_journals
+ingest_journals=dict()
+ingest_journals_lock=threading.Lock()
+
+global xml_file_dict
+xml_file_dict=dict()
+
+global fast5_layouts
+fast5_layouts=dict()
+
+global insert_statements
+insert_statements=dict()
+
+global max_packet
+max_packet=None
+
+global load_data_local
+load_data_local=True
+
+global dataset_buffers
+dataset_buffers=dict()
+dataset_buffers_lock=threading.Lock()
+
 #####################################################################
 
-def check_read(filepath, hdf, cursor):
+def dbname_from_filepath(filepath):
     filename = os.path.basename(filepath)
-    if (args.verbose is True):
-        print time.strftime('%Y-%m-%d %H:%M:%S'), "processing:", filename
     parts = filename.split("_")
     str = "_";
     dbname=str.join(parts[0:(len(parts)-5)])
@@ -127,6 +229,15 @@ def check_read(filepath, hdf, cursor):
         dbname = args.minotourusername + "_" + dbname
     if (len(dbname) > 64):
         dbname = dbname[:64]
+    return dbname
+
+#####################################################################
+
+def check_read(filepath, hdf, cursor):
+    filename = os.path.basename(filepath)
+    if (args.verbose is True):
+        print time.strftime('%Y-%m-%d %H:%M:%S'), "processing:", filename
+    dbname=dbname_from_filepath(filepath)
     ######
     global runindex
     ##########################################################################
@@ -171,6 +282,9 @@ def check_read(filepath, hdf, cursor):
                 db.commit()
                 if (args.verbose is True):
                     print "database dropped."
+            elif (args.resume is True):
+                resume_run(dbname, filepath, cursor)
+                return check_read(filepath, hdf, cursor)
             else:
                 print >>sys.stderr, "%s run database already exists. To write over the data re-run the minUP command with option -d" % (dbname)
                 sys.exit()
@@ -195,80 +309,32 @@ def check_read(filepath, hdf, cursor):
             err_string = "Error obtaining upload IP adress"
             print >>sys.stderr, err_string
 
+        ## a journal for this dbname is from a run database that was dropped, by -d or by hand
+        reset_ingest_journal(dbname)
+
         #################################################
         #### This bit adds columns to Gru.minIONruns ####
         modify_gru(cursor)
         #################################################
 
-        #### Create a new empty database
-        if (args.verbose is True):
-            print "making new database: ", dbname
-
-        sql="CREATE DATABASE %s" % (dbname)
-        cursor.execute(sql)
-        sql="USE %s" % (dbname)
-        cursor.execute(sql)
-        create_general_table('config_general',cursor) # make a table
-        create_trackingid_table('tracking_id',cursor) # make another table
-        create_basecall_summary_info('basecall_summary',cursor) # make another table!
-        create_events_model_fastq_table('basecalled_template', cursor) # make another table
-        create_events_model_fastq_table('basecalled_complement', cursor) # make another table
-        create_basecalled2d_fastq_table('basecalled_2d', cursor) # make another table
-        ########################################
-        if (args.telem is True):
-            for i in xrange(0,10):
-                temptable = 'caller_basecalled_template_%d' % (i)
-                comptable = 'caller_basecalled_complement_%d' % (i)
-                twod_aligntable = 'caller_basecalled_2d_alignment_%d' % (i)
-                create_caller_table_noindex(temptable, cursor)
-                create_caller_table_noindex(comptable, cursor)
-                create_2d_alignment_table(twod_aligntable, cursor)
-            create_model_list_table("model_list", cursor)
-            create_model_data_table("model_data", cursor)
-
         ########################################
         ######## Assign the correct reference fasta for this dbname if applicable
-        if (args.batch_fasta is not False):
-            for refbasename in ref_fasta_hash.keys():
-                common_path= os.path.commonprefix((ref_fasta_hash[refbasename]['path'], filepath)).rstrip('\\|\/|re|\\re|\/re')
-                if (common_path.endswith("downloads") ):
-                    ref_fasta_hash[dbname]=ref_fasta_hash[refbasename]
-                    #del ref_fasta_hash[refbasename]
-
-        if (args.ref_fasta is not False):
-            for refbasename in ref_fasta_hash.keys(): # there should only be one key
-                ref_fasta_hash[dbname]=ref_fasta_hash[refbasename]
+        assign_reference_fasta(dbname, filepath)
+
+        #### Create a new database with all its tables, copied from the schema template
+        if (args.verbose is True):
+            print "making new database: ", dbname
+        create_run_database(dbname, cursor)
 
         ###########################################
         if (dbname in ref_fasta_hash): # great, we assigned the reference fasta to this dbname
-            create_reference_table('reference_seq_info', cursor)
-            create_5_3_prime_align_tables('last_align_basecalled_template', cursor)
-            create_5_3_prime_align_tables('last_align_basecalled_complement', cursor)
-            create_5_3_prime_align_tables('last_align_basecalled_2d', cursor)
-
-            if (args.last_align is True):
-                #create_align_table('last_align_basecalled_template', cursor)
-                #create_align_table('last_align_basecalled_complement', cursor)
-                #create_align_table('last_align_basecalled_2d', cursor)
-                create_align_table_maf('last_align_maf_basecalled_template', cursor)
-                create_align_table_maf('last_align_maf_basecalled_complement', cursor)
-                create_align_table_maf('last_align_maf_basecalled_2d', cursor)
-
-            if (args.bwa_align is True):
-                create_align_table_sam('align_sam_basecalled_template', cursor)
-                create_align_table_sam('align_sam_basecalled_complement', cursor)
-                create_align_table_sam('align_sam_basecalled_2d', cursor)
-
             #dbcheckhash["mafoutdict"][dbname]=open(dbname+"."+process+".align.maf","w")
-            if (args.telem is True):
-                create_ref_kmer_table('ref_sequence_kmer', cursor)
-
             for refname in ref_fasta_hash[dbname]["seq_len"].iterkeys():
                 #print "refname", refname
                 reference=ref_fasta_hash[dbname]["seq_file"][refname]
                 reflen=ref_fasta_hash[dbname]["seq_len"][refname]
                 reflength=ref_fasta_hash[dbname]["seq_file_len"][reference]
-                refid=mysql_load_from_hashes(cursor, 'reference_seq_info', {'refname':refname, 'reflen':reflen, 'reffile':reference, 'ref_total_len':reflength})
+                refid=mysql_load_from_hashes(cursor, 'reference_seq_info', {'refname':refname, 'reflen':reflen, 'reffile':reference, 'ref_total_len':reflength, 'refhash':ref_fasta_hash[dbname]["hash"]})
                 ref_fasta_hash[dbname]["refid"][refname]=refid
                 if (args.telem is True):
                     kmers=ref_fasta_hash[dbname]["kmer"][refname]
@@ -319,28 +385,14 @@ def check_read(filepath, hdf, cursor):
 
         #################################################
         ########## Make entries in the Gru database
-        # try and get the right basecall-configuration general
-        basecalltype="Basecall_1D_CDNA"
-        basecalltype2="Basecall_2D"
-        basecalldir=''
-        basecalldirconfig=''
-        for x in range (0,9):
-            string='/Analyses/%s_00%s/Configuration/general' % (basecalltype, x)
-            if (string in hdf):
-                basecalldir='/Analyses/%s_00%s/' % (basecalltype,x)
-                basecalldirconfig=string
-                break
-            string='/Analyses/%s_00%s/Configuration/general' % (basecalltype2, x)
-            if (string in hdf):
-                basecalldir='/Analyses/%s_00%s/' % (basecalltype2,x)
-                basecalldirconfig=string
-                break
+        # get the right basecall-configuration general from the layout of this run
+        layout=get_fast5_layout(hdf, dbname)
 
-        #print "basecalldirconfig", basecalldirconfig
+        #print "basecalldirconfig", layout.basecalldirconfig
         ## get some data out of tacking_id and general
-        configdata=hdf[basecalldirconfig]
+        configdata=hdf[layout.basecalldirconfig]
         trackingid=hdf['/UniqueGlobalKey/tracking_id']
-        metrichor_info=hdf[basecalldir]
+        metrichor_info=hdf[layout.basecalldir]
         expstarttimecode=datetime.datetime.fromtimestamp(int(trackingid.attrs['exp_start_time'])).strftime('%Y-%m-%d')
         flowcellid = trackingid.attrs['device_id']
         version = metrichor_info.attrs['version']
@@ -477,22 +529,7 @@ def check_read(filepath, hdf, cursor):
 
         ##############################
         ## connection_pool for this db
-        connection_pool[dbname]=list()
-        if (args.last_align is True or args.bwa_align is True or args.telem is True):
-            try:
-                db_a = MySQLdb.connect(host=args.dbhost, user=args.dbusername, passwd=args.dbpass, port=args.dbport, db=dbname)
-                connection_pool[dbname].append(db_a)
-                db_b = MySQLdb.connect(host=args.dbhost, user=args.dbusername, passwd=args.dbpass, port=args.dbport, db=dbname)
-                connection_pool[dbname].append(db_b)
-                db_c = MySQLdb.connect(host=args.dbhost, user=args.dbusername, passwd=args.dbpass, port=args.dbport, db=dbname)
-                connection_pool[dbname].append(db_c)
-
-            except Exception, err:
-                print >>sys.stderr, "Can't setup MySQL connection pool: %s" % (err)
-                with open(dbcheckhash["logfile"][dbname],"a") as logfilehandle:
-                    logfilehandle.write(err_string+os.linesep)
-                    logfilehandle.close()
-                sys.exit()
+        open_connection_pool(dbname)
 
 
         #### this bit last to set the active database in this hash
@@ -506,27 +543,14 @@ def check_read(filepath, hdf, cursor):
     # if its a barcoded read.
 
     if (dbcheckhash["barcoded"][dbname] is False): # this will test the first read of this database to see if its a barcoded run
-        barcoded=False
-        for x in range(0,9):
-            string='/Analyses/Barcoding_00%s' % (x)
-            #print string
-            if (string in hdf):
-                barcoded=True
-                barcode_align_obj=string+"/Barcoding/Aligns"
-                break
-        if (barcoded is True):
+        if (get_fast5_layout(hdf, dbname).barcoding_dir is not None):
             create_barcode_table("barcode_assignment", cursor) # and create the table
             dbcheckhash["barcoded"][dbname]=True
             ###########
 
     if ( (dbcheckhash["barcode_info"][dbname] is False) and (args.pin is not False) ):
-        barcode_align_obj=False
-        for x in range(0,9):
-            string='/Analyses/Barcoding_00%s/Barcoding/Aligns' % (x)
-            if (string in hdf):
-                barcode_align_obj=string
-                break
-        if (barcode_align_obj is not False):
+        barcode_align_obj=get_fast5_layout(hdf, dbname).barcode_aligns
+        if (barcode_align_obj is not None):
             barcode_align_obj =hdf[barcode_align_obj][()]
             bcs=list()
             for i in range(len(barcode_align_obj)):
@@ -545,47 +569,541 @@ def check_read(filepath, hdf, cursor):
 
 #####################################################################
 
+def assign_reference_fasta(dbname, filepath):
+    if (args.batch_fasta is not False):
+        for refbasename in ref_fasta_hash.keys():
+            common_path= os.path.commonprefix((ref_fasta_hash[refbasename]['path'], filepath)).rstrip('\\|\/|re|\\re|\/re')
+            if (common_path.endswith("downloads") ):
+                ref_fasta_hash[dbname]=ref_fasta_hash[refbasename]
+                #del ref_fasta_hash[refbasename]
+
+    if (args.ref_fasta is not False):
+        for refbasename in ref_fasta_hash.keys(): # there should only be one key
+            ref_fasta_hash[dbname]=ref_fasta_hash[refbasename]
+
+#####################################################################
+## -res: pick up an existing run database where a previous minup left it
+
+def resume_run(dbname, filepath, cursor):
+    global runindex
+    print "resuming upload to existing database: ", dbname
+    sql="USE %s" % (dbname)
+    cursor.execute(sql)
+    sql="SELECT runindex FROM Gru.minIONruns WHERE runname = \'%s\' ORDER BY runindex DESC LIMIT 1" % (dbname)
+    cursor.execute(sql)
+    row=cursor.fetchone()
+    if (row is None):
+        print >>sys.stderr, "%s run database exists but is not registered in Gru.minIONruns so it can't be resumed. To write over the data re-run the minUP command with option -d" % (dbname)
+        sys.exit()
+    runindex=int(row[0])
+    dbcheckhash["runindex"][dbname]=runindex
+    sql="UPDATE Gru.minIONruns SET activeflag='1' WHERE runindex=%s" % (runindex)
+    cursor.execute(sql)
+    start_time=time.strftime('%Y-%m-%d %H:%M:%S')
+    comment_string = "minUp version %s resumed" % (minup_version)
+    sql="INSERT INTO Gru.comments (runindex,runname,user_name,comment,name,date) VALUES (%s,'%s','%s','%s','%s','%s')" %(runindex,dbname,args.minotourusername,comment_string,args.dbusername,start_time)
+    cursor.execute(sql)
+    db.commit()
+
+    ## work out what the earlier upload had already set up
+    sql="SHOW TABLES LIKE 'barcode_assignment'"
+    cursor.execute(sql)
+    dbcheckhash["barcoded"][dbname]=(cursor.fetchone() is not None)
+    dbcheckhash["barcode_info"][dbname]=True
+    if (args.pin is not False):
+        sql="SHOW TABLES LIKE 'barcode_control'"
+        cursor.execute(sql)
+        if (cursor.fetchone() is not None):
+            sql="SELECT COUNT(*) FROM barcode_control"
+            cursor.execute(sql)
+            dbcheckhash["barcode_info"][dbname]=(0 < int(cursor.fetchone()[0]))
+
+    assign_reference_fasta(dbname, filepath)
+    if (dbname in ref_fasta_hash):
+        sql="SHOW TABLES LIKE 'reference_seq_info'"
+        cursor.execute(sql)
+        if (cursor.fetchone() is None):
+            print >>sys.stderr, "%s was uploaded without a reference, so reads added now will not be aligned." % (dbname)
+            del ref_fasta_hash[dbname]
+        else:
+            sql="SELECT refname, refid FROM reference_seq_info"
+            cursor.execute(sql)
+            for refname, refid in cursor.fetchall():
+                ref_fasta_hash[dbname]["refid"][refname]=refid
+
+    if (args.telem is True):
+        if (args.tel_blob is True):
+            create_telemetry_blob_table("telemetry_blobs", cursor)
+        dbcheckhash["modelcheck"][dbname]=dict()
+        sql="SHOW TABLES LIKE 'model_data'"
+        cursor.execute(sql)
+        if (cursor.fetchone() is not None):
+            sql="SELECT DISTINCT model FROM model_data"
+            cursor.execute(sql)
+            for row in cursor.fetchall():
+                dbcheckhash["modelcheck"][dbname][row[0]]=1
+
+    remove_unjournaled_reads(dbname, cursor)
+
+    with open(dbcheckhash["logfile"][dbname],"a") as logfilehandle:
+        logfilehandle.write("minup resumed at:\t%s%s" % (start_time,os.linesep) )
+        logfilehandle.close()
+
+    open_connection_pool(dbname)
+    for e in dbcheckhash["dbname"].keys():
+        dbcheckhash["dbname"][e] = False
+    dbcheckhash["dbname"][dbname] = True
+
+#####################################################################
+## Reads that made it into the database but not into the journal were cut off
+## part way through by the crash. Their rows are removed so they can be
+## uploaded again in full.
+
+def remove_unjournaled_reads(dbname, cursor):
+    journal=get_ingest_journal(dbname)
+    sql="SELECT basename_id, file_path, md5sum FROM tracking_id"
+    cursor.execute(sql)
+    rows=cursor.fetchall()
+    if (journal.exists is False): # uploaded by a minup without a journal, so take the database's word for it
+        print "no journal for %s, rebuilding it from %d uploaded reads." % (dbname, len(rows))
+        journal.record_many([(row[1], row[2], row[0]) for row in rows])
+        return
+
+    journaled=set(journal.md5s.itervalues())
+    orphans=[int(row[0]) for row in rows if int(row[0]) not in journaled]
+    if (len(orphans) == 0):
+        return
+    print "removing %d partially uploaded reads from %s." % (len(orphans), dbname)
+    delete_reads(dbname, orphans, cursor)
+    db.commit()
+
+def delete_reads(dbname, basenameids, cursor):
+    ## every table keyed on basename_id, so nothing of the reads is left behind
+    sql="SELECT DISTINCT TABLE_NAME FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_SCHEMA=\'%s\' AND COLUMN_NAME='basename_id'" % (dbname)
+    cursor.execute(sql)
+    tables=[row[0] for row in cursor.fetchall()]
+    basenameids=sorted(basenameids)
+    for x in xrange(0, len(basenameids), 1000):
+        ids=','.join([str(int(i)) for i in basenameids[x:x+1000]])
+        for tablename in tables:
+            sql="DELETE FROM %s.%s WHERE basename_id IN (%s)" % (dbname, tablename, ids)
+            cursor.execute(sql)
+
+#####################################################################
+## Append-only record of the files that have been completely uploaded to a run,
+## one "path<TAB>md5<TAB>basename_id" line per file, kept in minup_run_logs.
+
+class ingest_journal():
+    def __init__(self, dbname):
+        self.path=os.path.join(os.path.sep,logfolder,dbname+".minup.journal")
+        self.paths=set()
+        self.md5s=dict()
+        self.handle=None
+        self.torn=False
+        self.exists=os.path.isfile(self.path)
+        if (self.exists is True):
+            with open(self.path,"rb") as journalhandle:
+                for line in journalhandle:
+                    if (line.endswith("\n") is False): # last line cut short by a crash
+                        self.torn=True
+                        continue
+                    fields=line.rstrip("\r\n").split("\t")
+                    if (len(fields) == 3):
+                        self.paths.add(compact_path_key(fields[0]))
+                        self.md5s[fields[1]]=int(fields[2])
+
+    def has_path(self, filepath):
+        return (compact_path_key(filepath) in self.paths)
+
+    def has_checksum(self, checksum):
+        return (checksum in self.md5s)
+
+    def record(self, filepath, checksum, basenameid):
+        self.record_many([(filepath, checksum, basenameid)])
+
+    def record_many(self, entries):
+        lines=["%s\t%s\t%s\n" % (filepath, checksum, basenameid) for filepath, checksum, basenameid in entries]
+        if (self.handle is None):
+            self.handle=os.open(self.path, os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0644)
+            self.exists=True
+            if (self.torn is True):
+                lines.insert(0, "\n")
+                self.torn=False
+        os.write(self.handle, ''.join(lines))
+        for filepath, checksum, basenameid in entries:
+            self.paths.add(compact_path_key(filepath))
+            self.md5s[checksum]=basenameid
+
+    def reset(self):
+        ## for a run database that is being made afresh, when the journal is left from an earlier one
+        if (self.handle is not None):
+            os.close(self.handle)
+            self.handle=None
+        if (os.path.isfile(self.path)):
+            os.remove(self.path)
+        self.paths=set()
+        self.md5s=dict()
+        self.torn=False
+        self.exists=False
+
+def get_ingest_journal(dbname):
+    if (dbname not in ingest_journals):
+        ingest_journals[dbname]=ingest_journal(dbname)
+    return ingest_journals[dbname]
+
+def reset_ingest_journal(dbname):
+    get_ingest_journal(dbname).reset()
+    del ingest_journals[dbname]
+
+def record_ingested(dbname, filepath, checksum, basenameid):
+    with ingest_journals_lock: # reads are finished by the alignment and telemetry threads
+        get_ingest_journal(dbname).record(filepath, checksum, basenameid)
+
+#####################################################################
+## A read is only journaled once everything of it is in the database: its
+## own rows, each of its alignments (once the alignment sink has written
+## them) and its telemetry. read_progress counts the parts still to be
+## written per read. A read with a part that failed isn't journaled, so -res
+## removes what there is of it and uploads it again.
+
+class read_progress():
+    def __init__(self):
+        self.lock=threading.Lock()
+        self.pending=dict() # (dbname, basename_id): [parts still to write, failed, filepath, checksum]
+
+    def start(self, read):
+        ## the read's own rows are the first part, done once they are committed
+        with self.lock:
+            self.pending[(read.dbname, read.basenameid)]=[1, False, read.filepath, read.checksum]
+
+    def discard(self, read):
+        with self.lock:
+            self.pending.pop((read.dbname, read.basenameid), None)
+
+    def add(self, dbname, basenameid, parts=1):
+        with self.lock:
+            if ((dbname, basenameid) in self.pending):
+                self.pending[(dbname, basenameid)][0]+=parts
+
+    def done(self, dbname, basenameid, ok=True):
+        with self.lock:
+            entry=self.pending.get((dbname, basenameid))
+            if (entry is None): # discarded
+                return
+            entry[0]-=1
+            if (ok is False):
+                entry[1]=True
+            if (entry[0] > 0):
+                return
+            del self.pending[(dbname, basenameid)]
+        parts, failed, filepath, checksum = entry
+        if (failed is True):
+            print >>sys.stderr, "%s wasn't completely written to %s, it will be uploaded again by -res" % (filepath, dbname)
+            return
+        if (args.verbose is True):
+            print "basename_id %s completely written to %s" % (basenameid, dbname)
+        record_ingested(dbname, filepath, checksum, basenameid)
+
+    def pending_reads(self):
+        with self.lock:
+            return len(self.pending)
+
+read_tracker=read_progress()
+
+#####################################################################
+
+def open_connection_pool(dbname):
+    if (dbname in connection_pool):
+        connection_pool[dbname].close()
+    connection_pool[dbname]=db_connection_pool(dbname, max(args.pool_size, 1))
+    if (args.last_align is True or args.bwa_align is True or args.telem is True):
+        try:
+            connection_pool[dbname].fill()
+
+        except Exception, err:
+            err_string = "Can't setup MySQL connection pool: %s" % (err)
+            print >>sys.stderr, err_string
+            with open(dbcheckhash["logfile"][dbname],"a") as logfilehandle:
+                logfilehandle.write(err_string+os.linesep)
+                logfilehandle.close()
+            sys.exit()
+
+#####################################################################
+## The extra connections of a run database. Threads check a connection out,
+## use it and give it back; connections are pinged before they are handed
+## out and replaced when they have gone away. run() retries the whole call
+## on a new connection if the connection is lost while it runs; each call is
+## one transaction, committed when it returns and rolled back if it fails.
+
+class db_connection_pool():
+    def __init__(self, dbname, size):
+        self.dbname=dbname
+        self.size=size
+        self.idle=list()
+        self.opened=0
+        self.in_use=0
+        self.lock=threading.Condition()
+        self.started=time.time()
+        self.checkouts=0
+        self.waits=0
+        self.wait_time=0.0
+        self.max_wait=0.0
+        self.busy_time=0.0
+        self.reconnects=0
+        self.checkout_times=dict()
+
+    def connect(self):
+        tries=0
+        while True:
+            try:
+                return MySQLdb.connect(host=args.dbhost, user=args.dbusername, passwd=args.dbpass, port=args.dbport, db=self.dbname, local_infile=1)
+            except MySQLdb.OperationalError, err:
+                tries+=1
+                if (tries > args.pool_retries):
+                    raise
+                print >>sys.stderr, "Can't connect to %s, retrying: %s" % (self.dbname, err)
+                time.sleep(tries)
+
+    def fill(self):
+        while (self.opened < self.size):
+            dbx=self.connect()
+            with self.lock:
+                self.idle.append(dbx)
+                self.opened+=1
+
+    def checkout(self):
+        requested=time.time()
+        dbx=None
+        with self.lock:
+            if (len(self.idle) == 0 and self.opened >= self.size):
+                self.waits+=1
+            while (len(self.idle) == 0 and self.opened >= self.size):
+                self.lock.wait()
+            if (0 < len(self.idle)):
+                dbx=self.idle.pop()
+            else:
+                self.opened+=1
+            self.in_use+=1
+            waited=time.time()-requested
+            self.checkouts+=1
+            self.wait_time+=waited
+            self.max_wait=max(self.max_wait, waited)
+        try:
+            if (dbx is None):
+                dbx=self.connect()
+            else:
+                dbx=self.check_alive(dbx)
+        except Exception:
+            with self.lock:
+                self.opened-=1
+                self.in_use-=1
+                self.lock.notify()
+            raise
+        with self.lock:
+            self.checkout_times[id(dbx)]=time.time()
+        return dbx
+
+    def check_alive(self, dbx):
+        try:
+            dbx.ping()
+            return dbx
+        except MySQLdb.Error:
+            close_quietly(dbx)
+            with self.lock:
+                self.reconnects+=1
+            return self.connect()
+
+    def checkin(self, dbx, broken=False):
+        with self.lock:
+            self.busy_time+=time.time()-self.checkout_times.pop(id(dbx), time.time())
+            self.in_use-=1
+            if (broken is True):
+                self.opened-=1
+            else:
+                self.idle.append(dbx)
+            self.lock.notify()
+        if (broken is True):
+            close_quietly(dbx)
+
+    def run(self, func, *funcargs):
+        tries=0
+        while True:
+            dbx=self.checkout()
+            try:
+                result=func(*(funcargs+(dbx,)))
+                dbx.commit() # everything one call wrote goes in together
+            except MySQLdb.OperationalError, err:
+                rollback_quietly(dbx)
+                self.checkin(dbx, connection_lost(err))
+                tries+=1
+                if (connection_lost(err) is False or tries > args.pool_retries):
+                    raise
+                with self.lock:
+                    self.reconnects+=1
+                print >>sys.stderr, "MySQL connection to %s lost, retrying: %s" % (self.dbname, err)
+                continue
+            except Exception:
+                rollback_quietly(dbx)
+                self.checkin(dbx)
+                raise
+            self.checkin(dbx)
+            return result
+
+    def stats(self):
+        with self.lock:
+            elapsed=max(time.time()-self.started, 1e-6)
+            avg_wait=0.0
+            if (0 < self.checkouts):
+                avg_wait=self.wait_time/self.checkouts
+            return {"size":self.size, "open":self.opened, "in_use":self.in_use, "checkouts":self.checkouts, "waits":self.waits, "avg_wait":avg_wait, "max_wait":self.max_wait, "utilisation":self.busy_time/(elapsed*self.size), "reconnects":self.reconnects}
+
+    def close(self):
+        with self.lock:
+            idle=self.idle
+            self.idle=list()
+            self.opened-=len(idle)
+        for dbx in idle:
+            close_quietly(dbx)
+
+def connection_lost(err):
+    return (err.args[0] in (2006, 2013, 2055)) # server gone away, lost connection during query, lost connection at handshake
+
+def rollback_quietly(dbx):
+    try:
+        dbx.rollback()
+    except Exception:
+        pass
+
+def close_quietly(dbx):
+    try:
+        dbx.close()
+    except Exception:
+        pass
+
+def print_pool_stats():
+    for name, pool in connection_pool.iteritems():
+        if (0 < pool.checkouts):
+            print "connection pool %s: %s" % (name, ', '.join(["%s=%s" % (k, round(v, 3) if isinstance(v, float) else v) for k, v in sorted(pool.stats().iteritems())]))
+
+#####################################################################
+## worker processes for --workers. Each one has its own MySQL connection
+## and h5py handles. The main process does the run-level setup in check_read
+## and hands each file over together with the state of its run.
+
+def init_ingest_worker():
+    global db
+    global cursor
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # the main process deals with ctrl-c
+    db = MySQLdb.connect(host=args.dbhost, user=args.dbusername, passwd=args.dbpass, port=args.dbport, local_infile=1)
+    cursor = db.cursor()
+    if (args.bulk_rows > 1 or args.txn_reads > 0):
+        t = threading.Thread(target=bulk_flush_timer)
+        t.daemon = True
+        t.start()
+        multiprocessing.util.Finalize(None, flush_bulk_writers, args=(cursor, True), exitpriority=10)
+    multiprocessing.util.Finalize(None, drain_aligner_batchers, exitpriority=6)
+    multiprocessing.util.Finalize(None, drain_alignment_workers, exitpriority=5)
+    multiprocessing.util.Finalize(None, flush_alignment_sinks, exitpriority=4)
+    multiprocessing.util.Finalize(None, flush_telemetry_sink, exitpriority=4)
+
+def ingest_worker_runstate(dbname):
+    refdict=None
+    if (dbname in ref_fasta_hash):
+        refdict=dict((k, v) for k, v in ref_fasta_hash[dbname].iteritems() if k not in ("kmer", "index_ready"))
+    runstate={"runindex":dbcheckhash["runindex"][dbname], "logfile":dbcheckhash["logfile"][dbname], "barcode_info":dbcheckhash["barcode_info"][dbname], "ref":refdict}
+    return runstate
+
+def attach_ingest_worker_run(dbname, runstate):
+    if (dbname not in dbcheckhash["dbname"]):
+        dbcheckhash["runindex"][dbname]=runstate["runindex"]
+        dbcheckhash["logfile"][dbname]=runstate["logfile"]
+        dbcheckhash["barcoded"][dbname]=False
+        dbcheckhash["barcode_info"][dbname]=True # barcode_control is filled in once by the main process
+        if (runstate["ref"] is not None):
+            ref_fasta_hash[dbname]=runstate["ref"]
+        open_connection_pool(dbname)
+        dbcheckhash["dbname"][dbname]=False
+    if (dbcheckhash["dbname"][dbname] is False):
+        sql="USE %s" % (dbname)
+        cursor.execute(sql)
+        for e in dbcheckhash["dbname"].keys():
+            dbcheckhash["dbname"][e] = False
+        dbcheckhash["dbname"][dbname] = True
+
+def ingest_worker_process(fast5file, dbname, runstate):
+    try:
+        with ingest_lock:
+            attach_ingest_worker_run(dbname, runstate)
+            hdf = h5py.File(fast5file, 'r')
+            check_read(fast5file, hdf, cursor)
+            process_fast5(fast5file, hdf, dbname, cursor)
+    except Exception, err:
+        err_string="Error with fast5 file: %s : %s" % (fast5file, err)
+        print >>sys.stderr, err_string
+        if (dbname in dbcheckhash["logfile"]):
+            with open(dbcheckhash["logfile"][dbname],"a") as logfilehandle:
+                logfilehandle.write(err_string+os.linesep)
+                logfilehandle.close()
+
+#####################################################################
+
 def process_fast5(filepath, hdf, dbname, cursor):
+    read=parse_fast5(filepath, hdf, dbname)
+    hdf.close()
+    if (read is not None):
+        write_fast5(read, cursor)
+
+#####################################################
+## The two halves of a read's upload: parse_fast5 takes everything minup
+## needs out of the hdf5 file without touching the database, write_fast5
+## writes it. process_fast5 runs them one after the other; the ingest
+## pipeline runs them in separate stages.
+
+class fast5_read():
+    def __init__(self, filepath, dbname):
+        self.filepath=filepath
+        self.dbname=dbname
+        self.checksum=None
+        self.basename=None
+        self.basenameid=None
+        self.tracking_id_hash=None
+        self.rows=list() # (tablename, data_hash) written after tracking_id, with its basename_id
+        self.models=list() # (model name, model table) for model_data
+        self.model_list=None # (template_model, complement_model)
+        self.fastqhash=dict()
+        self.tel_data=dict() # readtype: [table name or channel, events, buffer key]
+
+def parse_fast5(filepath, hdf, dbname):
 
     checksum=hashlib.md5(open(filepath, 'rb').read()).hexdigest()
     #print checksum, type(checksum)
+    if (args.resume is True and get_ingest_journal(dbname).has_checksum(checksum)): # this read has already been uploaded
+        if (args.verbose is True):
+            print "already uploaded:", filepath
+        return None
+    read=fast5_read(filepath, dbname)
+    read.checksum=checksum
     ### find the right basecall_2D location, get configuaration genral data, and define the basename.
-    basecalltype="Basecall_1D_CDNA"
-    basecalltype2="Basecall_2D"
-    basecalldir=''
-    basecalldirconfig=''
+    layout=get_fast5_layout(hdf, dbname)
+    basecalldir=layout.basecalldir
     #print "REF", ref_fasta_hash
 
-    for x in range (0,9):
-        string='/Analyses/%s_00%s/Configuration/general' % (basecalltype,x)
-        if (string in hdf):
-            basecalldir='/Analyses/%s_00%s/' % (basecalltype,x)
-            basecalldirconfig=string
-            break
-        string='/Analyses/%s_00%s/Configuration/general' % (basecalltype2,x)
-        if (string in hdf):
-            basecalldir='/Analyses/%s_00%s/' % (basecalltype2,x)
-            basecalldirconfig=string
-            break
-
-
-    configdata=hdf[basecalldirconfig]
+    configdata=hdf[layout.basecalldirconfig]
     basename=configdata.attrs['basename'] #= PLSP57501_17062014lambda_3216_1_ch101_file10_strand
+    read.basename=basename
 
 
 
 
     ## get all the tracking_id data, make primary entry for basename, and get basenameid
     tracking_id_fields=['basename','asic_id','asic_id_17','asic_id_eeprom','asic_temp','device_id','exp_script_purpose','exp_script_name','exp_start_time','flow_cell_id','heatsink_temp','hostname','run_id','version_name',]
-    tracking_id_hash=make_hdf5_object_attr_hash(hdf['/UniqueGlobalKey/tracking_id'],tracking_id_fields)
+    tracking_id_hash=make_hdf5_object_attr_hash(hdf['/UniqueGlobalKey/tracking_id'],tracking_id_fields,layout,'tracking_id')
     tracking_id_hash.update({'basename':basename,'file_path':filepath, 'md5sum':checksum})
     hdf5object=hdf['/UniqueGlobalKey/channel_id']
         #print "Got event location"
-    for x in ('channel_number','digitisation','offset','sampling_rate'):
-        if (x in hdf5object.attrs.keys() ):
-            value=str(hdf5object.attrs[x])
-            #print x, value
-            tracking_id_hash.update({x:value})
+    for x, value in make_hdf5_object_attr_hash(hdf5object,('channel_number','digitisation','offset','sampling_rate'),layout,'channel_id').iteritems():
+        #print x, value
+        tracking_id_hash.update({x:str(value)})
     #range is a specifal case:
     #for x in ('range'):
     #    if (x in hdf5object.attrs.keys() ):
@@ -598,38 +1116,33 @@ def process_fast5(filepath, hdf, dbname, cursor):
     if "\\pass\\" in filepath:
         passcheck = 1
     tracking_id_hash.update({'pass':passcheck})
-    basenameid=mysql_load_from_hashes(cursor,"tracking_id", tracking_id_hash)
+    read.tracking_id_hash=tracking_id_hash
 
     ## get all the data from Configuration/general, then add Event Detection mux pore number
     general_fields=['basename','local_folder','workflow_script','workflow_name','read_id','use_local','tag','model_path','complement_model','max_events','input','min_events','config','template_model','channel','metrichor_version','metrichor_time_stamp']
-    general_hash=make_hdf5_object_attr_hash(configdata, general_fields)
-    general_hash.update({'basename_id':basenameid})
+    general_hash=make_hdf5_object_attr_hash(configdata, general_fields, layout, 'config_general')
     metrichor_info=hdf[basecalldir]
     general_hash.update({'metrichor_version':metrichor_info.attrs['version'], 'metrichor_time_stamp':metrichor_info.attrs['time_stamp']})
-
     ## get event detection for the read; define mux pore nuber
     eventdectionreadstring = '/Analyses/EventDetection_000/Reads/Read_%s' % (general_hash['read_id'])
     if (eventdectionreadstring in hdf):
         hdf5object=hdf[eventdectionreadstring]
         #print "Got event location"
-        for x in ('start_mux','end_mux','abasic_event_index','abasic_found','abasic_peak_height','duration','hairpin_event_index','hairpin_found','hairpin_peak_height','hairpin_polyt_level','median_before','read_number','scaling_used','start_time'):
-            if (x in hdf5object.attrs.keys() ):
-                value=str(hdf5object.attrs[x])
-                #print x, value
-                general_hash.update({x:value})
-        #Specific to catch read_id as different class:
-        for x in ('read_id'):
-            if (x in hdf5object.attrs.keys() ):
-                value=str(hdf5object.attrs[x])
-                #print 'read_name', value
-                general_hash.update({'read_name':value})
+        event_detection_hash=make_hdf5_object_attr_hash(hdf5object,('start_mux','end_mux','abasic_event_index','abasic_found','abasic_peak_height','duration','hairpin_event_index','hairpin_found','hairpin_peak_height','hairpin_polyt_level','median_before','read_number','scaling_used','start_time','read_id'),layout,'event_detection')
+        for x, value in event_detection_hash.iteritems():
+            #print x, value
+            if (x=='read_id'): #Specific to catch read_id as different class:
+                general_hash.update({'read_name':str(value)})
+            else:
+                general_hash.update({x:str(value)})
         #Add pass flag to general_hash
         general_hash.update({'pass':passcheck})
         general_hash.update({'exp_start_time':tracking_id_hash['exp_start_time']})
-        general_hash.update({'1minwin':int(hdf5object.attrs['start_time']/float(tracking_id_hash['sampling_rate'])/60)})#'1minwin':int(template_start/(60))
-        general_hash.update({'5minwin':int(hdf5object.attrs['start_time']/float(tracking_id_hash['sampling_rate'])/60/5)})#'1minwin':int(template_start/(60))
-        general_hash.update({'10minwin':int(hdf5object.attrs['start_time']/float(tracking_id_hash['sampling_rate'])/60/10)})#'1minwin':int(template_start/(60))
-        general_hash.update({'15minwin':int(hdf5object.attrs['start_time']/float(tracking_id_hash['sampling_rate'])/60/15)})#'1minwin':int(template_start/(60))
+        start_time=event_detection_hash['start_time']
+        general_hash.update({'1minwin':int(start_time/float(tracking_id_hash['sampling_rate'])/60)})#'1minwin':int(template_start/(60))
+        general_hash.update({'5minwin':int(start_time/float(tracking_id_hash['sampling_rate'])/60/5)})#'1minwin':int(template_start/(60))
+        general_hash.update({'10minwin':int(start_time/float(tracking_id_hash['sampling_rate'])/60/10)})#'1minwin':int(template_start/(60))
+        general_hash.update({'15minwin':int(start_time/float(tracking_id_hash['sampling_rate'])/60/15)})#'1minwin':int(template_start/(60))
 
         #if ('start_mux' in hdf5object.attrs.keys() ):
         #    start_mux=str(hdf5object.attrs['start_mux'])
@@ -641,43 +1154,23 @@ def process_fast5(filepath, hdf, dbname, cursor):
         #    general_hash.update({'end_mux':stop_mux})
 
     ### load general_hash into mysql
-    mysql_load_from_hashes(cursor,"config_general", general_hash)
+    read.rows.append(("config_general", general_hash))
 
     ## get all the basecall summary split hairpin data
     basecall_summary_fields=['abasic_dur','abasic_index','abasic_peak','duration_comp','duration_temp','end_index_comp','end_index_temp','hairpin_abasics','hairpin_dur','hairpin_events','hairpin_peak','median_level_comp','median_level_temp','median_sd_comp','median_sd_temp','num_comp','num_events','num_temp','pt_level','range_comp','range_temp','split_index','start_index_comp','start_index_temp']
-    basecall_summary_hash=make_hdf5_object_attr_hash(hdf[basecalldir+'Summary/split_hairpin'],basecall_summary_fields)
+    basecall_summary_hash=make_hdf5_object_attr_hash(hdf[basecalldir+'Summary/split_hairpin'],basecall_summary_fields,layout,'split_hairpin')
 
     ## adding info about other the basecalling itself
-    if (basecalldir+'Summary/basecall_1d_complement' in hdf):
-        hdf5object=hdf[basecalldir+'Summary/basecall_1d_complement']
-        #print "Got event location"
-        for x in ('drift','mean_qscore','num_skips','num_stays','scale','scale_sd','sequence_length','shift','strand_score','var','var_sd'):
-            if (x in hdf5object.attrs.keys() ):
-                value=str(hdf5object.attrs[x])
+    basecall_fields=('drift','mean_qscore','num_skips','num_stays','scale','scale_sd','sequence_length','shift','strand_score','var','var_sd')
+    for summary, fields, suffix in (('basecall_1d_complement',basecall_fields,"C"),('basecall_1d_template',basecall_fields,"T"),('basecall_2d',('mean_qscore','sequence_length'),"2")):
+        if (basecalldir+'Summary/'+summary in hdf):
+            hdf5object=hdf[basecalldir+'Summary/'+summary]
+            #print "Got event location"
+            for x, value in make_hdf5_object_attr_hash(hdf5object,fields,layout,summary).iteritems():
                 #print x, value
-                basecall_summary_hash.update({x+"C":value})
-
-    ## adding info about other the basecalling itself
-    if (basecalldir+'Summary/basecall_1d_template' in hdf):
-        hdf5object=hdf[basecalldir+'Summary/basecall_1d_template']
-        #print "Got event location"
-        for x in ('drift','mean_qscore','num_skips','num_stays','scale','scale_sd','sequence_length','shift','strand_score','var','var_sd'):
-            if (x in hdf5object.attrs.keys() ):
-                value=str(hdf5object.attrs[x])
-                #print x, value
-                basecall_summary_hash.update({x+"T":value})
-
-    if (basecalldir+'Summary/basecall_2d' in hdf):
-        hdf5object=hdf[basecalldir+'Summary/basecall_2d']
-        #print "Got event location"
-        for x in ('mean_qscore','sequence_length'):
-            if (x in hdf5object.attrs.keys() ):
-                value=str(hdf5object.attrs[x])
-                #print x, value
-                basecall_summary_hash.update({x+"2":value})
+                basecall_summary_hash.update({x+suffix:str(value)})
 
     ## Adding key indexes and time stamps
-    basecall_summary_hash.update({'basename_id':basenameid})
     basecall_summary_hash.update({'pass':passcheck})
     basecall_summary_hash.update({'exp_start_time':tracking_id_hash['exp_start_time']})
     basecall_summary_hash.update({'1minwin':general_hash['1minwin']})
@@ -687,27 +1180,21 @@ def process_fast5(filepath, hdf, dbname, cursor):
     #print basecall_summary_hash
 
     ## load basecall summary hash into mysql
-    mysql_load_from_hashes(cursor,"basecall_summary",basecall_summary_hash)
+    read.rows.append(("basecall_summary", basecall_summary_hash))
 
     ## see if there is any barcoding info to addd
     barcode_hash=dict()
-    for x in range(0,9):
-        string='/Analyses/Barcoding_00%s/Summary/barcoding' % (x )
-        #print string
-        if (string in hdf):
-            #print "barcode", string
-            barcode_hash=make_hdf5_object_attr_hash(hdf[string],('pos0_start','score','design','pos1_end','pos0_end','pos1_start','variant','barcode_arrangement') )
-            barcode_hash.update({'basename_id':basenameid})
-            mysql_load_from_hashes(cursor,"barcode_assignment", barcode_hash)
-            #print barcode_hash
-            #for bk in barcode_hash.keys():
-            #    print bk, barcode_hash[bk], type(barcode_hash[bk])
-            break
+    if (layout.barcoding_summary is not None and layout.barcoding_summary in hdf):
+        #print "barcode", layout.barcoding_summary
+        barcode_hash=make_hdf5_object_attr_hash(hdf[layout.barcoding_summary],('pos0_start','score','design','pos1_end','pos0_end','pos1_start','variant','barcode_arrangement'),layout,'barcoding')
+        read.rows.append(("barcode_assignment", barcode_hash))
+        #print barcode_hash
+        #for bk in barcode_hash.keys():
+        #    print bk, barcode_hash[bk], type(barcode_hash[bk])
 
     ############# Do model details ##################
     if (args.telem is True):
-        if (dbname not in dbcheckhash["modelcheck"]):
-            dbcheckhash["modelcheck"][dbname]=dict()
+        modelcheck=dbcheckhash["modelcheck"].get(dbname, dict())
 
         log_string=basecalldir+'Log'
         if (log_string in hdf):
@@ -725,38 +1212,31 @@ def process_fast5(filepath, hdf, dbname, cursor):
                     complement_model=c.group(1)
 
             if (template_model is not None):
-                sql="INSERT INTO %s (basename_id,template_model,complement_model) VALUES ('%s','%s',NULL)" % ("model_list", basenameid,template_model)
-                if (template_model not in dbcheckhash["modelcheck"][dbname]):
+                read.model_list=(template_model, complement_model)
+                if (template_model not in modelcheck):
                     location=basecalldir+'BaseCalled_template/Model'
                     if location in hdf:
-                        upload_model_data("model_data", template_model, location, hdf, cursor)
-                        dbcheckhash["modelcheck"][dbname][template_model]=1
+                        read.models.append((template_model, hdf[location][()]))
 
                 if (complement_model is not None):
-                    sql = "INSERT INTO %s (basename_id,template_model,complement_model) VALUES ('%s','%s','%s')" % ("model_list", basenameid,template_model,complement_model)
-                    if (complement_model not in dbcheckhash["modelcheck"][dbname]):
+                    if (complement_model not in modelcheck):
                         location=basecalldir+'BaseCalled_complement/Model'
                         if location in hdf:
-                            upload_model_data("model_data", complement_model, location, hdf, cursor)
-                            dbcheckhash["modelcheck"][dbname][complement_model]=1
-
-                cursor.execute(sql)
-                db.commit()
+                            read.models.append((complement_model, hdf[location][()]))
 
     ############################################################
     readtypes = {'basecalled_template' : basecalldir+'BaseCalled_template/',
     'basecalled_complement' : basecalldir+'BaseCalled_complement/',
     'basecalled_2d' : basecalldir+'BaseCalled_2D/'}
 
-    fastqhash=dict()
+    fastqhash=read.fastqhash
     #tel_sql_list=list()
-    tel_data_hash=dict()
     template_start=0
     for readtype, location in readtypes.iteritems():
         if (location in hdf):
             fastq = hdf[location+'Fastq'][()]
             try:
-                rec=SeqIO.read(StringIO(fastq), "fastq")
+                sequence, qualtext, quals = decode_fastq(fastq)
             except Exception, err:
                 err_string = "%s:\tError reading fastq oject from base: %s type: %s error: %s" % (time.strftime('%Y-%m-%d %H:%M:%S'), basename, readtype, err)
                 print >>sys.stderr, err_string
@@ -765,44 +1245,43 @@ def process_fast5(filepath, hdf, dbname, cursor):
                     logfilehandle.close()
                 continue
 
-            sequence = str(rec.seq)
             seqlen = len(sequence)
-            rec.id=basename+"."+readtype
+            seqid=basename+"."+readtype
 
-            qual=chr_convert_array(rec.letter_annotations["phred_quality"])
-            fastqhash[rec.id]={"quals":rec.letter_annotations["phred_quality"], "seq":sequence}
+            qual=qualtext # already phred+33
+            fastqhash[seqid]={"quals":quals, "seq":sequence}
 
             if (location+'Alignment' in hdf): # so its 2D
                 #print "we're looking at a 2D read",template_start,"\n\n"
-                mysql_load_from_hashes(cursor,readtype, {'basename_id':basenameid,'seqid':rec.id,'sequence':sequence,'qual':qual,'start_time':template_start,'seqlen':seqlen,'exp_start_time':tracking_id_hash['exp_start_time'],'1minwin':int(template_start/(60)),'5minwin':int(template_start/(5*60)),'10minwin':int(template_start/(10*60)),'15minwin':int(template_start/(15*60)),'pass':passcheck})
+                read.rows.append((readtype, {'seqid':seqid,'sequence':sequence,'qual':qual,'start_time':template_start,'seqlen':seqlen,'exp_start_time':tracking_id_hash['exp_start_time'],'1minwin':int(template_start/(60)),'5minwin':int(template_start/(5*60)),'10minwin':int(template_start/(10*60)),'15minwin':int(template_start/(15*60)),'pass':passcheck}))
                 if (args.telem is True):
-                    alignment = hdf[location+'Alignment'][()]
+                    alignment = read_dataset(hdf[location+'Alignment'], readtype+'_alignment')
                     #print "ALIGNMENT", type(alignment)
                     channel = general_hash["channel"][-1]
-                    tel_data_hash[readtype]=[basenameid,channel,alignment]
+                    read.tel_data[readtype]=[channel,alignment,readtype+'_alignment']
                     #upload_2dalignment_data(basenameid,channel,alignment,db)
                     #tel_sql_list.append(t_sql)
 
             complement_and_template_fields=['basename','seqid','duration','start_time','scale','shift','gross_shift','drift','scale_sd','var_sd','var','sequence','qual']
             if (location+'Events' in hdf and location+'Model' in hdf): # so its either template or complement
-                events_hash=make_hdf5_object_attr_hash(hdf[location+'Events'], complement_and_template_fields)
-                model_hash=make_hdf5_object_attr_hash(hdf[location+'Model'], complement_and_template_fields)
+                events_hash=make_hdf5_object_attr_hash(hdf[location+'Events'], complement_and_template_fields, layout, readtype+'_events')
+                model_hash=make_hdf5_object_attr_hash(hdf[location+'Model'], complement_and_template_fields, layout, readtype+'_model')
                 ##Logging the start time of a template read to pass to the 2d read in order to speed up mysql processing
                 if (readtype=="basecalled_template"):
                     template_start = events_hash['start_time']
                 events_hash.update(model_hash)
-                events_hash.update({'basename_id':basenameid,'seqid':rec.id,'sequence':sequence,'qual':qual,'seqlen':seqlen, '1minwin':int(events_hash['start_time']/(60)),'5minwin':int(events_hash['start_time']/(5*60)),'10minwin':int(events_hash['start_time']/(10*60)),'15minwin':int(events_hash['start_time']/(15*60))})
+                events_hash.update({'seqid':seqid,'sequence':sequence,'qual':qual,'seqlen':seqlen, '1minwin':int(events_hash['start_time']/(60)),'5minwin':int(events_hash['start_time']/(5*60)),'10minwin':int(events_hash['start_time']/(10*60)),'15minwin':int(events_hash['start_time']/(15*60))})
                 events_hash.update({'exp_start_time':tracking_id_hash['exp_start_time'],'pass':passcheck})
-                mysql_load_from_hashes(cursor, readtype, events_hash)
+                read.rows.append((readtype, events_hash))
 
                 ###### This inserts telemetry data. It is optional under the flags above.
-                ###### Modified to calculate some means and averages - so we are going to do this everytime
-                #if (args.telem is True):
+                ###### The events are only read when they are going to be uploaded
+                if (args.telem is True):
                     #print "start telem",  (time.time())-starttime
                     ### Do Events
-                events = hdf[location+'Events'][()]
-                tablechannel = readtype + "_" + general_hash["channel"][-1]
-                tel_data_hash[readtype]=[basenameid,tablechannel,events]
+                    events = read_dataset(hdf[location+'Events'], readtype+'_events')
+                    tablechannel = readtype + "_" + general_hash["channel"][-1]
+                    read.tel_data[readtype]=[tablechannel,events,readtype+'_events']
                 ## We want to calculate the mean current for a read here... how do we do that?
                 #eventcounter=0
                 #totalcurrent=0
@@ -814,31 +1293,425 @@ def process_fast5(filepath, hdf, dbname, cursor):
                 #print numpy.median(numpy.array(meanlist))
                 #print basenameid, basename,readtype,eventcounter,totalcurrent/eventcounter
 
+    return read
+
+def write_fast5(read, cursor):
+    dbname=read.dbname
+    read_txn.begin(cursor, dbname)
+    try:
+        upload_fast5(read, cursor)
+    except Exception:
+        read_txn.rollback(cursor, dbname)
+        read_tracker.discard(read)
+        release_tel_data(read)
+        raise
+    read_txn.release(cursor)
+    flush_bulk_writers(cursor)
+
+def upload_fast5(read, cursor):
+    dbname=read.dbname
+    basenameid=bulk_load_from_hashes(cursor, dbname, "tracking_id", read.tracking_id_hash, "basename_id")
+    read.basenameid=basenameid
+    read_tracker.start(read)
+    for tablename, data_hash in read.rows:
+        data_hash['basename_id']=basenameid
+        bulk_load_from_hashes(cursor, dbname, tablename, data_hash)
+
+    ############# Do model details ##################
+    if (read.model_list is not None):
+        if (dbname not in dbcheckhash["modelcheck"]):
+            dbcheckhash["modelcheck"][dbname]=dict()
+        for model_name, table in read.models:
+            if (model_name not in dbcheckhash["modelcheck"][dbname]):
+                upload_model_data(dbname+".model_data", model_name, table, cursor)
+                dbcheckhash["modelcheck"][dbname][model_name]=1
+        sql="INSERT INTO %s.model_list (basename_id,template_model,complement_model) VALUES (%%s,%%s,%%s)" % (dbname)
+        cursor.execute(sql, (basenameid, read.model_list[0], read.model_list[1]))
+        commit_rows()
+
     ##########################################################
     if (dbname in ref_fasta_hash): # so we're doing an alignment
-        if (fastqhash): # sanity check for the quality scores in the hdf5 file. this will not exist if it's malformed.
-            if (args.last_align is True):
-                if (args.verbose is True):
-                    print "aligning...."
-                init_last_threads(connection_pool[dbname], fastqhash, basename, basenameid, dbname)
-            if (args.bwa_align is True):
-                if (args.verbose is True):
-                    print "aligning...."
-                init_bwa_threads(connection_pool[dbname], fastqhash, basename, basenameid, dbname)
+        if (read.fastqhash): # sanity check for the quality scores in the hdf5 file. this will not exist if it's malformed.
+            ## the alignments update the read rows, so they have to wait until those are written
+            after_bulk_flush((dbname, basenameid), submit_alignment, read)
             #for seqid in fastqhash.keys():    # use this for debugging instead of lines above that use threading
             #    #if ("template" in seqid):
             #    do_last_align(seqid, fastqhash[seqid], basename, basenameid, dbname, db)
             #    do_bwa_align(seqid, fastqhash[seqid], basename, basenameid, dbname, db)
-    hdf.close()
-
 
     if (args.telem is True):
-        init_tel_threads2(connection_pool[dbname], tel_data_hash)
+        after_bulk_flush((dbname, basenameid), submit_telemetry, read)
+
+    after_bulk_flush((dbname, basenameid), read_tracker.done, dbname, basenameid)
 
 #####################################################
+def submit_alignment(read):
+    aligners=[args.last_align, args.bwa_align].count(True)
+    read_tracker.add(read.dbname, read.basenameid, len(read.fastqhash)*aligners)
+    if (ingest_stages is not None):
+        ingest_stages.align.put((read,))
+    else:
+        align_read(read.fastqhash, read.basename, read.basenameid, read.dbname)
+
+def submit_telemetry(read):
+    read_tracker.add(read.dbname, read.basenameid)
+    get_telemetry_sink().put(read)
+
+def upload_telemetry(read, db):
+    for readtype, (table, data, key) in read.tel_data.iteritems():
+        if (args.tel_blob is True):
+            upload_telem_blob(read.basenameid, readtype, table, data, db)
+        elif (readtype == "basecalled_2d"):
+            upload_2dalignment_data(read.basenameid, table, data, db)
+        else:
+            upload_telem_data(read.basenameid, table, data, db)
 
-def do_bwa_align(seqid, fastqhash, basename, basenameid, dbname, db):
-    cursor=db.cursor()
+def release_tel_data(read):
+    for readtype, (table, data, key) in read.tel_data.iteritems():
+        release_dataset(key, data)
+    read.tel_data=dict()
+
+#####################################################
+## The ingest pipeline used when minup runs without --workers:
+##   parse -> write -> align -> alignment write
+## (telemetry goes to the telemetry sink once a read is committed)
+## Each stage has its own threads and a bounded queue in front of it, so a
+## slow stage makes the one before it wait instead of piling up reads. The
+## write stage is a single thread as it owns the main MySQL connection;
+## alignments and telemetry are queued once their read has been committed.
+
+class pipeline_stage():
+    def __init__(self, name, func, threads, queuesize):
+        self.name=name
+        self.func=func
+        self.queue=Queue.Queue(max(queuesize, 1))
+        for i in xrange(max(threads, 1)):
+            t=threading.Thread(target=self.worker)
+            t.daemon=True
+            t.start()
+
+    def put(self, item):
+        self.queue.put(item) # blocks while the stage is full
+
+    def worker(self):
+        while True:
+            item=self.queue.get()
+            try:
+                self.func(*item)
+            except Exception, err:
+                print >>sys.stderr, "Error in the %s stage: %s" % (self.name, err)
+            finally:
+                self.queue.task_done()
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def drain(self):
+        self.queue.join()
+
+class ingest_pipeline():
+    def __init__(self):
+        self.parse=pipeline_stage("parse", parse_stage, args.parse_threads, args.stage_queue)
+        self.write=pipeline_stage("write", write_stage, 1, args.stage_queue)
+        self.align=pipeline_stage("align", align_stage, args.align_threads, args.stage_queue)
+        self.alignwrite=pipeline_stage("alignwrite", alignment_write_stage, args.align_write_threads, args.stage_queue)
+
+    def stages(self):
+        return (self.parse, self.write, self.align, self.alignwrite)
+
+    def depths(self):
+        depths=["%s=%d" % (stage.name, stage.depth()) for stage in self.stages()]
+        with aligner_batchers_lock:
+            batched=sum([batcher.depth() for batcher in aligner_batchers.itervalues()])
+        depths.insert(3, "alignbatch=%d" % (batched))
+        depths.append("unwritten_reads=%d" % (read_tracker.pending_reads()))
+        if (telemetry_writer is not None):
+            depths.append("telemetry=%d" % (telemetry_writer.depth()))
+        return ' '.join(depths)
+
+    def drain(self):
+        self.parse.drain()
+        self.write.drain()
+        with ingest_lock:
+            flush_bulk_writers(cursor, True) # queues the alignments and telemetry still held back
+        self.align.drain()
+        drain_aligner_batchers()
+        self.alignwrite.drain()
+        flush_alignment_sinks()
+        flush_telemetry_sink()
+
+def parse_stage(fast5file):
+    try:
+        hdf = h5py.File(fast5file, 'r')
+        try:
+            with ingest_lock: # run-level setup uses the main connection
+                dbname=check_read(fast5file, hdf, cursor)
+            read=parse_fast5(fast5file, hdf, dbname)
+        finally:
+            hdf.close()
+    except Exception, err:
+        log_fast5_error(fast5file, err)
+        return
+    if (read is not None):
+        ingest_stages.write.put((read,))
+
+def write_stage(read):
+    try:
+        with ingest_lock:
+            write_fast5(read, cursor)
+    except Exception, err:
+        log_fast5_error(read.filepath, err)
+
+def align_stage(read):
+    for seqid, fastqdata in read.fastqhash.iteritems():
+        if (args.last_align is True):
+            get_aligner_batcher("last", read.dbname).submit(seqid, fastqdata["seq"], queue_alignment_write, load_last_alignment, seqid, read)
+        if (args.bwa_align is True):
+            get_aligner_batcher("bwa", read.dbname).submit(seqid, fastqdata["seq"], queue_alignment_write, load_bwa_alignment, seqid, read)
+
+def queue_alignment_write(out, loader, seqid, read):
+    ingest_stages.alignwrite.put((loader, out, seqid, read))
+
+def alignment_write_stage(loader, out, seqid, read):
+    ## the read's part is done by the alignment sink once it has written the results
+    try:
+        loader(out, seqid, read.fastqhash[seqid], read.basename, read.basenameid, read.dbname)
+    except Exception:
+        read_tracker.done(read.dbname, read.basenameid, False)
+        raise
+
+#####################################################
+## Batched aligner runs for the align stage and for --workers. Sequences for
+## the same reference and aligner are collected and aligned with one lastal/bwa
+## process, so the index is loaded once per batch. The aligners write all of a
+## query's alignments together, so each read's records are handed on (to the
+## alignment write stage or the alignment workers) as soon as the next query's
+## begin, and only one read's are held.
+## Neither aligner writes anything until it has read its whole input batch,
+## which is why this batches instead of keeping a process open per read.
+
+class aligner_batcher():
+    def __init__(self, aligner, dbname):
+        self.aligner=aligner
+        self.dbname=dbname
+        self.pending=list() # (seqid, sequence, callback, callback args)
+        self.started=0
+        self.lock=threading.Lock()
+        self.batches=Queue.Queue(max(args.stage_queue, 1))
+        for i in xrange(max(args.align_procs, 1)):
+            t=threading.Thread(target=self.runner)
+            t.daemon=True
+            t.start()
+        t=threading.Thread(target=self.timer)
+        t.daemon=True
+        t.start()
+
+    def submit(self, seqid, seq, callback, *cbargs):
+        with self.lock:
+            if (len(self.pending) == 0):
+                self.started=time.time()
+            self.pending.append((seqid, seq, callback, cbargs))
+            if (len(self.pending) >= args.align_batch):
+                self.hand_off()
+
+    def hand_off(self):
+        ## called with self.lock held
+        if (0 < len(self.pending)):
+            self.batches.put(self.pending)
+            self.pending=list()
+
+    def timer(self):
+        while True:
+            time.sleep(0.1)
+            with self.lock:
+                if (0 < len(self.pending) and args.align_batch_secs <= (time.time()-self.started) ):
+                    self.hand_off()
+
+    def runner(self):
+        while True:
+            batch=self.batches.get()
+            callbacks=dict((seqid, (callback, cbargs)) for seqid, seq, callback, cbargs in batch) # seqids not yet called back
+            try:
+                self.run_batch(batch, callbacks)
+            except Exception, err:
+                print >>sys.stderr, "Error aligning a batch of %d sequences with %s: %s" % (len(batch), self.aligner, err)
+            finally:
+                for callback, cbargs in callbacks.itervalues(): # unaligned, or left over by an error, so the reads aren't left waiting
+                    callback([], *cbargs)
+                self.batches.task_done()
+
+    def run_batch(self, batch, callbacks):
+        seqs=[(seqid, seq) for seqid, seq, callback, cbargs in batch]
+        if (self.aligner == "last"):
+            records=run_last_batch(seqs, self.dbname)
+        else:
+            records=run_bwa_batch(seqs, self.dbname)
+        qname=None
+        out=list()
+        for record in records:
+            if (record.qname != qname):
+                self.dispatch(callbacks, qname, out)
+                qname=record.qname
+                out=list()
+            out.append(record)
+        self.dispatch(callbacks, qname, out)
+
+    def dispatch(self, callbacks, qname, out):
+        if (qname is None):
+            return
+        if (qname not in callbacks):
+            print >>sys.stderr, "%d alignments of %s from %s came apart from the query's others and are left out" % (len(out), qname, self.aligner)
+            return
+        callback, cbargs = callbacks.pop(qname)
+        callback(out, *cbargs)
+
+    def depth(self):
+        with self.lock:
+            return len(self.pending)+self.batches.qsize()
+
+    def drain(self):
+        with self.lock:
+            self.hand_off()
+        self.batches.join()
+
+def get_aligner_batcher(aligner, dbname):
+    with aligner_batchers_lock:
+        if ((aligner, dbname) not in aligner_batchers):
+            aligner_batchers[(aligner, dbname)]=aligner_batcher(aligner, dbname)
+        return aligner_batchers[(aligner, dbname)]
+
+def drain_aligner_batchers():
+    with aligner_batchers_lock:
+        batchers=aligner_batchers.values()
+    for batcher in batchers:
+        batcher.drain()
+
+#####################################################
+## Streaming readers for the aligners' output. stream_aligner feeds the fasta
+## to the aligner from a thread and hands back its stdout line by line, and
+## parse_maf/parse_sam turn those lines into one small record per alignment,
+## so nothing holds the whole MAF/SAM text for a read with many alignments.
+## SAM tags are kept by name as (type, value) with i and f values converted.
+
+maf_record=collections.namedtuple('maf_record', 'score rname rstart rlen rstrand rsize raln qname qstart qlen strand qsize qaln')
+sam_record=collections.namedtuple('sam_record', 'qname flag rname pos mapq cigar rnext pnext tlen seq qual tags')
+
+def stream_aligner(cmd, fasta):
+    devnull=open(os.devnull, 'w')
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,stderr=devnull,stdin=subprocess.PIPE, shell=True)
+    def feed():
+        try:
+            proc.stdin.write(fasta)
+        except IOError: # the aligner has gone away, its exit shows up below
+            pass
+        finally:
+            proc.stdin.close()
+    feeder=threading.Thread(target=feed)
+    feeder.daemon=True
+    feeder.start()
+    try:
+        for line in iter(proc.stdout.readline, ''):
+            yield line
+    finally:
+        proc.stdout.close()
+        feeder.join()
+        proc.wait()
+        devnull.close()
+
+def maf_number(value):
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+def parse_maf(lines):
+    ## a block is an "a" line and its "s" lines, the query being the second "s" line
+    score=None
+    r_list=None
+    for line in lines:
+        if (line.startswith('a')):
+            score=None
+            r_list=None
+            for field in line.split()[1:]:
+                if (field.startswith('score=')):
+                    score=maf_number(field[6:])
+        elif (line.startswith('s') and score is not None):
+            if (r_list is None):
+                r_list=line.split()
+            else:
+                q_list=line.split()
+                #name start alnSize strand seqSize alignment
+                yield maf_record(score, r_list[1], int(r_list[2]), int(r_list[3]), r_list[4], int(r_list[5]), r_list[6], q_list[1], int(q_list[2]), int(q_list[3]), q_list[4], int(q_list[5]), q_list[6])
+                score=None
+        elif (not line.startswith('q') and not line.startswith('i')):
+            score=None
+
+def parse_sam_tag(tag):
+    name, kind, value=tag.split(':', 2)
+    if (kind == 'i'):
+        value=int(value)
+    elif (kind == 'f'):
+        value=float(value)
+    return name, (kind, value)
+
+def sam_tag_text(record, name):
+    ## the tag as it appeared in the SAM line, e.g. NM:i:3
+    if (name not in record.tags):
+        return None
+    kind, value=record.tags[name]
+    return "%s:%s:%s" % (name, kind, value)
+
+def sam_tag_value(record, name, default=None):
+    if (name not in record.tags):
+        return default
+    return record.tags[name][1]
+
+def parse_sam(lines):
+    for line in lines:
+        if (line.startswith('@')):
+            continue
+        record=line.rstrip('\r\n').split('\t')
+        if (len(record) < 11):
+            continue
+        tags=dict(parse_sam_tag(tag) for tag in record[11:])
+        yield sam_record(record[0], int(record[1]), record[2], int(record[3]), int(record[4]), record[5], record[6], int(record[7]), int(record[8]), record[9], record[10], tags)
+
+def log_fast5_error(fast5file, err):
+    err_string="Error with fast5 file: %s : %s" % (fast5file, err)
+    print >>sys.stderr, err_string
+    dbname=dbname_from_filepath(fast5file)
+    if (dbname in dbcheckhash["logfile"]):
+        with open(dbcheckhash["logfile"][dbname],"a") as logfilehandle:
+            logfilehandle.write(err_string+os.linesep)
+            logfilehandle.close()
+
+#####################################################
+
+def align_read(fastqhash, basename, basenameid, dbname):
+    if (args.last_align is True):
+        if (args.verbose is True):
+            print "aligning...."
+        init_last_threads(fastqhash, basename, basenameid, dbname)
+    if (args.bwa_align is True):
+        if (args.verbose is True):
+            print "aligning...."
+        init_bwa_threads(fastqhash, basename, basenameid, dbname)
+
+#####################################################
+
+def run_bwa_batch(seqs, dbname):
+    wait_for_reference_index(dbname)
+    options="-"+(args.bwa_options.replace(","," -"))
+    #print options
+    #read='>testread\nGGCATGACATAAACAAACGTACTTGCCTGTCTGATATATCTTCGGCGTCTTGATCGTAGTTATACGTCATCATAGTGCGGGCCGCGTATTTGTGTTGTCG'
+    #cmd='bwa mem -x ont2d -T0 %s.bwa.index %s.fasta ' % (ref_fasta_hash[dbname]["prefix"], basename)
+    #cmd='cat %s.fasta | bwa mem -x ont2d -T0 %s.bwa.index -' % (basename, ref_fasta_hash[dbname]["prefix"])
+    read="\n".join([">%s \r\n%s" % (seqid,seq) for seqid, seq in seqs])
+    cmd='bwa mem -x ont2d %s %s -' % (options, ref_fasta_hash[dbname]["bwa_index"])
+    #print cmd
+    return parse_sam(stream_aligner(cmd, read))
+
+def load_bwa_alignment(records, seqid, fastqhash, basename, basenameid, dbname):
     #Op BAM Description
     #M 0 alignment match (can be a sequence match or mismatch)cur
     #I 1 insertion to the reference
@@ -850,271 +1723,185 @@ def do_bwa_align(seqid, fastqhash, basename, basenameid, dbname, db):
     #= 7 sequence match
     #X 8 sequence mismatch
 
-    colstring='basename_id,refid,alignnum,covcount,alignstrand,score,seqpos,refpos,seqbase,refbase,seqbasequal,cigarclass'
+    prime_cols=('basename_id','refid','alignnum','covcount','alignstrand','score','seqpos','refpos','seqbase','refbase','seqbasequal','cigarclass')
+    sam_cols=('basename_id','qname','flag','rname','pos','mapq','cigar','rnext','pnext','tlen','seq','qual','N_M','M_D','A_S','X_S')
+    table_rows=dict() # (tablename, cols): rows for the alignment sink
+    aligned=set()
     qualscores=fastqhash["quals"]
-    options="-"+(args.bwa_options.replace(","," -"))
-    #print options
-    #read='>testread\nGGCATGACATAAACAAACGTACTTGCCTGTCTGATATATCTTCGGCGTCTTGATCGTAGTTATACGTCATCATAGTGCGGGCCGCGTATTTGTGTTGTCG'
-    #cmd='bwa mem -x ont2d -T0 %s.bwa.index %s.fasta ' % (ref_fasta_hash[dbname]["prefix"], basename)
-    #cmd='cat %s.fasta | bwa mem -x ont2d -T0 %s.bwa.index -' % (basename, ref_fasta_hash[dbname]["prefix"])
-    read=">%s \r\n%s" % (seqid,fastqhash["seq"])
-    cmd='bwa mem -x ont2d %s %s -' % (options, ref_fasta_hash[dbname]["bwa_index"])
-    #print cmd
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,stderr=subprocess.PIPE,stdin=subprocess.PIPE, shell=True)
-    out, err = proc.communicate(input=read)
-    status = proc.wait()
-    #print "BWA Error", err
-    sam=out.encode('utf-8')
-    samdata=sam.splitlines()
-    for line in samdata:
-        #print line
-        if not line.startswith('@'):
-            line=line.strip('\n')
-            record=line.split("\t")
-            #print "RECORD", len(record)
-            if (record[2] is not '*'):
-                qname=record[0]
-                flag=int(record[1])
-                rname=record[2]
-                refid=ref_fasta_hash[dbname]["refid"][rname]
-                pos=int(record[3])
-                mapq=int(record[4])
-                cigar=record[5]
-                rnext=record[6]
-                pnext=record[7]
-                tlen=int(record[8])
-                seq=record[9]
-                qual=record[10]
-                n_m=record[11]
-                m_d=record[12]
-                a_s=record[13]
-                x_s=record[14]
-
-                align_strand=str()
-                strand=str()
-
-                if (flag==0 or flag==2048):
-                    strand="+"
-                    align_strand="F"
-
-                if (flag==16 or flag==2064):
-                    strand="-"
-                    align_strand="R"
-
-                tablename=str()
-                if (qname.endswith("2d")):
-                    tablename='align_sam_basecalled_2d'
-                if (qname.endswith("complement")):
-                    tablename='align_sam_basecalled_complement'
-                if (qname.endswith("template")):
-                    tablename='align_sam_basecalled_template'
-                sql= "INSERT INTO %s (basename_id,qname,flag,rname,pos,mapq,cigar,rnext,pnext,tlen,seq,qual,N_M,M_D,A_S,X_S) VALUES (%d,\'%s\',%d,\'%s\',%d,%d,\'%s\',\'%s\',\'%s\',%d,\'%s\',\'%s\',\'%s\',\'%s\',\'%s\',\'%s\')" % (tablename,basenameid,qname,flag,rname,pos,mapq,cigar,rnext,pnext,tlen,seq,qual,n_m,m_d,a_s,x_s)
-                #print sql
-                cursor.execute(sql)
-                db.commit()
-                #print tablename
-
-                ##################
-                r_pos=int(record[3])-1
-                readbases=list(record[9])
-                #translate_cigar_mdflag_to_reference(cigar,m_d,r_pos,readbases)
-                align_info=translate_cigar_mdflag_to_reference(cigar,m_d,r_pos,readbases)
-                #result={"q_start":q_start, "q_stop":q_stop, "q_start_base":r_array[0],"q_stop_base":r_array[-1], "r_start":r_start, "r_stop":r_stop, "r_start_base":r_array[0],"r_stop_base":r_array[-1]  }
-                ####### do 5' 3' aligned read base position calc. ########
-                tablename = 'last_align_'+qname.rsplit('.', 1)[1]
-                #lo.pprint tablename
-                if (args.verbose is True):
-                    align_message="%s\tAligned:%s:%s-%s (%s) " % (qname, rname, align_info["r_start"], align_info["r_stop"], strand)
-                    print align_message
-                #print line
+    for record in records:
+        if (record.rname != '*'):
+            qname=record.qname
+            flag=record.flag
+            rname=record.rname
+            refid=ref_fasta_hash[dbname]["refid"][rname]
+            pos=record.pos
+            mapq=record.mapq
+            cigar=record.cigar
+            rnext=record.rnext
+            pnext=record.pnext
+            tlen=record.tlen
+            seq=record.seq
+            qual=record.qual
+            n_m=sam_tag_text(record, 'NM')
+            m_d=sam_tag_text(record, 'MD')
+            a_s=sam_tag_text(record, 'AS')
+            x_s=sam_tag_text(record, 'XS')
+
+            align_strand=str()
+            strand=str()
+
+            if (flag==0 or flag==2048):
+                strand="+"
+                align_strand="F"
 
-                ####I think this is the point we know a read is aligning.
+            if (flag==16 or flag==2064):
+                strand="-"
+                align_strand="R"
 
-                sql = "UPDATE "+dbname+"."+qname.split('.')[-1]+" SET align='1' WHERE basename_id=\'%s\'" % (basenameid) # ML
-                #print sql
-                #sys.exit()
-                cursor.execute(sql)
-                db.commit()
+            tablename=str()
+            if (qname.endswith("2d")):
+                tablename='align_sam_basecalled_2d'
+            if (qname.endswith("complement")):
+                tablename='align_sam_basecalled_complement'
+            if (qname.endswith("template")):
+                tablename='align_sam_basecalled_template'
+            sam_row=(basenameid,qname,flag,rname,pos,mapq,cigar,rnext,pnext,tlen,seq,qual,n_m,m_d,a_s,x_s)
+            #print sam_row
+            table_rows.setdefault((tablename, sam_cols), list()).append(sam_row)
+            #print tablename
+
+            ##################
+            r_pos=pos-1
+            align_info=translate_cigar_mdflag_to_reference(cigar,sam_tag_value(record, 'MD', ''),r_pos,seq)
+            #result={"q_start":q_start, "q_stop":q_stop, "q_start_base":r_array[0],"q_stop_base":r_array[-1], "r_start":r_start, "r_stop":r_stop, "r_start_base":r_array[0],"r_stop_base":r_array[-1]  }
+            ####### do 5' 3' aligned read base position calc. ########
+            tablename = 'last_align_'+qname.rsplit('.', 1)[1]
+            #lo.pprint tablename
+            if (args.verbose is True):
+                align_message="%s\tAligned:%s:%s-%s (%s) " % (qname, rname, align_info["r_start"], align_info["r_stop"], strand)
+                print align_message
+            #print line
 
-                if (flag==0): # so it's a primary alignment, POSITIVE strand
-                    fiveprimetable = tablename+"_5prime"
-                    threeprimetable = tablename+"_3prime"
-                    #print "Qs", len(qualscores), int(align_info["q_stop"])
-                    ### five prime
-                    valstring="("
-                    valstring+= "%s," % (basenameid) # basename_id
-                    valstring+= "%s," % (refid) # refid
-                    valstring+= "%s," % '1' # alignnum
-                    valstring+= "%s," % '0' # covcount
-                    valstring+= "\'%s\'," % (align_strand) # alignstrand
-                    valstring+= "%s," % mapq # score
-                    valstring+= "%s," % ( align_info["q_start"] ) # seqpos
-                    valstring+= "%s," % ( align_info["r_start"] ) # refpos
-                    valstring+= "\'%s\'," % ( align_info["q_start_base"] ) # seqbase
-                    valstring+= "\'%s\'," % ( align_info["r_start_base"] ) # refbase
-                    valstring+= "%s," % qualscores[int(align_info["q_start"])-1] # seqbasequal
-                    valstring+= "%s" % ('7') # cigarclass
-                    valstring+=")"
-                    #primes[tablename]['fiveprime']['string']=valstring
-                    sql="INSERT INTO %s (%s) VALUES %s" % (fiveprimetable, colstring, valstring)
-                    #print "B", sql
-                    cursor.execute(sql)
-                    db.commit()
-
-
-                    ### three prime
-                    valstring="("
-                    valstring+= "%s," % (basenameid) # basename_id
-                    valstring+= "%s," % (refid) # refid
-                    valstring+= "%s," % '1' # alignnum
-                    valstring+= "%s," % '0' # covcount
-                    valstring+= "\'%s\'," % (align_strand) # alignstrand
-                    valstring+= "%s," % mapq # score
-                    valstring+= "%s," % (align_info["q_stop"] ) # seqpos
-                    valstring+= "%s," % (align_info["r_stop"] ) # refpos
-                    valstring+= "\'%s\'," % (align_info["q_stop_base"] ) # seqbase
-                    valstring+= "\'%s\'," % (align_info["r_stop_base"] ) # refbase
-                    valstring+= "%s," % qualscores[int(align_info["q_stop"])-1]  # seqbasequal
-                    valstring+= "%s" % ('7') # cigarclass
-                    valstring+=")"
-                    sql="INSERT INTO %s (%s) VALUES %s" % (threeprimetable, colstring, valstring)
-                    #print "B", sql
-                    cursor.execute(sql)
-                    db.commit()
-
-                if (flag==16 ): # It's a primary alignment on the NEGATIVE strand
-                    fiveprimetable = tablename+"_5prime"
-                    threeprimetable = tablename+"_3prime"
-                    #print "Qs", len(qualscores), int(align_info["q_stop"])
-                    ### five prime
-                    valstring="("
-                    valstring+= "%s," % (basenameid) # basename_id
-                    valstring+= "%s," % (refid) # refid
-                    valstring+= "%s," % '1' # alignnum
-                    valstring+= "%s," % '0' # covcount
-                    valstring+= "\'%s\'," % (align_strand) # alignstrand
-                    valstring+= "%s," % mapq # score
-                    valstring+= "%s," % ( align_info["q_start"] ) # seqpos
-                    valstring+= "%s," % ( align_info["r_stop"] ) # refpos
-                    valstring+= "\'%s\'," % ( align_info["q_start_base"] ) # seqbase
-                    valstring+= "\'%s\'," % ( align_info["r_stop_base"] ) # refbase
-                    valstring+= "%s," % qualscores[int(align_info["q_stop"])-1] # seqbasequal
-                    valstring+= "%s" % ('7') # cigarclass
-                    valstring+=")"
-                    #primes[tablename]['fiveprime']['string']=valstring
-                    sql="INSERT INTO %s (%s) VALUES %s" % (fiveprimetable, colstring, valstring)
-                    #print "B", sql
-                    cursor.execute(sql)
-                    db.commit()
-
-                    ### three prime
-                    valstring="("
-                    valstring+= "%s," % (basenameid) # basename_id
-                    valstring+= "%s," % (refid) # refid
-                    valstring+= "%s," % '1' # alignnum
-                    valstring+= "%s," % '0' # covcount
-                    valstring+= "\'%s\'," % (align_strand) # alignstrand
-                    valstring+= "%s," % mapq # score
-                    valstring+= "%s," % (align_info["q_stop"] ) # seqpos
-                    valstring+= "%s," % (align_info["r_start"] ) # refpos
-                    valstring+= "\'%s\'," % (align_info["q_stop_base"] ) # seqbase
-                    valstring+= "\'%s\'," % (align_info["r_start_base"] ) # refbase
-                    valstring+= "%s," % qualscores[int(align_info["q_stop"])-1]  # seqbasequal
-                    valstring+= "%s" % ('7') # cigarclass
-                    valstring+=")"
-                    sql="INSERT INTO %s (%s) VALUES %s" % (threeprimetable, colstring, valstring)
-                    #print "B", sql
-                    cursor.execute(sql)
-                    db.commit()
-                ##################################
+            ####I think this is the point we know a read is aligning.
+            aligned.add(qname.split('.')[-1])
 
-######################################################
+            if (flag==0): # so it's a primary alignment, POSITIVE strand
+                fiveprimetable = tablename+"_5prime"
+                threeprimetable = tablename+"_3prime"
+                #print "Qs", len(qualscores), int(align_info["q_stop"])
+                ### five prime: basename_id, refid, alignnum, covcount, alignstrand, score, seqpos, refpos, seqbase, refbase, seqbasequal, cigarclass
+                table_rows.setdefault((fiveprimetable, prime_cols), list()).append((basenameid, refid, 1, 0, align_strand, mapq, align_info["q_start"], align_info["r_start"], align_info["q_start_base"], align_info["r_start_base"], qualscores[int(align_info["q_start"])-1], 7))
 
-def translate_cigar_mdflag_to_reference(cigar,m_d,r_start,readbases):
+                ### three prime
+                table_rows.setdefault((threeprimetable, prime_cols), list()).append((basenameid, refid, 1, 0, align_strand, mapq, align_info["q_stop"], align_info["r_stop"], align_info["q_stop_base"], align_info["r_stop_base"], qualscores[int(align_info["q_stop"])-1], 7))
 
+            if (flag==16 ): # It's a primary alignment on the NEGATIVE strand
+                fiveprimetable = tablename+"_5prime"
+                threeprimetable = tablename+"_3prime"
+                #print "Qs", len(qualscores), int(align_info["q_stop"])
+                ### five prime
+                table_rows.setdefault((fiveprimetable, prime_cols), list()).append((basenameid, refid, 1, 0, align_strand, mapq, align_info["q_start"], align_info["r_stop"], align_info["q_start_base"], align_info["r_stop_base"], qualscores[int(align_info["q_stop"])-1], 7))
+
+                ### three prime
+                table_rows.setdefault((threeprimetable, prime_cols), list()).append((basenameid, refid, 1, 0, align_strand, mapq, align_info["q_stop"], align_info["r_start"], align_info["q_stop_base"], align_info["r_start_base"], qualscores[int(align_info["q_stop"])-1], 7))
+            ##################################
+
+    get_alignment_sink(dbname).add(basenameid, aligned, table_rows)
+
+######################################################
+
+######################################################################
+## CIGAR and MD strings are handled as runs of operations rather than base by
+## base. The endpoints of an alignment and the bases at either end only need
+## one pass over the runs; the aligned strings themselves (q_array/r_array)
+## are only built when asked for with columns=True.
+
+def cigar_runs(cigar):
+    return [(int(count), op) for count, op in re.findall('(\d+)([MIDNSHP=X])', cigar)]
+
+def md_runs(m_d):
+    ## (count, bases): bases is None for a run of matches, the reference base
+    ## of a mismatch, or the reference bases deleted from the read
+    runs=list()
+    for count, deleted, mismatch in re.findall('(\d+)|\^([A-Z]+)|([A-Z])', m_d.replace('MD:Z:', '')):
+        if (count):
+            if (0 < int(count)):
+                runs.append((int(count), None))
+        elif (deleted):
+            runs.append((len(deleted), deleted))
+        else:
+            runs.append((1, mismatch))
+    return runs
+
+def md_reference_base(runs, offset, readbases, q_index):
+    r=0
+    for count, bases in runs:
+        if (offset < r+count):
+            if (bases is None):
+                return readbases[q_index]
+            return bases[offset-r]
+        r+=count
+    if (q_index is None):
+        return "X"
+    return readbases[q_index]
+
+def translate_cigar_mdflag_to_reference(cigar,m_d,r_start,readbases,columns=False):
+    runs=md_runs(m_d)
+    cigsecs=cigar_runs(cigar)
     q_pos=0
     r_pos=r_start
-    r_array=list()
+    first=None
+    last=None # (op, query index, reference offset) of the first and last aligned column
     q_array=list()
-
-    cigparts = re.split('([A-Z])', cigar)
-    cigsecs=[cigparts[x:x+2] for x in xrange(0, len(cigparts)-1, 2)]
-
-    for cig in cigsecs:
-        #print "cigar point:", cigarpoint
-        cigartype = cig[1]
-        cigarpartbasecount=int(cig[0])
-        if (cigartype is "S"): # not aligned read section
-            q_pos+=cigarpartbasecount
-
-        if (cigartype is "M"): # so its not a deletion or insertion. Its 0:M
-            for q in xrange(q_pos, (q_pos+cigarpartbasecount) ):
-                q_array.append(readbases[q])
-            for r in xrange(r_pos, (r_pos+cigarpartbasecount) ):
-                r_array.append("X")
-            q_pos+=cigarpartbasecount
-            r_pos+=cigarpartbasecount
-
-        if (cigartype is "I"):
-            for q in xrange(q_pos, (q_pos+cigarpartbasecount) ):
-                q_array.append(readbases[q])
-            for r in xrange(r_pos, (r_pos+cigarpartbasecount) ):
-                r_array.append("-")
-            q_pos+=cigarpartbasecount
-
-        if (cigartype is "D"):
-            for q in xrange(q_pos, (q_pos+cigarpartbasecount) ):
-                q_array.append("-")
-            for r in xrange(r_pos, (r_pos+cigarpartbasecount) ):
-                #rstring+=str(refbases[r])
-                r_array.append("X")
-            r_pos+=cigarpartbasecount
-
-    #print "QUERY:", ''.join(q_array)
-    #print "REFF1:", ''.join(r_array)
-    #####################################################
-    for x in range(len(q_array)):
-        if (r_array[x] is not "-"):
-            if (q_array[x] is not "-"):
-                r_array[x]=q_array[x]
-    #print "REFF2:", ''.join(r_array)
-    #####################################################
-    mdparts = re.split('(\d+|MD:Z:)', m_d)
-    a=0
-    for m in mdparts:
-        if (m.isdigit()):
-            for b in range(int(m)):
-                if (r_array[(a+b)] is "-"):
-                    while (r_array[(a+b)] is "-"):
-                        a+=1
-            a+=int(m)
-
+    r_array=list()
+    for count, op in cigsecs:
+        if (op == "S"): # not aligned read section
+            q_pos+=count
+        elif (op in "M=X"):
+            if (first is None):
+                first=(op, q_pos, r_pos-r_start)
+            last=(op, q_pos+count-1, r_pos+count-1-r_start)
+            if (columns is True):
+                q_array.extend(readbases[q_pos:q_pos+count])
+                r_array.extend(md_reference_base(runs, r_pos-r_start+x, readbases, q_pos+x) for x in xrange(count))
+            q_pos+=count
+            r_pos+=count
+        elif (op == "I"):
+            if (first is None):
+                first=(op, q_pos, None)
+            last=(op, q_pos+count-1, None)
+            if (columns is True):
+                q_array.extend(readbases[q_pos:q_pos+count])
+                r_array.extend("-"*count)
+            q_pos+=count
+        elif (op == "D"):
+            if (first is None):
+                first=(op, None, r_pos-r_start)
+            last=(op, None, r_pos+count-1-r_start)
+            if (columns is True):
+                q_array.extend("-"*count)
+                r_array.extend(md_reference_base(runs, r_pos-r_start+x, readbases, None) for x in xrange(count))
+            r_pos+=count
+        elif (op == "N"):
+            r_pos+=count
+
+    end_bases=list()
+    for op, q_index, r_offset in (first, last):
+        if (op == "I"):
+            end_bases.append("-")
         else:
-            if (m is "A" or m is "T" or m is "C" or m is "G"):
-                if (r_array[a] is "-"):
-                    while (r_array[a] is "-"):
-                        a+=1
-                r_array[a]=m
-                #r_array[a]="o"
-                a+=1
-
-            else:
-                if (m.startswith('^')):
-                    ins=list(m[1:])
-                    for x in range(len(ins)):
-                        r_array[a]=ins[x]
-                        #r_array[a]='i'
-                        a+=1
-    #print "QUERY:", ''.join(q_array)
-    #print "REFF3:", ''.join(r_array)
+            end_bases.append(md_reference_base(runs, r_offset, readbases, q_index))
     ## get the first position of the query sequence that is aligned
     q_start=0
-    if (cigsecs[0][1] is "S" or cigsecs[0][1] is "H"):
+    if (cigsecs[0][1] == "S" or cigsecs[0][1] == "H"):
         q_start=cigsecs[0][0]
     ######
     q_stop=q_pos
     r_stop=r_pos
-    result={"q_start":int(q_start), "q_stop":int(q_stop), "q_start_base":r_array[0],"q_stop_base":r_array[-1], "r_start":(int(r_start+1)), "r_stop":(int(r_stop+1)), "r_start_base":r_array[0],"r_stop_base":r_array[-1]  }
+    result={"q_start":int(q_start), "q_stop":int(q_stop), "q_start_base":end_bases[0],"q_stop_base":end_bases[1], "r_start":(int(r_start+1)), "r_stop":(int(r_stop+1)), "r_start_base":end_bases[0],"r_stop_base":end_bases[1]  }
+    if (columns is True):
+        result["q_array"]=q_array
+        result["r_array"]=r_array
     return result
 
 
@@ -1145,214 +1932,420 @@ def create_align_table_sam(tablename, cursor):
     #print sql
     cursor.execute(sql)
 
-###########################################
-class last_threader(threading.Thread):
-    def __init__(self,seqid,fastqdata,basename,basenameid,dbname,db):
-        threading.Thread.__init__(self)
-        self.seqid=seqid
-        self.fastqdata=fastqdata
-        self.basename=basename
-        self.basenameid=basenameid
-        self.dbname=dbname
-        self.db=db
+#####################################################
 
-    def run(self):
-        do_last_align(self.seqid,self.fastqdata,self.basename,self.basenameid,self.dbname,self.db)
+#######################################################
+## Telemetry is written in the background so ingest never waits for it. Reads
+## are put on a bounded queue once their rows are committed; writer threads,
+## each with its own MySQL connection per run database, take up to
+## --telemetry-batch-reads reads off the queue at a time, write their events
+## and commit them together (or a read at a time, if the batch fails). flush_telemetry_sink waits for everything queued
+## to be written and is run when minup (or a worker process) shuts down.
+
+class telemetry_sink():
+    def __init__(self, threads, queuesize):
+        self.queue=Queue.Queue(max(queuesize, 1))
+        for i in xrange(max(threads, 1)):
+            t=threading.Thread(target=self.writer)
+            t.daemon=True
+            t.start()
 
-###########################################
+    def put(self, read):
+        self.queue.put(read) # blocks while the queue is full
 
-class bwa_threader(threading.Thread):
-    def __init__(self,seqid,fastqdata,basename,basenameid,dbname,db):
-        threading.Thread.__init__(self)
-        self.seqid=seqid
-        self.fastqdata=fastqdata
-        self.basename=basename
-        self.basenameid=basenameid
-        self.dbname=dbname
-        self.db=db
+    def writer(self):
+        connections=dict() # dbname: this thread's connection
+        while True:
+            batch=[self.queue.get()]
+            while (len(batch) < args.tel_batch):
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            reads=dict()
+            for read in batch:
+                reads.setdefault(read.dbname, list()).append(read)
+            for dbname, dbreads in reads.iteritems():
+                self.write_reads(dbname, dbreads, connections)
+            for read in batch:
+                release_tel_data(read)
+                self.queue.task_done()
+
+    def write_reads(self, dbname, reads, connections):
+        ## a batch that fails is written again a read at a time, so one bad
+        ## read doesn't lose the telemetry of the others
+        try:
+            self.write(dbname, reads, connections)
+        except Exception, err:
+            lost=(isinstance(err, MySQLdb.OperationalError) and connection_lost(err))
+            if (len(reads) == 1 or lost is True): # the retries for a lost connection are used up
+                if (len(reads) == 1):
+                    err_string="%s:\tError writing the telemetry of basename_id %s: %s" % (time.strftime('%Y-%m-%d %H:%M:%S'), reads[0].basenameid, err)
+                else:
+                    err_string="%s:\tError writing the telemetry of %d reads: %s" % (time.strftime('%Y-%m-%d %H:%M:%S'), len(reads), err)
+                print >>sys.stderr, err_string
+                if (dbname in dbcheckhash["logfile"]):
+                    with open(dbcheckhash["logfile"][dbname],"a") as logfilehandle:
+                        logfilehandle.write(err_string+os.linesep)
+                        logfilehandle.close()
+                for read in reads:
+                    read_tracker.done(dbname, read.basenameid, False)
+                return
+            for read in reads:
+                self.write_reads(dbname, [read], connections)
+            return
+        for read in reads:
+            read_tracker.done(dbname, read.basenameid)
+
+    def write(self, dbname, reads, connections):
+        tries=0
+        while True:
+            if (dbname not in connections):
+                connections[dbname]=connection_pool[dbname].connect()
+            dbx=connections[dbname]
+            try:
+                for read in reads:
+                    upload_telemetry(read, dbx)
+                dbx.commit()
+                return
+            except MySQLdb.OperationalError, err:
+                rollback_quietly(dbx)
+                tries+=1
+                if (connection_lost(err) is False or tries > args.pool_retries):
+                    raise
+                close_quietly(dbx)
+                del connections[dbname]
+                print >>sys.stderr, "MySQL connection to %s lost, retrying the telemetry: %s" % (dbname, err)
+            except Exception:
+                rollback_quietly(dbx)
+                raise
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def drain(self):
+        self.queue.join()
+
+def get_telemetry_sink():
+    global telemetry_writer
+    with telemetry_writer_lock:
+        if (telemetry_writer is None):
+            telemetry_writer=telemetry_sink(args.tel_threads, args.stage_queue)
+        return telemetry_writer
+
+def flush_telemetry_sink():
+    if (telemetry_writer is not None):
+        telemetry_writer.drain()
 
-    def run(self):
-        do_bwa_align(self.seqid,self.fastqdata,self.basename,self.basenameid,self.dbname,self.db)
+########################################################
 
-#####################################################
+## With --workers the sequences are aligned in batches by aligner_batcher, as
+## in the pipeline, and each read's results are loaded by the alignment workers.
 
-class tel_threader(threading.Thread):
-    def __init__(self,db,sql):
-        threading.Thread.__init__(self)
-        self.db=db
-        self.sql=sql
-    def run(self):
-        run_insert(self.db, self.sql)
+def init_last_threads(fastqhash, basename, basenameid,dbname):
+    for seqid in fastqhash.keys():
+        fastqdata=fastqhash[seqid]
+        get_aligner_batcher("last", dbname).submit(seqid, fastqdata["seq"], queue_alignment_load, load_last_alignment, seqid, fastqdata, basename, basenameid, dbname)
 
-######################################################
+########################################################
 
-def run_insert(dbx, sql):
-    try:
-        cursorx = dbx.cursor()
-        cursorx.execute(sql)
-        dbx.commit()
-        cursorx.close()
-    except Exception, err:
-        print "mysql pool failed", err
-    return
+def init_bwa_threads(fastqhash, basename, basenameid,dbname):
+    for seqid in fastqhash.keys():
+        fastqdata=fastqhash[seqid]
+        get_aligner_batcher("bwa", dbname).submit(seqid, fastqdata["seq"], queue_alignment_load, load_bwa_alignment, seqid, fastqdata, basename, basenameid, dbname)
 
-#######################################################
-class tel_twodalign_threader(threading.Thread):
-    def __init__(self,basenameid,channel,events,db):
-        threading.Thread.__init__(self)
-        self.basenameid=basenameid
-        self.channel=channel
-        self.events=events
-        self.db=db
-    def run(self):
-        upload_2dalignment_data(self.basenameid,self.channel,self.events,self.db)
+def queue_alignment_load(out, loader, seqid, fastqdata, basename, basenameid, dbname):
+    get_alignment_workers().submit(dbname, basenameid, loader, out, seqid, fastqdata, basename, basenameid, dbname)
 
-#######################################################
-class tel_template_comp_threader(threading.Thread):
-    def __init__(self,basenameid,tablechannel,events,db):
-        threading.Thread.__init__(self)
-        self.basenameid=basenameid
-        self.tablechannel=tablechannel
-        self.events=events
-        self.db=db
-    def run(self):
-        upload_telem_data(self.basenameid,self.tablechannel,self.events,self.db)
+########################################################
+## Alignment threads that stay up for the whole run, loading the results of
+## the aligner batches into the alignment sink. A job that fails is reported
+## to read_tracker, one that succeeds is done once the sink has written it.
+
+class alignment_workers():
+    def __init__(self, threads, queuesize):
+        self.jobs=Queue.Queue(max(queuesize, 1)) # submit waits while it's full, so queued fastq can't pile up
+        for i in xrange(max(threads, 1)):
+            t=threading.Thread(target=self.worker)
+            t.daemon=True
+            t.start()
 
-#######################################################
-def init_tel_threads2(connections, tel_data):
-    backgrounds=[]
-    d=0
-    for read_type in tel_data.keys():
-        #if (args.verbose is True):
-        #    print "using TEL pool thread", d
-        db=connections[d]
-        #print "connection: %d, %s"%(d, db)
-        if (read_type is "basecalled_2d"):
-            background=tel_twodalign_threader(tel_data[read_type][0],tel_data[read_type][1],tel_data[read_type][2],db)
-        if (read_type is "basecalled_template"):
-            background=tel_template_comp_threader(tel_data[read_type][0],tel_data[read_type][1],tel_data[read_type][2],db)
-        if (read_type is "basecalled_complement"):
-            background=tel_template_comp_threader(tel_data[read_type][0],tel_data[read_type][1],tel_data[read_type][2],db)
-        background.start()
-        backgrounds.append(background)
-        d+=1
-    for background in backgrounds:
-        background.join()
+    def submit(self, dbname, basenameid, func, *funcargs):
+        self.jobs.put((dbname, basenameid, func, funcargs)) # blocks while the queue is full
 
+    def worker(self):
+        while True:
+            dbname, basenameid, func, funcargs = self.jobs.get()
+            try:
+                func(*funcargs)
+            except Exception, err:
+                print >>sys.stderr, "Error aligning basename_id %s in %s: %s" % (basenameid, dbname, err)
+                read_tracker.done(dbname, basenameid, False)
+            finally:
+                self.jobs.task_done()
 
-#######################################################
-def init_tel_threads(connections, sqls):
-    backgrounds = []
-    for d in xrange(0, len(sqls)):
-        #if (args.verbose is True):
-        #    print "using pool thread", d
-        db=connections[d]
-        sql=sqls[d]
-        #print "connection: %d, %s"%(d, db)
-        background = tel_threader(db, sql)
-        background.start()
-        backgrounds.append(background)
-
-    for background in backgrounds:
-        background.join()
+    def drain(self):
+        self.jobs.join()
 
-########################################################
+def drain_alignment_workers():
+    if (alignment_pool is not None):
+        alignment_pool.drain()
 
-def init_last_threads(connections, fastqhash, basename, basenameid,dbname):
-    backgrounds=[]
-    d=0
-    for seqid in fastqhash.keys():
-        db=connections[d]
-        fastqdata=fastqhash[seqid]
-        background = last_threader(seqid, fastqdata, basename, basenameid, dbname, db)
-        background.start()
-        backgrounds.append(background)
-        d+=1
-    for background in backgrounds:
-        background.join()
+def get_alignment_workers():
+    global alignment_pool
+    with alignment_pool_lock:
+        if (alignment_pool is None):
+            alignment_pool=alignment_workers(args.align_workers, args.stage_queue)
+        return alignment_pool
 
 ########################################################
-
-def init_bwa_threads(connections, fastqhash, basename, basenameid,dbname):
-    backgrounds = []
-    d=0
-    for seqid in fastqhash.keys():
-        db=connections[d]
-        fastqdata=fastqhash[seqid]
-        background = bwa_threader(seqid, fastqdata, basename, basenameid, dbname, db)
-        background.start()
-        backgrounds.append(background)
-        d+=1
-    for background in backgrounds:
-        background.join()
+## Alignment results of a run database. The loaders hand each read's results
+## over here instead of writing them: the read types to flag as aligned and
+## the MAF/SAM and 5'/3' rows per table. After --align-flush-reads reads or
+## --align-flush-interval seconds everything collected is written on one pool
+## connection, as one UPDATE ... WHERE basename_id IN (...) per read type and
+## multi-row INSERTs per table, and committed together.
+
+class alignment_sink():
+    def __init__(self, dbname):
+        self.dbname=dbname
+        self.lock=threading.Lock()
+        self.reset()
+        t=threading.Thread(target=self.timer)
+        t.daemon=True
+        t.start()
+
+    def reset(self):
+        ## called with self.lock held
+        self.flags=dict() # read type: basename_ids to set align='1' for
+        self.rows=dict() # insert_statement: (row, rowlen) list
+        self.parts=list() # basename_id of each add, done in read_tracker once written
+        self.reads=0
+        self.started=0
+
+    def add(self, basenameid, readtypes, table_rows):
+        with self.lock:
+            if (self.reads == 0):
+                self.started=time.time()
+            for readtype in readtypes:
+                self.flags.setdefault(readtype, set()).add(basenameid)
+            for (tablename, cols), rows in table_rows.iteritems():
+                statement=get_insert_statement(tablename, cols)
+                for row in rows:
+                    row=tuple([sql_param(val) for val in row])
+                    self.rows.setdefault(statement, list()).append((row, statement_row_length(row)))
+            self.parts.append(basenameid)
+            self.reads+=1
+            due=(self.reads >= args.align_flush_reads)
+        if (due is True):
+            self.flush()
+
+    def timer(self):
+        while True:
+            time.sleep(0.5)
+            with self.lock:
+                due=(0 < self.reads and args.align_flush_secs <= (time.time()-self.started) )
+            if (due is True):
+                self.flush()
+
+    def flush(self):
+        with self.lock:
+            if (self.reads == 0):
+                return
+            flags=self.flags
+            rows=self.rows
+            parts=self.parts
+            reads=self.reads
+            self.reset()
+        ok=False
+        failed=set()
+        try:
+            failed=connection_pool[self.dbname].run(self.write, flags, rows)
+            ok=True
+        except Exception, err:
+            err_string="%s:\tError writing the alignments of %d reads: %s" % (time.strftime('%Y-%m-%d %H:%M:%S'), reads, err)
+            print >>sys.stderr, err_string
+            if (self.dbname in dbcheckhash["logfile"]):
+                with open(dbcheckhash["logfile"][self.dbname],"a") as logfilehandle:
+                    logfilehandle.write(err_string+os.linesep)
+                    logfilehandle.close()
+        for basenameid in parts:
+            read_tracker.done(self.dbname, basenameid, (ok is True and basenameid not in failed) )
+
+    def write(self, flags, rows, db):
+        cursor=db.cursor()
+        for readtype, basenameids in flags.iteritems():
+            basenameids=sorted(basenameids)
+            for i in xrange(0, len(basenameids), 1000):
+                ids=basenameids[i:i+1000]
+                sql = "UPDATE "+self.dbname+"."+readtype+" SET align='1' WHERE basename_id IN ("+','.join(['%s']*len(ids))+")" # ML
+                cursor.execute(sql, ids)
+        failed=set()
+        for statement, statement_rows in rows.iteritems():
+            failed.update(failed_reads(statement, insert_row_chunks(cursor, statement, statement_rows, self.dbname, statement.tablename)))
+        return failed
+
+def get_alignment_sink(dbname):
+    with alignment_sinks_lock:
+        if (dbname not in alignment_sinks):
+            alignment_sinks[dbname]=alignment_sink(dbname)
+        return alignment_sinks[dbname]
+
+def flush_alignment_sinks():
+    with alignment_sinks_lock:
+        sinks=alignment_sinks.values()
+    for sink in sinks:
+        sink.flush()
 
 #####################################################
 
 def upload_2dalignment_data(basenameid, channel, alignment,db):
     cursor=db.cursor()
-    sqlarray=list()
-    for i in alignment:
-        val_str = "(%d,%d,%d,'%s')" % (basenameid, i[0],i[1],i[2])
-        sqlarray.append(val_str)
-    stringvals=','.join(sqlarray)
-    sql = 'INSERT INTO caller_basecalled_2d_alignment_%s (basename_id,template,complement,kmer) VALUES %s;' % (channel, stringvals)
-    #print sql
-    cursor.execute(sql)
-    db.commit()
-    #return sql
+    names=alignment.dtype.names
+    columns=[constant_column(basenameid, len(alignment)), alignment[names[0]], alignment[names[1]], alignment[names[2]]]
+    load_columns(cursor, 'caller_basecalled_2d_alignment_%s' % (channel), ('basename_id','template','complement','kmer'), columns)
 
 #####################################################
 
 def upload_telem_data(basenameid,readtype,events, db):
     cursor=db.cursor()
-    ###Going to be my worker thread function """
-    sqlarray=list()
-    #print "EVENTS LEN", len(events[0])
-    if (len(events[0]) == 14):
-        for i in events:
-            val_str = "(%d,%f,%f,%f,%f,'%s',%f,%d,%f,'%s',%f,%f,%f,%f,%f, 0)" % (basenameid, i[0],i[1],i[2],i[3],i[4],i[5],i[6],i[7],i[8],i[9],i[10],i[11],i[12],i[13])
-            sqlarray.append(val_str)
+    names=events.dtype.names
+    if (len(names) == 14):
+        fields=names[0:14]
+        raw_index=constant_column(0, len(events))
+    elif ("weights" in names):
+        fields=names[0:7]+names[8:15]
+        raw_index=constant_column(0, len(events))
     else:
-        #print "LEN", len(events[0])
-        for i in events:
-                if "weights" in  events.dtype.names:
-                    val_str = "(%d,%f,%f,%f,%f,'%s',%f,%d,%f,'%s',%f,%f,%f,%f,%f,0)" % (basenameid, i[0],i[1],i[2],i[3],i[4],i[5],i[6],i[8],i[9],i[10],i[11],i[12],i[13],i[14])
-                else:
-                    val_str = "(%d,%f,%f,%f,%f,'%s',%f,%d,%f,'%s',%f,%f,%f,%f,%f,%d)" % (basenameid, i[0],i[1],i[2],i[3],i[4],i[5],i[6],i[7],i[8],i[9],i[10],i[11],i[12],i[13],i[14])
-                sqlarray.append(val_str)
+        fields=names[0:14]
+        raw_index=events[names[14]]
+    columns=[constant_column(basenameid, len(events))]+[events[name] for name in fields]+[raw_index]
+    load_columns(cursor, 'caller_%s' % (readtype), ('basename_id','mean','start','stdv','length','model_state','model_level','move','p_model_state','mp_state','p_mp_state','p_A','p_C','p_G','p_T','raw_index'), columns)
 
-    stringvals=','.join(sqlarray)
-    #print "processed telem",  (time.time())-starttime
-    sql = 'INSERT INTO caller_%s (basename_id,mean,start,stdv,length,model_state,model_level,move,p_model_state,mp_state,p_mp_state,p_A,p_C,p_G,p_T,raw_index) VALUES %s;' % (readtype, stringvals)
-    cursor.execute(sql)
-    db.commit()
+#####################################################
+def upload_model_data(tablename, model_name, table, cursor):
+    names=table.dtype.names
+    columns=[constant_column(model_name, len(table))]+[table[name] for name in names]
+    if (len(names) == 6): # no variant column
+        columns.insert(2, constant_column(0, len(table)))
+    load_columns(cursor, tablename, ('model','kmer','variant','level_mean','level_stdv','sd_mean','sd_stdv','weight'), columns)
+    commit_rows()
+
+#####################################################
+## --telemetry-blob: a read's events (or 2D alignment) go into telemetry_blobs
+## as one row holding the structured array's bytes, compressed, together with
+## its numpy dtype and the caller_ table the rows would otherwise be in.
+## The format, for anything reading the events back:
+##   data   - the bytes of the C-ordered structured array, compressed with
+##            zlib or as an lz4 frame, as codec says
+##   dtype  - repr() of numpy.lib.format.dtype_to_descr(array.dtype)
+##   row_count - the number of events (or 2D alignment rows)
+## mT_server/nefario/mT_telemetry.py has decode_telemetry_blob and
+## fetch_telemetry to read them back.
+
+telemetry_blob_cols=('basename_id','readtype','caller_table','row_count','dtype','codec','data')
+
+def upload_telem_blob(basenameid, readtype, table, data, db):
+    if (data.dtype.hasobject):
+        ## raised so the telemetry sink counts the read as failed rather than journaling it without its events
+        raise ValueError("can't store the %s telemetry as a blob, it has variable length fields" % (readtype))
+    if (readtype == "basecalled_2d"):
+        caller_table='caller_basecalled_2d_alignment_%s' % (table)
+    else:
+        caller_table='caller_%s' % (table)
+    dtype, blob = encode_telemetry_blob(data, args.tel_codec)
+    cursor=db.cursor()
+    get_insert_statement('telemetry_blobs', telemetry_blob_cols).execute(cursor, (basenameid, readtype, caller_table, len(data), dtype, args.tel_codec, blob))
+
+def encode_telemetry_blob(data, codec):
+    raw=numpy.ascontiguousarray(data).tostring()
+    if (codec == "lz4"):
+        blob=lz4frame.compress(raw)
+    else:
+        blob=zlib.compress(raw, 6)
+    return repr(numpy.lib.format.dtype_to_descr(data.dtype)), blob
+
+#####################################################
+## Telemetry and model tables are encoded a column at a time with numpy
+## instead of formatting every event in Python: each column becomes text and
+## the columns are joined with tabs, one line per row. The lines are sent with
+## LOAD DATA LOCAL INFILE in chunks of at most half of max_allowed_packet. If
+## the server or client doesn't allow LOCAL INFILE the chunks are written as
+## multi-row INSERTs instead.
+
+def constant_column(value, rows):
+    return numpy.repeat(numpy.array([str(value)]), rows)
+
+def encode_columns(columns):
+    text=None
+    for column in columns:
+        column=numpy.asarray(column)
+        if (column.dtype.kind != 'S'):
+            column=column.astype('S')
+        if (text is None):
+            text=column
+        else:
+            text=numpy.char.add(numpy.char.add(text, '\t'), column)
+    return text
+
+def packet_limit(cursor):
+    global max_packet
+    if (max_packet is None):
+        cursor.execute("SELECT @@max_allowed_packet")
+        max_packet=int(cursor.fetchone()[0])
+    return max_packet/2
+
+def load_columns(cursor, tablename, cols, columns):
+    text=encode_columns(columns)
+    if (text is None or len(text) == 0):
+        return
+    lengths=numpy.char.str_len(text)+1
+    ends=numpy.cumsum(lengths)
+    limit=packet_limit(cursor)
+    start=0
+    while (start < len(text)):
+        stop=int(numpy.searchsorted(ends, ends[start]-lengths[start]+limit, 'right'))
+        stop=max(stop, start+1)
+        load_lines(cursor, tablename, cols, text[start:stop].tolist())
+        start=stop
+
+def load_lines(cursor, tablename, cols, lines):
+    global load_data_local
+    if (load_data_local is True):
+        handle, path = tempfile.mkstemp(prefix='minup_', suffix='.tsv')
+        try:
+            with os.fdopen(handle, 'wb') as chunkfile:
+                chunkfile.write('\n'.join(lines)+'\n')
+            sql = "LOAD DATA LOCAL INFILE %%s INTO TABLE %s FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n' (%s)" % (tablename, ','.join(cols))
+            cursor.execute(sql, (path.replace('\\', '/'),))
+            return
+        except MySQLdb.Error, err:
+            if (err.args[0] not in (1148, 2068, 3948)): # not allowed / rejected by the client / disabled on the server
+                raise
+            load_data_local=False
+            print >>sys.stderr, "LOAD DATA LOCAL INFILE isn't allowed, writing telemetry with INSERTs: %s" % (err)
+        finally:
+            os.remove(path)
+    statement=get_insert_statement(tablename, cols)
+    rows=[tuple(line.split('\t')) for line in lines]
+    insert_row_chunks(cursor, statement, [(row, statement_row_length(row)) for row in rows], None, tablename)
 
 #####################################################
-def upload_model_data(tablename, model_name, model_location, hdf, cursor):
-    table = hdf[model_location][()]
-    sqlarray=list()
-    for r in table:
-        i=list(r)
-        if ( len(i) == 6):
-            i.insert(1, 0)
-        eventdeats = "('"+str(model_name)+"'"
-        for j in i:
-            if isinstance(j, (int, long, float, complex)):
-                eventdeats+= ","+str(j)
-            else:
-                eventdeats+= ",'"+str(j)+"'"
-        eventdeats+=")"
-        sqlarray.append(eventdeats)
-    stringvals=','.join(sqlarray)
-    sql = 'INSERT INTO %s (model,kmer,variant,level_mean,level_stdv,sd_mean,sd_stdv,weight) VALUES %s;' % (tablename, stringvals)
-    #print sql
-    cursor.execute(sql)
-    db.commit()
 
-#####################################################
+def run_last_batch(seqs, dbname):
+    wait_for_reference_index(dbname)
+    options="-"+(args.last_options.replace(","," -"))
+    cmd=str()
+    if (oper is "linux"):
+        cmd='lastal %s  %s -' % (options, ref_fasta_hash[dbname]["last_index"])
+    if (oper is "windows"):
+        cmd='lastal %s  %s ' % (options, ref_fasta_hash[dbname]["last_index"])
 
-def do_last_align(qname, fastqhash, basename, basenameid, dbname, db):
-    cursor=db.cursor()
+    read="\n".join([">%s \r\n%s" % (qname,seq) for qname, seq in seqs])
+    #print cmd
+    return parse_maf(stream_aligner(cmd, read))
+
+def load_last_alignment(records, qname, fastqhash, basename, basenameid, dbname):
     #def do_bwa_align(seqid, fastqhash, basename, basenameid, dbname, cursor):
     #Op BAM Description
     #M 0 alignment match (can be a sequence match or mismatch)
@@ -1373,447 +2366,955 @@ def do_last_align(qname, fastqhash, basename, basenameid, dbname, db):
     #proc = subprocess.Popen(cmd, shell=True)
     #status = proc.wait()
 
-    options="-"+(args.last_options.replace(","," -"))
-    cmd=str()
-    if (oper is "linux"):
-        cmd='lastal %s  %s -' % (options, ref_fasta_hash[dbname]["last_index"])
-    if (oper is "windows"):
-        cmd='lastal %s  %s ' % (options, ref_fasta_hash[dbname]["last_index"])
-
-    read=">%s \r\n%s" % (qname,fastqhash["seq"])
-    #print cmd
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,stderr=subprocess.PIPE,stdin=subprocess.PIPE, shell=True)
-    out, err = proc.communicate(input=read)
-    #print err
-    status = proc.wait()
-    maf=out.encode('utf-8')
-    lines=maf.splitlines()
-
     count_read_align_record=dict()
     count_read_aligned_bases=dict()
 
-    colstring='basename_id,refid,alignnum,covcount,alignstrand,score,seqpos,refpos,seqbase,refbase,seqbasequal,cigarclass'
-    colstring_maf='basename_id,refid,alignnum,alignstrand,score,r_start,q_start,r_align_len,q_align_len,r_align_string,q_align_string'
+    prime_cols=('basename_id','refid','alignnum','covcount','alignstrand','score','seqpos','refpos','seqbase','refbase','seqbasequal','cigarclass')
+    maf_cols=('basename_id','refid','alignnum','alignstrand','score','r_start','q_start','r_align_len','q_align_len','r_align_string','q_align_string')
+    maf_rows=dict()
+    aligned=set()
 
     alignedreadids=dict()
     primes=dict()
-    #with open(basename+".temp.maf", "r") as lastfile:
-    #lines=lastfile.readlines()
     count_read_align_record=0
-    #lines=out.splitlines()
-    line_number=0
-    #print "lines", len(lines)
-    while (line_number < len(lines)-2):
-        #print lines[line_number]
-        #print ">>>", len(lines[line_number]), "<<<"
-        if (0<len(lines[line_number]) and lines[line_number][0] is "a" and lines[line_number+1][0] is "s" and lines[line_number+2][0] is "s"):
-            #print "num",line_number, line_number+1, line_number+2
-            #########
-            score=re.split(' |=', lines[line_number])[2]
-            r_list = lines[line_number+1].split()
-            q_list = lines[line_number+2].split()
-            #name start alnSize strand seqSize alignment
-            rname = r_list[1]
-            rstart = int(r_list[2])
-            rlen = int(r_list[3])
-            rend = int(r_list[5])
-            ###########
-            qname = q_list[1]
-            qstart = int(q_list[2])
-            qlen = int(q_list[3])
-            qend = int(q_list[5])
-            ###########
-            raln= list(r_list[6])
-            qaln= list(q_list[6])
-            strand = q_list[4]
-            ###########
+    for record in records:
+        score=record.score
+        #name start alnSize strand seqSize alignment
+        rname = record.rname
+        rstart = record.rstart
+        rlen = record.rlen
+        rend = record.rsize
+        ###########
+        qname = record.qname
+        qstart = record.qstart
+        qlen = record.qlen
+        qend = record.qsize
+        ###########
+        raln= record.raln
+        qaln= record.qaln
+        strand = record.strand
+        ###########
 
-            if (args.verbose is True):
-                align_message="%s\tAligned:%s:%s-%s (%s) " % (qname, rname, rstart, (rstart+rlen), strand)
-                print align_message
-            ####I think this is the point we know a read is aligning.
-            #print dbname,qname.split('.')[-1]
-            sql = "UPDATE "+dbname+"."+qname.split('.')[-1]+" SET align='1' WHERE basename_id=\"%s\" " % (basenameid) # ML
-            cursor.execute(sql)
-            db.commit()
-            #print lines[line_number]
-            #print lines[line_number+1]
-            #print lines[line_number+2]
+        if (args.verbose is True):
+            align_message="%s\tAligned:%s:%s-%s (%s) " % (qname, rname, rstart, (rstart+rlen), strand)
+            print align_message
+        ####I think this is the point we know a read is aligning.
+        aligned.add(qname.split('.')[-1])
+        #print lines[line_number]
+        #print lines[line_number+1]
+        #print lines[line_number+2]
 
-                #########
-            count_read_align_record+=1 # count the read id occurances
             #########
-            readbases=list(fastqhash["seq"])
-            qualscores=fastqhash["quals"]
-            #refbases=ref_fasta_hash["seq_len"][rname]
-            refid=ref_fasta_hash[dbname]["refid"][rname]
-            ###########
-            align_strand=''
-            ###########
-            if (strand is "+"):
-                align_strand="F"
-            ##########
-            if (strand is "-"):
-                align_strand="R"
-
-            ####### do 5' 3' aligned read base position calc. ########
-            tablename = 'last_align_'+qname.rsplit('.', 1)[1]
-            valstring=''
-
-            first_q_align_base_index=int(q_list[2])
-            last_q_align_base_index=(int(q_list[2])+int(q_list[3])-1)
-            first_refbase=raln[0]
-            last_refbase=raln[(len(raln))-1]
-            first_refbase_index = rstart+1
-            last_refbase_index = (rstart+rlen)
-
-            if (strand is "-"):
-                last_q_align_base_index=(int(q_list[5])-int(q_list[2]))-1
-                first_q_align_base_index=( int(q_list[5])-int(q_list[2])-int(q_list[3]))
-                first_refbase=raln[(len(raln))-1]
-                last_refbase=raln[0]
-                first_refbase_index = (rstart+rlen)
-                last_refbase_index = rstart+1
-
-            if (tablename in primes):
-                if ( (first_q_align_base_index+1) <primes[tablename]['fiveprime']['seqpos'] ): # lowest seqpos
-                    primes[tablename]['fiveprime']['seqpos']=(first_q_align_base_index+1)
-                    valstring="("
-                    valstring+= "%s," % (basenameid) # basename_id
-                    valstring+= "%s," % (refid) # refid
-                    valstring+= "%s," % count_read_align_record # alignnum
-                    valstring+= "%s," % '0' # covcount
-                    #valstring+= "%s," % count_read_aligned_bases[(qname,rname,rstart)] # covcount
-                    valstring+= "\'%s\'," % (align_strand) # alignstrand
-                    valstring+= "%s," % score # score
-                    valstring+= "%s," % (first_q_align_base_index+1) # seqpos
-                    valstring+= "%s," % (first_refbase_index) # refpos
-                    valstring+= "\'%s\'," % (readbases[first_q_align_base_index]) # seqbase
-                    valstring+= "\'%s\'," % (first_refbase) # refbase
-                    valstring+= "%s," % qualscores[first_q_align_base_index] # seqbasequal
-                    valstring+= "%s" % ('7') # cigarclass
-                    valstring+=")"
-                    primes[tablename]['fiveprime']['string']=valstring
-
-                if (primes[tablename]['threeprime']['seqpos'] < (last_q_align_base_index+1) ): # lowest seqpos
-                    primes[tablename]['threeprime']['seqpos']=(last_q_align_base_index+1)
-                    valstring="("
-                    valstring+= "%s," % (basenameid) # basename_id
-                    valstring+= "%s," % (refid) # refid
-                    valstring+= "%s," % count_read_align_record # alignnum
-                    valstring+= "%s," % '0' # covcount
-                    #valstring+= "%s," % count_read_aligned_bases[(qname,rname,rstart)] # covcount
-                    valstring+= "\'%s\'," % (align_strand) # alignstrand
-                    valstring+= "%s," % score # score
-                    valstring+= "%s," % (last_q_align_base_index+1) # seqpos
-                    valstring+= "%s," % (last_refbase_index) # refpos
-                    #print (qstart+qlen), len(readbases)
-                    valstring+= "\'%s\'," % (readbases[last_q_align_base_index]) # seqbase
-                    valstring+= "\'%s\'," % (last_refbase) # refbase
-                    valstring+= "%s," % qualscores[last_q_align_base_index] # seqbasequal
-                    valstring+= "%s" % ('7') # cigarclass
-                    valstring+=")"
-                    primes[tablename]['threeprime']['string']=valstring
-
-
-            if (tablename not in primes):
-                primes[tablename]=dict()
-                primes[tablename]['fiveprime']=dict()
+        count_read_align_record+=1 # count the read id occurances
+        #########
+        readbases=list(fastqhash["seq"])
+        qualscores=fastqhash["quals"]
+        #refbases=ref_fasta_hash["seq_len"][rname]
+        refid=ref_fasta_hash[dbname]["refid"][rname]
+        ###########
+        align_strand=''
+        ###########
+        if (strand is "+"):
+            align_strand="F"
+        ##########
+        if (strand is "-"):
+            align_strand="R"
+
+        ####### do 5' 3' aligned read base position calc. ########
+        tablename = 'last_align_'+qname.rsplit('.', 1)[1]
+        valstring=''
+
+        first_q_align_base_index=qstart
+        last_q_align_base_index=(qstart+qlen-1)
+        first_refbase=raln[0]
+        last_refbase=raln[(len(raln))-1]
+        first_refbase_index = rstart+1
+        last_refbase_index = (rstart+rlen)
+
+        if (strand is "-"):
+            last_q_align_base_index=(qend-qstart)-1
+            first_q_align_base_index=( qend-qstart-qlen)
+            first_refbase=raln[(len(raln))-1]
+            last_refbase=raln[0]
+            first_refbase_index = (rstart+rlen)
+            last_refbase_index = rstart+1
+
+        ## 5' and 3' rows: basename_id, refid, alignnum, covcount, alignstrand, score, seqpos, refpos, seqbase, refbase, seqbasequal, cigarclass
+        if (tablename in primes):
+            if ( (first_q_align_base_index+1) <primes[tablename]['fiveprime']['seqpos'] ): # lowest seqpos
                 primes[tablename]['fiveprime']['seqpos']=(first_q_align_base_index+1)
-                valstring="("
-                valstring+= "%s," % (basenameid) # basename_id
-                valstring+= "%s," % (refid) # refid
-                valstring+= "%s," % count_read_align_record # alignnum
-                valstring+= "%s," % '0' # covcount
-                #valstring+= "%s," % count_read_aligned_bases[(qname,rname,rstart)] # covcount
-                valstring+= "\'%s\'," % (align_strand) # alignstrand
-                valstring+= "%s," % score # score
-                valstring+= "%s," % (first_q_align_base_index+1) # seqpos
-                valstring+= "%s," % (first_refbase_index) # refpos
-                valstring+= "\'%s\'," % (readbases[first_q_align_base_index]) # seqbase
-                valstring+= "\'%s\'," % (first_refbase) # refbase
-                valstring+= "%s," % qualscores[first_q_align_base_index] # seqbasequal
-                valstring+= "%s" % ('7') # cigarclass
-                valstring+=")"
-                primes[tablename]['fiveprime']['string']=valstring
-                primes[tablename]['threeprime']=dict()
+                primes[tablename]['fiveprime']['row']=(basenameid, refid, count_read_align_record, 0, align_strand, score, first_q_align_base_index+1, first_refbase_index, readbases[first_q_align_base_index], first_refbase, qualscores[first_q_align_base_index], 7)
+
+            if (primes[tablename]['threeprime']['seqpos'] < (last_q_align_base_index+1) ): # lowest seqpos
                 primes[tablename]['threeprime']['seqpos']=(last_q_align_base_index+1)
-                valstring="("
-                valstring+= "%s," % (basenameid) # basename_id
-                valstring+= "%s," % (refid) # refid
-                valstring+= "%s," % count_read_align_record # alignnum
-                valstring+= "%s," % '0' # covcount
-                #valstring+= "%s," % count_read_aligned_bases[(qname,rname,rstart)] # covcount
-                valstring+= "\'%s\'," % (align_strand) # alignstrand
-                valstring+= "%s," % score # score
-                valstring+= "%s," % (last_q_align_base_index+1) # seqpos
-                valstring+= "%s," % (last_refbase_index) # refpos
                 #print (qstart+qlen), len(readbases)
-                #print len(qualscores), qend, "###"
-                valstring+= "\'%s\'," % (readbases[last_q_align_base_index]) # seqbase
-                valstring+= "\'%s\'," % last_refbase # refbase
-                valstring+= "%s," % qualscores[last_q_align_base_index] # seqbasequal
-                valstring+= "%s" % ('7') # cigarclass
-                valstring+=")"
-                primes[tablename]['threeprime']['string']=valstring
-            #############################
-
-            ##### upload MAF ####
-            #if (args.upload_maf is True):
-            valstring = str()
-            valstring+= "%s," % (basenameid) # basename_id
-            valstring+= "%s," % (refid) # refid
-            valstring+= "%s," % count_read_align_record # alignnum
-            valstring+= "\'%s\'," % (align_strand) # alignstrand
-            valstring+= "%s," % score # score
-            valstring+= "%s," % (rstart) # r_start
-            valstring+= "%s," % (qstart) # q_start
-            valstring+= "%s," % (rlen) # r_align_len
-            valstring+= "%s," % (qlen) # q_align_len
-            valstring+= "\'%s\'," % (r_list[6]) # r_align_string
-            valstring+= "\'%s\'" % (q_list[6]) # q_align_string
-            tablename = 'last_align_maf_'+qname.rsplit('.', 1)[1]
-            sql="INSERT INTO %s (%s) VALUES (%s) " % (tablename, colstring_maf, valstring)
-            #print sql
-            cursor.execute(sql)
-            db.commit()
-
-            #####################
-            #print "dbname", dbname
-            #filehandle=dbcheckhash["mafoutdict"][dbname]
-            #filehandle.write(lines[line_number])
-            #filehandle.write(lines[line_number+1])
-            #filehandle.write(lines[line_number+2]+os.linesep)
-            #####################
-        line_number+=1
+                primes[tablename]['threeprime']['row']=(basenameid, refid, count_read_align_record, 0, align_strand, score, last_q_align_base_index+1, last_refbase_index, readbases[last_q_align_base_index], last_refbase, qualscores[last_q_align_base_index], 7)
+
+
+        if (tablename not in primes):
+            primes[tablename]=dict()
+            primes[tablename]['fiveprime']=dict()
+            primes[tablename]['fiveprime']['seqpos']=(first_q_align_base_index+1)
+            primes[tablename]['fiveprime']['row']=(basenameid, refid, count_read_align_record, 0, align_strand, score, first_q_align_base_index+1, first_refbase_index, readbases[first_q_align_base_index], first_refbase, qualscores[first_q_align_base_index], 7)
+            primes[tablename]['threeprime']=dict()
+            primes[tablename]['threeprime']['seqpos']=(last_q_align_base_index+1)
+            #print len(qualscores), qend, "###"
+            primes[tablename]['threeprime']['row']=(basenameid, refid, count_read_align_record, 0, align_strand, score, last_q_align_base_index+1, last_refbase_index, readbases[last_q_align_base_index], last_refbase, qualscores[last_q_align_base_index], 7)
+        #############################
+
+        ##### upload MAF ####
+        #if (args.upload_maf is True):
+        tablename = 'last_align_maf_'+qname.rsplit('.', 1)[1]
+        maf_rows.setdefault(tablename, list()).append((basenameid, refid, count_read_align_record, align_strand, score, rstart, qstart, rlen, qlen, raln, qaln))
+
+        #####################
+        #print "dbname", dbname
+        #filehandle=dbcheckhash["mafoutdict"][dbname]
+        #filehandle.write(lines[line_number])
+        #filehandle.write(lines[line_number+1])
+        #filehandle.write(lines[line_number+2]+os.linesep)
+        #####################
+
+    ##### MAF and 5' 3' prime ends go to the alignment sink ####
+    table_rows=dict()
+    for tablename, rows in maf_rows.iteritems():
+        table_rows[(tablename, maf_cols)]=rows
 
-    ##### upload 5' 3' prime ends ####
     for tablename in primes:
         fiveprimetable = tablename+"_5prime"
         threeprimetable = tablename+"_3prime"
-
-        string = primes[tablename]['fiveprime']['string']
-        sql="INSERT INTO %s (%s) VALUES %s" % (fiveprimetable, colstring, string)
-        #print "L", sql
-        cursor.execute(sql)
-        db.commit()
-
-        string = primes[tablename]['threeprime']['string']
-        sql="INSERT INTO %s (%s) VALUES %s" % (threeprimetable, colstring, string)
-        #print "L", sql
-        cursor.execute(sql)
-        db.commit()
+        table_rows[(fiveprimetable, prime_cols)]=[primes[tablename]['fiveprime']['row']]
+        table_rows[(threeprimetable, prime_cols)]=[primes[tablename]['threeprime']['row']]
+    get_alignment_sink(dbname).add(basenameid, aligned, table_rows)
     ###########
     #os.remove(basename+".temp.maf")
     #print "finished alignment", (time.time())-starttime
 
 ###########################################################
-def file_dict_of_folder(path):
-
-    file_list_dict=dict()
-    ref_list_dict=dict()
-
-    global xml_file_dict
-    xml_file_dict=dict()
-
-    if os.path.isdir(path):
-        print "caching existing fast5 files in: %s" % (path)
-        for path, dirs, files in os.walk(path) :
-            for f in files:
-                if ("downloads" in path ):
-                    if ("muxscan" not in f and f.endswith(".fast5") ):
-                        file_list_dict[os.path.join(path, f)]=os.stat(os.path.join(path, f)).st_mtime
-
-                    if (args.batch_fasta is True):
-                        if ("reference" in path):
-                            if ( f.endswith(".fa") or f.endswith(".fasta") or f.endswith(".fna") ):
-                                ref_path=path
-                                while  ("downloads" not in os.path.split(ref_path)[1]):
-                                    ref_path=os.path.split(ref_path)[0]
-                                if (ref_path not in ref_list_dict):
-                                    ref_list_dict[ref_path]=list()
-                                ref_list_dict[ref_path].append(os.path.join(path, f))
-
-                    if ( "XML" in path ):
-                        if ( f.endswith(".xml") ):
-                            xml_path=path
-                            while  ("downloads" not in os.path.split(xml_path)[1]):
-                                #print xml_path, os.path.split(xml_path), len (os.path.split(xml_path))
-                                xml_path=os.path.split(xml_path)[0]
-                                #print "FINAL", xml_path
-                            try:
-                                xmlraw=open((os.path.join(path, f)), 'r').read()
-                                xmldict = xmltodict.parse(xmlraw)
-                                if (xml_path not in xml_file_dict):
-                                    xml_file_dict[xml_path]=dict()
-                                    xml_file_dict[xml_path]["study"]=dict()
-                                    xml_file_dict[xml_path]["experiment"]=dict()
-                                    xml_file_dict[xml_path]["run"]=dict()
-                                    xml_file_dict[xml_path]["sample"]=dict()
-
-                                if ('STUDY_SET' in xmldict):
-                                    #print "STUDY", f
-                                    primary_id=xmldict['STUDY_SET']['STUDY']['IDENTIFIERS']['PRIMARY_ID']
-                                    #print "STUDY_ID", primary_id
-                                    title=xmldict['STUDY_SET']['STUDY']['DESCRIPTOR']['STUDY_TITLE']
-                                    #print "TITLE", title
-                                    abstr=xmldict['STUDY_SET']['STUDY']['DESCRIPTOR']['STUDY_ABSTRACT']
-                                    #print "ABSTRACT", abstr
-                                    if (primary_id not in xml_file_dict[xml_path]["study"]):
-                                        xml_file_dict[xml_path]["study"][primary_id]=dict()
-                                    xml_file_dict[xml_path]["study"][primary_id]["file"]=f
-                                    xml_file_dict[xml_path]["study"][primary_id]["xml"]=xmlraw
-                                    xml_file_dict[xml_path]["study"][primary_id]["title"]=title
-                                    xml_file_dict[xml_path]["study"][primary_id]["abstract"]=abstr
-                                    xml_file_dict[xml_path]["study"][primary_id]["path"]=path
-
-                                if ('EXPERIMENT_SET' in xmldict):
-                                    #print "EXPERIMENT", f
-                                    primary_id=xmldict['EXPERIMENT_SET']['EXPERIMENT']['IDENTIFIERS']['PRIMARY_ID']
-                                    #print "EXP_ID", primary_id
-                                    study_id= xmldict['EXPERIMENT_SET']['EXPERIMENT']['STUDY_REF']['IDENTIFIERS']['PRIMARY_ID']
-                                    #print "STUDY_ID", study_id
-                                    sample_id= xmldict['EXPERIMENT_SET']['EXPERIMENT']['DESIGN']['SAMPLE_DESCRIPTOR']['IDENTIFIERS']['PRIMARY_ID']
-                                    #print "SAMPLE_ID", sample_id
-                                    if (primary_id not in xml_file_dict[xml_path]["experiment"]):
-                                        xml_file_dict[xml_path]["experiment"][primary_id]=dict()
-                                    xml_file_dict[xml_path]["experiment"][primary_id]["file"]=f
-                                    xml_file_dict[xml_path]["experiment"][primary_id]["xml"]=xmlraw
-                                    xml_file_dict[xml_path]["experiment"][primary_id]["sample_id"]=sample_id
-                                    xml_file_dict[xml_path]["experiment"][primary_id]["study_id"]=study_id
-                                    #for a,b in xmldict['EXPERIMENT_SET']['EXPERIMENT'].items():
-                                    #    print a,b
-
-                                if ('SAMPLE_SET' in xmldict):
-                                    #print "SAMPLE_SET", f
-                                    primary_id=xmldict['SAMPLE_SET']['SAMPLE']['IDENTIFIERS']['PRIMARY_ID']
-                                    #print "SAMPLE_ID", primary_id
-                                    if (primary_id not in xml_file_dict[xml_path]["sample"]):
-                                        xml_file_dict[xml_path]["sample"][primary_id]=dict()
-                                    xml_file_dict[xml_path]["sample"][primary_id]["file"]=f
-                                    xml_file_dict[xml_path]["sample"][primary_id]["xml"]=xmlraw
-
-                                if ('RUN_SET' in xmldict):
-                                    #print "RUN", f
-                                    primary_id=xmldict['RUN_SET']['RUN']['IDENTIFIERS']['PRIMARY_ID']
-                                    exp_id=xmldict['RUN_SET']['RUN']['EXPERIMENT_REF']['IDENTIFIERS']['PRIMARY_ID']
-                                    #print "RUN_ID", primary_id
-                                    if (primary_id not in xml_file_dict[xml_path]["run"]):
-                                        xml_file_dict[xml_path]["run"][primary_id]=dict()
-                                    xml_file_dict[xml_path]["run"][primary_id]["xml"]=xmlraw
-                                    xml_file_dict[xml_path]["run"][primary_id]["file"]=f
-                                    xml_file_dict[xml_path]["run"][primary_id]["exp_id"]=exp_id
-
-                            except Exception, err:
-                                err_string="Error with XML file: %s : %s" % (f, err)
-                                print >>sys.stderr, err_string
-                                continue
-
-    print "found %d existing fast5 files to process first." % (len(file_list_dict) )
-    if ( 0<len(xml_file_dict) ):
-        print "found %d XML folders." % (len(xml_file_dict))
-        counts=dict()
-        for xmldir in xml_file_dict.keys():
-            for xmltype in xml_file_dict[xmldir].keys():
-                if xmltype not in counts:
-                    counts[xmltype]=len(xml_file_dict[xmldir][xmltype])
+## The startup scan of the watch-dir. Folders are listed by a pool of threads
+## and every fast5 file found goes straight to the ingest scheduler, so uploads
+## can start while the scan is still running. When the scan reaches a run's
+## downloads folder it reads that folder's XML and reference subfolders first;
+## a new run only waits (scan_metadata) for its own downloads folder.
+
+def scan_directory(path):
+    dirs=list()
+    files=list()
+    if (scandir is not None):
+        for entry in scandir(path):
+            if (entry.is_dir(follow_symlinks=False)):
+                dirs.append(entry.path)
+            else:
+                files.append((entry.name, entry))
+    else:
+        for f in os.listdir(path):
+            filepath=os.path.join(path, f)
+            if (os.path.isdir(filepath) and not os.path.islink(filepath)):
+                dirs.append(filepath)
+            else:
+                files.append((f, None))
+    return dirs, files
+
+def downloads_folder(filepath):
+    path=os.path.dirname(filepath)
+    while ("downloads" not in os.path.split(path)[1]):
+        parent=os.path.dirname(path)
+        if (parent == path):
+            return None
+        path=parent
+    return path
+
+class metadata_readiness():
+    def __init__(self):
+        self.lock=threading.Lock()
+        self.folders=dict() # downloads folder: threading.Event, set once its XML and references are read
+        self.scanned=threading.Event() # the whole watch-dir has been scanned
+
+    def add(self, folder):
+        with self.lock:
+            self.folders[folder]=threading.Event()
+
+    def folder_done(self, folder):
+        with self.lock:
+            self.folders[folder].set()
+
+    def scan_done(self):
+        self.scanned.set()
+
+    def wait(self, filepath, timeout):
+        if (self.scanned.is_set() is True):
+            return True
+        with self.lock:
+            event=self.folders.get(downloads_folder(filepath))
+        if (event is None): # a folder the scan hasn't got to, e.g. one created since it started
+            event=self.scanned
+        return event.wait(timeout)
+
+scan_metadata=metadata_readiness()
+
+class directory_scanner():
+    def __init__(self, scheduler):
+        self.scheduler=scheduler
+        self.queue=Queue.Queue()
+        self.lock=threading.Lock()
+        self.found=0
+        self.xml_files=list()
+        self.ref_list_dict=dict()
+
+    def scan(self, path):
+        self.queue.put(path)
+        threads=list()
+        for i in xrange(max(args.scan_threads, 1)):
+            t = threading.Thread(target=self.worker)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        self.queue.join()
+        for t in threads:
+            self.queue.put(None)
+        for t in threads:
+            t.join()
+
+    def worker(self):
+        while True:
+            path=self.queue.get()
+            if (path is None):
+                break
+            try:
+                self.scan_one(path)
+            except Exception, err:
+                print >>sys.stderr, "Error reading folder: %s : %s" % (path, err)
+            self.queue.task_done()
+
+    def scan_one(self, path):
+        dirs, files = scan_directory(path)
+        if ("downloads" in os.path.split(path)[1]): # a run's downloads folder
+            metadata_dirs=[d for d in dirs if ("XML" in os.path.split(d)[1] or "reference" in os.path.split(d)[1])]
+            dirs=[d for d in dirs if d not in metadata_dirs]
+            scan_metadata.add(path)
+            try:
+                self.scan_metadata_dirs(metadata_dirs)
+            finally:
+                scan_metadata.folder_done(path)
+        for d in dirs:
+            self.queue.put(d)
+        if ("downloads" not in path ):
+            return
+        self.add_files(path, files, self.xml_files, self.ref_list_dict)
+
+    def scan_metadata_dirs(self, dirs):
+        ## read straight away rather than at the end of the scan
+        xml_files=list()
+        ref_list_dict=dict()
+        while (0 < len(dirs)):
+            path=dirs.pop()
+            subdirs, files = scan_directory(path)
+            dirs.extend(subdirs)
+            self.add_files(path, files, xml_files, ref_list_dict)
+        load_scan_metadata(xml_files, ref_list_dict)
+
+    def add_files(self, path, files, xml_files, ref_list_dict):
+        for f, entry in files:
+            if ("muxscan" not in f and f.endswith(".fast5") ):
+                if (entry is not None):
+                    mtime=entry.stat().st_mtime # still a stat call on posix, scandir only has it cached on windows
                 else:
-                    counts[xmltype]+=len(xml_file_dict[xmldir][xmltype])
-        for xmltype in counts:
-            print "found %d %s xml files." % (counts[xmltype], xmltype)
+                    mtime=os.stat(os.path.join(path, f)).st_mtime
+                self.scheduler.add(os.path.join(path, f), mtime)
+                with self.lock:
+                    self.found+=1
+
+            if (args.batch_fasta is True):
+                if ("reference" in path):
+                    if ( f.endswith(".fa") or f.endswith(".fasta") or f.endswith(".fna") ):
+                        ref_path=downloads_folder(os.path.join(path, f))
+                        with self.lock:
+                            if (ref_path not in ref_list_dict):
+                                ref_list_dict[ref_path]=list()
+                            ref_list_dict[ref_path].append(os.path.join(path, f))
+
+            if ( "XML" in path ):
+                if ( f.endswith(".xml") ):
+                    xml_path=downloads_folder(os.path.join(path, f))
+                    with self.lock:
+                        xml_files.append((xml_path, path, f))
+
+###########################################################
+def parse_xml_file(xml_path, path, f):
+    xmlraw=open((os.path.join(path, f)), 'r').read()
+    xmldict = xmltodict.parse(xmlraw)
+    if (xml_path not in xml_file_dict):
+        xml_file_dict[xml_path]=dict()
+        xml_file_dict[xml_path]["study"]=dict()
+        xml_file_dict[xml_path]["experiment"]=dict()
+        xml_file_dict[xml_path]["run"]=dict()
+        xml_file_dict[xml_path]["sample"]=dict()
+
+    if ('STUDY_SET' in xmldict):
+        #print "STUDY", f
+        primary_id=xmldict['STUDY_SET']['STUDY']['IDENTIFIERS']['PRIMARY_ID']
+        #print "STUDY_ID", primary_id
+        title=xmldict['STUDY_SET']['STUDY']['DESCRIPTOR']['STUDY_TITLE']
+        #print "TITLE", title
+        abstr=xmldict['STUDY_SET']['STUDY']['DESCRIPTOR']['STUDY_ABSTRACT']
+        #print "ABSTRACT", abstr
+        if (primary_id not in xml_file_dict[xml_path]["study"]):
+            xml_file_dict[xml_path]["study"][primary_id]=dict()
+        xml_file_dict[xml_path]["study"][primary_id]["file"]=f
+        xml_file_dict[xml_path]["study"][primary_id]["xml"]=xmlraw
+        xml_file_dict[xml_path]["study"][primary_id]["title"]=title
+        xml_file_dict[xml_path]["study"][primary_id]["abstract"]=abstr
+        xml_file_dict[xml_path]["study"][primary_id]["path"]=path
+
+    if ('EXPERIMENT_SET' in xmldict):
+        #print "EXPERIMENT", f
+        primary_id=xmldict['EXPERIMENT_SET']['EXPERIMENT']['IDENTIFIERS']['PRIMARY_ID']
+        #print "EXP_ID", primary_id
+        study_id= xmldict['EXPERIMENT_SET']['EXPERIMENT']['STUDY_REF']['IDENTIFIERS']['PRIMARY_ID']
+        #print "STUDY_ID", study_id
+        sample_id= xmldict['EXPERIMENT_SET']['EXPERIMENT']['DESIGN']['SAMPLE_DESCRIPTOR']['IDENTIFIERS']['PRIMARY_ID']
+        #print "SAMPLE_ID", sample_id
+        if (primary_id not in xml_file_dict[xml_path]["experiment"]):
+            xml_file_dict[xml_path]["experiment"][primary_id]=dict()
+        xml_file_dict[xml_path]["experiment"][primary_id]["file"]=f
+        xml_file_dict[xml_path]["experiment"][primary_id]["xml"]=xmlraw
+        xml_file_dict[xml_path]["experiment"][primary_id]["sample_id"]=sample_id
+        xml_file_dict[xml_path]["experiment"][primary_id]["study_id"]=study_id
+        #for a,b in xmldict['EXPERIMENT_SET']['EXPERIMENT'].items():
+        #    print a,b
+
+    if ('SAMPLE_SET' in xmldict):
+        #print "SAMPLE_SET", f
+        primary_id=xmldict['SAMPLE_SET']['SAMPLE']['IDENTIFIERS']['PRIMARY_ID']
+        #print "SAMPLE_ID", primary_id
+        if (primary_id not in xml_file_dict[xml_path]["sample"]):
+            xml_file_dict[xml_path]["sample"][primary_id]=dict()
+        xml_file_dict[xml_path]["sample"][primary_id]["file"]=f
+        xml_file_dict[xml_path]["sample"][primary_id]["xml"]=xmlraw
+
+    if ('RUN_SET' in xmldict):
+        #print "RUN", f
+        primary_id=xmldict['RUN_SET']['RUN']['IDENTIFIERS']['PRIMARY_ID']
+        exp_id=xmldict['RUN_SET']['RUN']['EXPERIMENT_REF']['IDENTIFIERS']['PRIMARY_ID']
+        #print "RUN_ID", primary_id
+        if (primary_id not in xml_file_dict[xml_path]["run"]):
+            xml_file_dict[xml_path]["run"][primary_id]=dict()
+        xml_file_dict[xml_path]["run"][primary_id]["xml"]=xmlraw
+        xml_file_dict[xml_path]["run"][primary_id]["file"]=f
+        xml_file_dict[xml_path]["run"][primary_id]["exp_id"]=exp_id
+
+###########################################################
+def load_scan_metadata(xml_files, ref_list_dict):
+    for xml_path, xml_dir, f in sorted(xml_files):
+        try:
+            parse_xml_file(xml_path, xml_dir, f)
+        except Exception, err:
+            err_string="Error with XML file: %s : %s" % (f, err)
+            print >>sys.stderr, err_string
+            continue
 
     if ( 0<len(ref_list_dict)  ):
         print "found %d reference fasta folders." % ( len(ref_list_dict) )
-        #print found_ref_note
-        for path in ref_list_dict.keys():
-            files = ",".join(ref_list_dict[path])
-            process_ref_fasta(files)
-
-    #with open(dbcheckhash["logfile"][dbname],"a") as logfilehandle:
-    #    logfilehandle.write(found_fast5_note+os.linesep)
-    #    logfilehandle.close()
+    for ref_path in ref_list_dict.keys():
+        files = ",".join(ref_list_dict[ref_path])
+        process_ref_fasta(files)
 
-    return file_list_dict
+def scan_watch_dir(path, scheduler):
+    try:
+        if os.path.isdir(path):
+            print "caching existing fast5 files in: %s" % (path)
+            scanner=directory_scanner(scheduler)
+            scanner.scan(path)
+            print "found %d existing fast5 files to process first." % (scanner.found)
+
+            ## anything that wasn't in a downloads folder's own XML or reference subfolder
+            load_scan_metadata(scanner.xml_files, scanner.ref_list_dict)
+
+            if ( 0<len(xml_file_dict) ):
+                print "found %d XML folders." % (len(xml_file_dict))
+                counts=dict()
+                for xmldir in xml_file_dict.keys():
+                    for xmltype in xml_file_dict[xmldir].keys():
+                        if xmltype not in counts:
+                            counts[xmltype]=len(xml_file_dict[xmldir][xmltype])
+                        else:
+                            counts[xmltype]+=len(xml_file_dict[xmldir][xmltype])
+                for xmltype in counts:
+                    print "found %d %s xml files." % (counts[xmltype], xmltype)
+    finally:
+        scan_metadata.scan_done()
 
 ##########################################################
+## columns minup needs in Gru.minIONruns that older minoTour installs don't have
+gru_columns=(
+    ('mt_ctrl_flag', 'INT(1) DEFAULT 0'),
+    ('watch_dir', 'TEXT(200)'),
+    ('host_ip', 'TEXT(16)'))
+global gru_checked
+gru_checked=False
+
 def modify_gru(cursor):
+    global gru_checked
+    if (gru_checked is True): # Gru doesn't change under us, so once per process is enough
+        return
 
     #### This bit adds columns to Gru.minIONruns ####
-    ## Add column 'mt_ctrl_flag' to Gru.minIONruns table if it doesn't exist
-    sql ="SELECT * FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_SCHEMA=\"Gru\" AND TABLE_NAME=\"minIONruns\" AND column_name=\"mt_ctrl_flag\" "
+    ## Add any of gru_columns that Gru.minIONruns doesn't have yet, in one ALTER
+    sql ="SELECT column_name FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_SCHEMA=\"Gru\" AND TABLE_NAME=\"minIONruns\" AND column_name IN (%s)" % (','.join('"%s"' % (name) for name, definition in gru_columns))
     #print sql
     cursor.execute(sql)
-    if (cursor.rowcount ==0):
-        #print "adding mt_ctrl_flag to Gru.minIONruns"
-        sql = "ALTER TABLE Gru.minIONruns ADD mt_ctrl_flag INT(1) DEFAULT 0";
+    found=set(row[0].lower() for row in cursor.fetchall())
+    missing=[(name, definition) for name, definition in gru_columns if name.lower() not in found]
+    if (len(missing) > 0):
+        #print "adding", missing, "to Gru.minIONruns"
+        sql = "ALTER TABLE Gru.minIONruns %s" % (', '.join("ADD %s %s" % (name, definition) for name, definition in missing))
         #print sql
         cursor.execute(sql)
         db.commit()
+    gru_checked=True
 
-    ## Add column 'watch_dir' to Gru.minIONruns table if it doesn't exist
-    sql ="SELECT * FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_SCHEMA=\"Gru\" AND TABLE_NAME=\"minIONruns\" AND column_name=\"watch_dir\" "
-    #print sql
-    cursor.execute(sql)
-    if (cursor.rowcount ==0):
-        #print "adding 'watch_dir' to Gru.minIONruns"
-        sql = "ALTER TABLE Gru.minIONruns ADD watch_dir TEXT(200)";
-        #print sql
-        cursor.execute(sql)
-        db.commit()
+###########################################################
+## A new run database is made in one multi-statement round trip. The tables
+## of run_schema_tables are first built in a template database named after
+## run_schema_version and a hash of their DDL, so any change to a create_*
+## function, or a different set of options, gets a template of its own. Run
+## databases are then CREATE TABLE ... LIKE copies of the template's tables.
+## A process builds each template it uses once (IF NOT EXISTS, so another
+## process or an earlier minup having made it is fine) in the same batch as
+## its first run database.
+## The batch goes over a connection of its own, opened with
+## CLIENT.MULTI_STATEMENTS and closed straight after; the long-lived
+## connections keep running one statement per query.
+## The minup_schema_* databases stay on the server for later runs. Ones for
+## old schema versions or option sets are never used again;
+## --drop-schema-templates removes them all, and those still needed are made
+## again.
+
+run_schema_version=1
+global run_templates
+run_templates=set()
+create_table_pattern=re.compile(r'^CREATE TABLE (?:IF NOT EXISTS )?(\w+) ')
+
+def run_schema_tables(dbname):
+    ## (create function, tablename) for every table of a new run database
+    tables=[
+        (create_general_table, 'config_general'),
+        (create_trackingid_table, 'tracking_id'),
+        (create_basecall_summary_info, 'basecall_summary'),
+        (create_events_model_fastq_table, 'basecalled_template'),
+        (create_events_model_fastq_table, 'basecalled_complement'),
+        (create_basecalled2d_fastq_table, 'basecalled_2d')]
+    if (args.telem is True and args.tel_blob is True):
+        tables.append((create_telemetry_blob_table, "telemetry_blobs"))
+    elif (args.telem is True):
+        for i in xrange(0,10):
+            tables.append((create_caller_table_noindex, 'caller_basecalled_template_%d' % (i)))
+            tables.append((create_caller_table_noindex, 'caller_basecalled_complement_%d' % (i)))
+            tables.append((create_2d_alignment_table, 'caller_basecalled_2d_alignment_%d' % (i)))
+    if (args.telem is True):
+        tables.append((create_model_list_table, "model_list"))
+        tables.append((create_model_data_table, "model_data"))
 
-    ## Add column 'host_ip' to Gru.minIONruns table if it doesn't exist
-    sql ="SELECT * FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_SCHEMA=\"Gru\" AND TABLE_NAME=\"minIONruns\" AND column_name=\"host_ip\" "
-    #print sql
+    if (dbname in ref_fasta_hash): # the reference fasta is assigned before the database is made
+        tables.append((create_reference_table, 'reference_seq_info'))
+        for readtype in ('template', 'complement', '2d'):
+            tables.append((create_5_3_prime_align_tables, 'last_align_basecalled_'+readtype))
+        if (args.last_align is True):
+            for readtype in ('template', 'complement', '2d'):
+                tables.append((create_align_table_maf, 'last_align_maf_basecalled_'+readtype))
+        if (args.bwa_align is True):
+            for readtype in ('template', 'complement', '2d'):
+                tables.append((create_align_table_sam, 'align_sam_basecalled_'+readtype))
+        if (args.telem is True):
+            tables.append((create_ref_kmer_table, 'ref_sequence_kmer'))
+    return tables
+
+class schema_recorder():
+    ## stands in for the cursor of the create_* functions and keeps their SQL
+    def __init__(self):
+        self.statements=list()
+
+    def execute(self, sql):
+        self.statements.append(sql)
+
+def run_schema(dbname):
+    ## the template database for dbname's tables, and [(tablename, sql creating it in the template)]
+    recorder=schema_recorder()
+    for create, tablename in run_schema_tables(dbname):
+        create(tablename, recorder)
+    template="minup_schema_%d_%s" % (run_schema_version, hashlib.sha1("\n".join(recorder.statements)).hexdigest()[:12])
+    tables=list()
+    for sql in recorder.statements:
+        tablename=create_table_pattern.match(sql).group(1)
+        tables.append((tablename, create_table_pattern.sub("CREATE TABLE IF NOT EXISTS %s.%s " % (template, tablename), sql)))
+    return template, tables
+
+def execute_batch(statements):
+    ## one round trip for all the statements; an error in any of them is
+    ## raised as its result is read
+    batchdb = MySQLdb.connect(host=args.dbhost, user=args.dbusername, passwd=args.dbpass, port=args.dbport, client_flag=CLIENT.MULTI_STATEMENTS)
+    try:
+        batchcursor=batchdb.cursor()
+        batchcursor.execute(";\n".join(statements))
+        while (batchcursor.nextset() is not None):
+            pass
+    finally:
+        batchdb.close()
+
+def create_run_database(dbname, cursor):
+    ## makes dbname with all its tables and switches to it
+    template, tables = run_schema(dbname)
+    statements=list()
+    if (template not in run_templates):
+        filterwarnings('ignore', "Can't create database '%s'; database exists" % (template))
+        filterwarnings('ignore', "Table '.*' already exists")
+        statements.append("CREATE DATABASE IF NOT EXISTS %s" % (template))
+        statements.extend(sql for tablename, sql in tables)
+    statements.append("CREATE DATABASE %s" % (dbname))
+    statements.extend("CREATE TABLE %s.%s LIKE %s.%s" % (dbname, tablename, template, tablename) for tablename, sql in tables)
+    execute_batch(statements)
+    run_templates.add(template)
+    sql="USE %s" % (dbname)
     cursor.execute(sql)
-    if (cursor.rowcount ==0):
-        #print "adding mt_ctrl_flag to Gru.minIONruns"
-        sql = "ALTER TABLE Gru.minIONruns ADD host_ip TEXT(16)";
-        #print sql
-        cursor.execute(sql)
-        db.commit()
 
-###########################################################
-def chr_convert_array(array):
-    string=str()
-    for val in array:
-        string+=chr(val+33)
-    return db.escape_string(string)
+def drop_schema_templates(cursor):
+    ## --drop-schema-templates
+    cursor.execute("SHOW DATABASES LIKE 'minup\\_schema\\_%'")
+    for row in cursor.fetchall():
+        print "dropping schema template database", row[0]
+        cursor.execute("DROP DATABASE %s" % (row[0]))
 
 ###########################################################
-#def chr_convert_array(array):
-#    string='"'
-#    for val in array:
-#        string+=chr(val+64)
-#    string+='"'
-#    return string
+## the Fastq dataset of a fast5 file holds one four line record. Returns the
+## sequence and quality strings and the phred scores as a uint8 view of the
+## quality string, without going through the characters in python.
+def decode_fastq(fastq):
+    lines=fastq.split('\n', 4)
+    if (len(lines) < 4 or not lines[0].startswith('@') or not lines[2].startswith('+')):
+        raise ValueError("Not a fastq record: %r" % (fastq[:50]))
+    sequence=lines[1].rstrip('\r')
+    qualtext=lines[3].rstrip('\r')
+    if (len(sequence) != len(qualtext)):
+        raise ValueError("Lengths of sequence and quality values differs (%i and %i)." % (len(sequence), len(qualtext)))
+    quals=numpy.frombuffer(qualtext, dtype=numpy.uint8)-33
+    if (len(quals) and quals.max() > 93): # characters below '!' wrap round past 93
+        raise ValueError("Invalid character in quality string")
+    return sequence, qualtext, quals
 
 ###########################################################
-def make_hdf5_object_attr_hash(hdf5object, fields):
+def make_hdf5_object_attr_hash(hdf5object, fields, layout=None, key=None):
+    if (layout is not None):
+        return layout.read_attrs(key, hdf5object, fields)
+    attrs=dict(hdf5object.attrs.items()) # one pass over the attributes
     att_hash=dict()
     for field in fields:
-        if (field in hdf5object.attrs.keys() ):
+        if (field in attrs):
             #print "filed: ",field (args.ref_fasta is not None), hdf5object.attrs[field]
-            att_hash[field]=hdf5object.attrs[field]
+            att_hash[field]=attrs[field]
     return att_hash
 
+###########################################################
+## reads a table dataset (events, 2D alignment) into a buffer that is kept
+## for later reads of the same kind, so long runs don't allocate a new array
+## for every read. The returned view owns its buffer until it is given back
+## with release_dataset after the upload.
+def read_dataset(dataset, key):
+    if (dataset.dtype.hasobject or len(dataset.shape) != 1): # variable length fields can't be read in place
+        return dataset[()]
+    rows=dataset.shape[0]
+    buf=None
+    with dataset_buffers_lock:
+        free=dataset_buffers.setdefault(key, list())
+        for i in xrange(len(free)):
+            if (free[i].dtype == dataset.dtype and rows <= len(free[i])):
+                buf=free.pop(i)
+                break
+        if (buf is None and 0 < len(free) and free[-1].dtype == dataset.dtype): # too small, so replace it with a bigger one
+            rows_wanted=max(rows, int(len(free.pop())*1.5))
+        else:
+            rows_wanted=rows
+    if (buf is None):
+        buf=numpy.empty(rows_wanted, dtype=dataset.dtype)
+    if (rows > 0):
+        dataset.read_direct(buf, dest_sel=numpy.s_[0:rows])
+    return buf[:rows]
+
+def release_dataset(key, data):
+    ## hands the buffer behind data back once its rows have been uploaded
+    buf=data.base
+    if (buf is None or not isinstance(buf, numpy.ndarray)):
+        return
+    with dataset_buffers_lock:
+        free=dataset_buffers.setdefault(key, list())
+        if (len(free) < 8):
+            free.append(buf)
+
+###########################################################
+## the group paths and attribute names of a fast5 file are the same for
+## every read of a run, so they are found on the first file and kept
+## per run. Files whose /Analyses groups differ get a layout of their own.
+class fast5_layout():
+    def __init__(self, hdf):
+        self.basecalldir=''
+        self.basecalldirconfig=''
+        self.barcoding_dir=None
+        self.barcoding_summary=None
+        self.barcode_aligns=None
+        self.attr_names=dict()
+        basecalltype="Basecall_1D_CDNA"
+        basecalltype2="Basecall_2D"
+        for x in range (0,9):
+            string='/Analyses/%s_00%s/Configuration/general' % (basecalltype,x)
+            if (string in hdf):
+                self.basecalldir='/Analyses/%s_00%s/' % (basecalltype,x)
+                self.basecalldirconfig=string
+                break
+            string='/Analyses/%s_00%s/Configuration/general' % (basecalltype2,x)
+            if (string in hdf):
+                self.basecalldir='/Analyses/%s_00%s/' % (basecalltype2,x)
+                self.basecalldirconfig=string
+                break
+        for x in range(0,9):
+            string='/Analyses/Barcoding_00%s' % (x)
+            if (string in hdf):
+                self.barcoding_dir=string
+                self.barcoding_summary=string+'/Summary/barcoding'
+                if (string+'/Barcoding/Aligns' in hdf):
+                    self.barcode_aligns=string+'/Barcoding/Aligns'
+                break
+
+    def read_attrs(self, key, hdf5object, fields):
+        names=self.attr_names.get(key)
+        if (names is not None and len(hdf5object.attrs)==len(names)):
+            try:
+                return dict((field, hdf5object.attrs[field]) for field in fields if field in names)
+            except KeyError:
+                pass # the attributes have changed, so learn them again
+        attrs=dict(hdf5object.attrs.items())
+        self.attr_names[key]=frozenset(attrs.keys())
+        return dict((field, attrs[field]) for field in fields if field in attrs)
+
+def get_fast5_layout(hdf, dbname):
+    signature=tuple(sorted(hdf['/Analyses'].keys()))
+    if (dbname not in fast5_layouts):
+        fast5_layouts[dbname]=dict()
+    if (signature not in fast5_layouts[dbname]):
+        if (args.verbose is True):
+            print "learning fast5 layout for", dbname, signature
+        fast5_layouts[dbname][signature]=fast5_layout(hdf)
+    return fast5_layouts[dbname][signature]
+
+##########################################################
+## INSERT statements with bound parameters. MySQLdb has no server side
+## prepare, so each table's statement is built once for a fixed column order
+## and the driver escapes the values on execute. executemany sends a list of
+## rows as one multi-row INSERT.
+
+class insert_statement():
+    def __init__(self, tablename, cols):
+        self.tablename=tablename
+        self.cols=tuple(cols)
+        self.sql="INSERT INTO %s (%s) VALUES (%s)" % (tablename, ','.join(self.cols), ','.join(['%s']*len(self.cols)))
+
+    def values(self, data_hash):
+        return tuple([sql_param(data_hash[col]) for col in self.cols])
+
+    def execute(self, cursor, row):
+        cursor.execute(self.sql, row)
+
+    def executemany(self, cursor, rows):
+        cursor.executemany(self.sql, rows)
+
+def get_insert_statement(tablename, cols):
+    key=(tablename, tuple(cols))
+    if (key not in insert_statements):
+        insert_statements[key]=insert_statement(tablename, cols)
+    return insert_statements[key]
+
+def sql_param(entry):
+    if isinstance(entry, numpy.generic): # numpy scalars from the hdf5 attributes and arrays
+        return entry.item()
+    return entry
+
 ##########################################################
 def mysql_load_from_hashes(cursor,tablename, data_hash):
-    cols=list()
-    vals=list()
-    for colhead, entry in data_hash.iteritems():
-        if isinstance(entry, basestring):
-            vals.append("'%s'"  % (entry) )
-        else:
-            vals.append(str(entry) )
-    cols=','.join(data_hash.keys() )
-    values=','.join(vals)
-    sql ="INSERT INTO %s (%s) VALUES (%s) " % (tablename, cols, values)
-    #print sql
-    cursor.execute(sql)
-    db.commit()
+    statement=get_insert_statement(tablename, sorted(data_hash.keys()))
+    statement.execute(cursor, statement.values(data_hash))
     ids = cursor.lastrowid
+    commit_rows()
+    return ids
+
+##########################################################
+## Buffered multi-row inserts for the per-read tables (--bulk-insert-rows).
+## Rows are kept in memory per table and written out for all tables together,
+## so a read's rows always land in the same flush.
+
+def bulk_load_from_hashes(cursor, dbname, tablename, data_hash, id_column=None):
+    if (args.bulk_rows <= 1):
+        return mysql_load_from_hashes(cursor, "%s.%s" % (dbname, tablename), data_hash)
+    ids=None
+    if (id_column is not None): # the auto increment id is needed now, so take one from a reserved block
+        if (dbname not in id_allocators):
+            id_allocators[dbname]=id_block_allocator(dbname, tablename, id_column)
+        ids=id_allocators[dbname].next_id()
+        data_hash[id_column]=ids
+    if ((dbname,tablename) not in bulk_writers):
+        bulk_writers[(dbname,tablename)]=bulk_writer(dbname, tablename)
+    bulk_writers[(dbname,tablename)].add(data_hash)
     return ids
 
+##########################################################
+def after_bulk_flush(owner, func, *funcargs):
+    ## owner is the (dbname, basename_id) of the read the hook belongs to
+    if (args.bulk_rows <= 1 and args.txn_reads <= 0):
+        func(*funcargs)
+    else:
+        bulk_flush_hooks.append((owner, func, funcargs))
+
+##########################################################
+def flush_bulk_writers(cursor, force=False):
+    now=time.time()
+    due=force
+    for writer in bulk_writers.itervalues():
+        if (writer.count >= args.bulk_rows or (0 < writer.count and args.bulk_interval <= (now-writer.started) ) ):
+            due=True
+    if (read_txn.due(now) is True):
+        due=True
+    if (due is False or read_txn.active is True):
+        return
+    failed=set()
+    for (dbname, tablename), writer in bulk_writers.iteritems():
+        failed.update([(dbname, basenameid) for basenameid in writer.flush(cursor)])
+    ## a read with a row that couldn't be written is taken back out completely
+    ## before the commit, so it is neither half in the database nor journaled
+    for dbname in set([owner[0] for owner in failed]):
+        try:
+            delete_reads(dbname, [basenameid for name, basenameid in failed if name == dbname], cursor)
+        except Exception, err:
+            print >>sys.stderr, "Error removing the failed reads from %s: %s" % (dbname, err)
+    db.commit()
+    read_txn.committed()
+    hooks=list(bulk_flush_hooks)
+    del bulk_flush_hooks[:]
+    for owner, func, funcargs in hooks:
+        if (owner in failed):
+            continue
+        try:
+            func(*funcargs)
+        except Exception, err:
+            print >>sys.stderr, "Error after writing buffered rows: %s" % (err)
+    for dbname, basenameid in failed: # -res uploads these again
+        read_tracker.done(dbname, basenameid, False)
+
+##########################################################
+def bulk_flush_timer():
+    while True:
+        time.sleep(1)
+        with ingest_lock:
+            try:
+                flush_bulk_writers(cursor)
+            except Exception, err:
+                print >>sys.stderr, "Error writing buffered rows: %s" % (err)
+
+##########################################################
+class bulk_writer():
+    def __init__(self, dbname, tablename):
+        self.dbname=dbname
+        self.tablename=tablename
+        self.rows=dict() # rows are grouped by their column set, one statement per group
+        self.count=0
+        self.started=0
+
+    def add(self, data_hash):
+        statement=get_insert_statement("%s.%s" % (self.dbname, self.tablename), sorted(data_hash.keys()))
+        row=statement.values(data_hash)
+        if (statement not in self.rows):
+            self.rows[statement]=list()
+        self.rows[statement].append((row, statement_row_length(row)))
+        if (self.count == 0):
+            self.started=time.time()
+        self.count+=1
+
+    def mark(self):
+        return (dict((statement, len(rows)) for statement, rows in self.rows.iteritems()), self.count, self.started)
+
+    def truncate(self, mark):
+        lengths, self.count, self.started = mark
+        for statement in self.rows.keys():
+            if (statement in lengths):
+                del self.rows[statement][lengths[statement]:]
+            else:
+                del self.rows[statement]
+
+    def flush(self, cursor):
+        ## returns the basename_ids of the reads that lost a row
+        failed=set()
+        for statement, rows in self.rows.iteritems():
+            failed.update(failed_reads(statement, insert_row_chunks(cursor, statement, rows, self.dbname, self.tablename)))
+        self.rows=dict()
+        self.count=0
+        return failed
+
+##########################################################
+## Writes (row, rowlen) pairs with as few multi-row INSERTs as fit in
+## max_statement_size; a chunk that fails is retried row by row so one bad
+## row only loses itself. The rows that still fail are returned, see
+## failed_reads for the reads they belonged to.
+
+max_statement_size=1000000 # keep each statement well inside max_allowed_packet
+
+def statement_row_length(row):
+    return sum([len(val)+3 if isinstance(val, basestring) else 24 for val in row]) # roughly its size in the statement
+
+def insert_row_chunks(cursor, statement, rows, dbname, tablename):
+    failed=list()
+    chunk=list()
+    chunklen=0
+    for row, rowlen in rows:
+        if (0 < len(chunk) and max_statement_size < (chunklen+rowlen) ):
+            failed.extend(insert_rows(cursor, statement, chunk, dbname, tablename))
+            chunk=list()
+            chunklen=0
+        chunk.append(row)
+        chunklen+=rowlen
+    if (0 < len(chunk)):
+        failed.extend(insert_rows(cursor, statement, chunk, dbname, tablename))
+    return failed
+
+def insert_rows(cursor, statement, chunk, dbname, tablename):
+    try:
+        statement.executemany(cursor, chunk)
+    except Exception, err:
+        if (len(chunk) == 1):
+            err_string="%s:\tError writing row to %s: %s" % (time.strftime('%Y-%m-%d %H:%M:%S'), tablename, err)
+            print >>sys.stderr, err_string
+            if (dbname in dbcheckhash["logfile"]):
+                with open(dbcheckhash["logfile"][dbname],"a") as logfilehandle:
+                    logfilehandle.write(err_string+os.linesep)
+                    logfilehandle.close()
+            return chunk
+        failed=list()
+        for row in chunk:
+            failed.extend(insert_rows(cursor, statement, [row], dbname, tablename))
+        return failed
+    return list()
+
+def failed_reads(statement, rows):
+    if ('basename_id' not in statement.cols):
+        return set()
+    col=statement.cols.index('basename_id')
+    return set([row[col] for row in rows])
+
+##########################################################
+## Transactions per read (--transaction-reads). Each read is written inside a
+## savepoint on the main connection; if it fails the savepoint and the read's
+## buffered rows are thrown away. Reads are committed together by
+## flush_bulk_writers, which then runs the alignments and other hooks.
+
+class read_transaction():
+    def __init__(self):
+        self.active=False
+        self.reads=0
+        self.started=0
+        self.marks=None
+        self.hooks=0
+        self.models=None
+
+    def begin(self, cursor, dbname):
+        if (args.txn_reads <= 0):
+            return
+        cursor.execute("SAVEPOINT minup_read")
+        self.marks=dict((key, writer.mark()) for key, writer in bulk_writers.iteritems())
+        self.hooks=len(bulk_flush_hooks)
+        self.models=set(dbcheckhash["modelcheck"].get(dbname, dict()).keys())
+        self.active=True
+
+    def rollback(self, cursor, dbname):
+        if (self.active is False):
+            return
+        self.active=False
+        try:
+            cursor.execute("ROLLBACK TO SAVEPOINT minup_read")
+        except Exception, err:
+            print >>sys.stderr, "Error rolling back read: %s" % (err)
+        for key, writer in bulk_writers.iteritems():
+            if (key in self.marks):
+                writer.truncate(self.marks[key])
+            else:
+                writer.truncate((dict(), 0, 0))
+        del bulk_flush_hooks[self.hooks:]
+        if (dbname in dbcheckhash["modelcheck"]): # the model rows went with the savepoint
+            for model in dbcheckhash["modelcheck"][dbname].keys():
+                if (model not in self.models):
+                    del dbcheckhash["modelcheck"][dbname][model]
+
+    def release(self, cursor):
+        if (self.active is False):
+            return
+        self.active=False
+        cursor.execute("RELEASE SAVEPOINT minup_read")
+        if (self.reads == 0):
+            self.started=time.time()
+        self.reads+=1
+
+    def due(self, now):
+        return (0 < self.reads and (self.reads >= args.txn_reads or args.bulk_interval <= (now-self.started) ) )
+
+    def committed(self):
+        self.reads=0
+
+def commit_rows():
+    if (read_txn.active is False): # inside a read the rows wait for the group commit
+        db.commit()
+
+read_txn=read_transaction()
+
+##########################################################
+## Hands out auto increment ids (e.g. basename_id) for buffered rows. Blocks of
+## ids are reserved atomically in the id_blocks table on a connection from the
+## run's pool, so several processes can fill the same run database and a
+## connection dropped by the server's wait_timeout is simply replaced.
+
+class id_block_allocator():
+    def __init__(self, dbname, tablename, column):
+        self.dbname=dbname
+        self.tablename=tablename
+        self.blocksize=max(args.bulk_rows, 1)
+        self.next=0
+        self.stop=0
+        connection_pool[dbname].run(self.setup, column)
+
+    def setup(self, column, dbx):
+        cursorx=dbx.cursor()
+        create_id_blocks_table('id_blocks', cursorx)
+        sql="SELECT IFNULL(MAX(%s),0)+1 FROM %s" % (column, self.tablename)
+        cursorx.execute(sql)
+        first=int(cursorx.fetchone()[0])
+        sql="INSERT INTO id_blocks (tablename,next_id) VALUES ('%s',%d) ON DUPLICATE KEY UPDATE next_id=GREATEST(next_id,VALUES(next_id))" % (self.tablename, first)
+        cursorx.execute(sql)
+        cursorx.close()
+
+    def next_id(self):
+        if (self.next >= self.stop):
+            self.reserve()
+        ids=self.next
+        self.next+=1
+        return ids
+
+    def reserve(self):
+        ## a retry after a lost connection may skip a block, but never hands one out twice
+        self.stop=connection_pool[self.dbname].run(self.take_block)
+        self.next=self.stop-self.blocksize
+
+    def take_block(self, dbx):
+        cursorx=dbx.cursor()
+        sql="UPDATE id_blocks SET next_id=LAST_INSERT_ID(next_id+%d) WHERE tablename='%s'" % (self.blocksize, self.tablename)
+        cursorx.execute(sql)
+        cursorx.execute("SELECT LAST_INSERT_ID()")
+        stop=int(cursorx.fetchone()[0])
+        cursorx.close()
+        return stop
+
 ##########################################################
 def process_ref_fasta(ref_fasta):
     print "processing the reference fasta."
@@ -1836,94 +3337,258 @@ def process_ref_fasta(ref_fasta):
         b=os.path.splitext(os.path.basename(files[0]))[0]
         ref_basename="%s_plus_%s_more_seqs" % (os.path.splitext(os.path.basename(files[0]))[0], str(len(files)-1) )
 
-    validated_ref=os.path.join(os.path.sep,valid_ref_dir,ref_basename+"_valid.fasta")
-
-    refdict["big_name"]=validated_ref
     refdict["big_len"]=0
     #refdict["prefix"]=ref_basename
     refdict["path"]=os.path.dirname(files[0])
 
-    if (os.path.isfile(validated_ref) is False or os.stat(validated_ref).st_size==0 ) :
-        valid_fasta_handle = open(validated_ref, "w")
-        for fasta_file in files:
-            print "FASTA file:", fasta_file
-            fasta_records = list(SeqIO.parse(fasta_file, "fasta"))
-            if (len(fasta_records)==0):
-                os.remove(validated_ref)
-                err_string="Error with your reference sequence FASTA file: %s: It's an empty file" % (fasta_file)
-                print >>sys.stderr, err_string
-                sys.exit(1)
-
-            try:
-                for record in fasta_records:
-                    #ref_fasta_hash["seq_file"][record.id]=os.path.splitext(os.path.basename(fasta_file))[0]
-                    if (len(record.seq)==0):
-                        os.remove(validated_ref)
-                        err_string="Error with your reference sequence FASTA file: %s: SEQID %s" % (fasta_file, record.id)
-                        print >>sys.stderr, err_string
-                        sys.exit(1)
-                    else:
-                        seq = record.seq.upper()
-                        record.seq=seq
-                        record.description=os.path.basename(fasta_file)
-                        SeqIO.write([record], valid_fasta_handle, "fasta")
-
-            except Exception, err:
-                os.remove(validated_ref)
-                err_string="Error with your reference sequence FASTA file: %s: %s" % (fasta_file,err)
-                print >>sys.stderr, err_string
-                sys.exit(1)
-        valid_fasta_handle.close()
+    handle, temp_ref = tempfile.mkstemp(prefix=ref_basename+"_", suffix=".fasta.tmp", dir=valid_ref_dir)
+    store=reference_store_writer(temp_ref+".2bit")
+    with os.fdopen(handle, "w") as valid_fasta_handle:
+        refhash=validate_reference_fasta(files, refdict, valid_fasta_handle, store, temp_ref)
+    store.close()
 
-    for record in SeqIO.parse(validated_ref, 'fasta'):
-        if (args.verbose is True):
-            print "processing seq: ", record.id
-
-        refdict["seq_len"][record.id]=len(record.seq)
-        disc=re.split('\s+', record.description)[1]
-        refdict["seq_file"][record.id]=disc
-        refdict["big_len"]+=len(record.seq)
-        #####
-        #refdict["sequence"][record.id]=record.seq
-        #####
-        if ( disc in refdict["seq_file_len"]):
-            refdict["seq_file_len"][disc]+=len(record.seq)
-        else:
-            refdict["seq_file_len"][disc]=len(record.seq)
+    ## the same sequences may already be in the cache from another run or file name
+    validated_ref=os.path.join(valid_ref_dir, refhash+".fasta")
+    if (os.path.isfile(validated_ref) is False or os.stat(validated_ref).st_size==0 ):
+        os.rename(temp_ref, validated_ref)
+    else:
+        os.remove(temp_ref)
+    store_path=os.path.join(valid_ref_dir, refhash+".2bit")
+    if (os.path.isfile(store_path+".json") is False):
+        os.rename(temp_ref+".2bit", store_path) # the index goes last, readers look for it
+        os.rename(temp_ref+".2bit.json", store_path+".json")
+    else:
+        os.remove(temp_ref+".2bit")
+        os.remove(temp_ref+".2bit.json")
+    refdict["reference_store"]=store_path
+    manifest_entry=update_reference_manifest(refhash, [os.path.abspath(f) for f in files], fasta=validated_ref, sequences=len(refdict["seq_len"]), length=refdict["big_len"])
+    if (args.verbose is True):
+        print "reference %s is cached as %s" % (ref_basename, refhash)
+    refdict["big_name"]=ref_basename # what Gru.minIONruns shows as the reference
+    refdict["big_name_path"]=validated_ref
+    refdict["hash"]=refhash
 
-        ### do kmer
-        if (args.telem is True):
-            recomp = record.seq.reverse_complement()
-            km= kmer_count_fasta(record.seq, recomp, 5)
-            refdict["kmer"][record.id]=km
+    if (args.telem is True):
+        refstore=reference_store(store_path)
+        try:
+            refdict["kmer"]=kmer_count_references(refstore, refdict["seq_len"].keys(), 5)
+        finally:
+            refstore.close()
 
+    builds=list()
     if (args.last_align is True):
-        last_index=os.path.join(os.path.sep,last_index_dir,ref_basename+".last.index")
-        last_index_file_part=os.path.join(os.path.sep,last_index_dir,ref_basename+".last.index.bck")
-        if (os.path.isfile(last_index_file_part) is False or os.stat(last_index_file_part).st_size==0) :
-            print "Building LAST index for reference fasta..."
-            cmd="lastdb -Q 0 %s %s" %(last_index, validated_ref) # format the database
-            if (args.verbose is True):
-                print cmd
-            proc = subprocess.Popen(cmd, shell=True)
-            status = proc.wait()
+        last_index=os.path.join(last_index_dir, refhash+".last.index")
+        if (manifest_entry.get("last_index") != last_index or os.path.isfile(last_index+".bck") is False):
+            builds.append(("last_index", "LAST index", last_index, ".bck", "lastdb -Q 0 %s "+validated_ref))
         refdict["last_index"]=last_index
 
     if (args.bwa_align is True):
-        bwa_index=os.path.join(os.path.sep,bwa_index_dir,ref_basename+".bwa.index")
-        bwa_index_file_part=os.path.join(os.path.sep,bwa_index_dir,ref_basename+".bwa.index.bwt")
-        if (os.path.isfile(bwa_index_file_part) is False or os.stat(bwa_index_file_part).st_size==0):
-            print "Building BWA index for reference fasta..."
-            cmd="bwa index -p %s %s" %(bwa_index, validated_ref) # format the database
-            if (args.verbose is True):
-                print cmd
-            proc = subprocess.Popen(cmd, shell=True)
-            status = proc.wait()
+        bwa_index=os.path.join(bwa_index_dir, refhash+".bwa.index")
+        if (manifest_entry.get("bwa_index") != bwa_index or os.path.isfile(bwa_index+".bwt") is False):
+            builds.append(("bwa_index", "BWA index", bwa_index, ".bwt", "bwa index -p %s "+validated_ref))
         refdict["bwa_index"]=bwa_index
 
+    ## the indexes build in the background; alignments for this reference wait for them
+    refdict["index_ready"]=threading.Event()
+    if (len(builds) == 0):
+        refdict["index_ready"].set()
+    else:
+        builder=threading.Thread(target=build_reference_indexes, args=(refhash, builds, refdict["index_ready"]))
+        builder.daemon=True
+        builder.start()
+
     print "finished processing reference fasta."
     ref_fasta_hash[ref_basename]=refdict
 
+######################################################
+## Validated reference fasta files and their LAST/BWA indexes are cached by
+## the content of the reference: a sha1 over every record's id and upper case
+## sequence. The same sequences under another file name reuse what is already
+## built, and different sequences under an old file name get their own
+## files. reference_manifest.json in valid_reference_fasta_files records the
+## source files of each entry and which of its indexes finished building.
+## Several minup processes can share these folders: the manifest is only
+## changed under a lock file, and indexes are built in a folder of their own
+## and moved into place once they are complete.
+
+reference_manifest_lock=threading.Lock()
+
+def validate_reference_fasta(files, refdict, valid_fasta_handle, store, temp_ref):
+    ## reads the fasta files record by record, writes the validated and 2-bit copies and returns the content hash
+    refhash=hashlib.sha1()
+    for fasta_file in files:
+        print "FASTA file:", fasta_file
+        records=0
+        disc=os.path.basename(fasta_file)
+        try:
+            for record in SeqIO.parse(fasta_file, "fasta"):
+                records+=1
+                if (len(record.seq)==0):
+                    reference_error("Error with your reference sequence FASTA file: %s: SEQID %s" % (fasta_file, record.id), temp_ref)
+                seq=str(record.seq).upper()
+                refhash.update("%s\n%s\n" % (record.id, seq))
+                valid_fasta_handle.write(">%s %s\n" % (record.id, disc))
+                for x in xrange(0, len(seq), 60):
+                    valid_fasta_handle.write(seq[x:x+60]+"\n")
+
+                if (args.verbose is True):
+                    print "processing seq: ", record.id
+                refdict["seq_len"][record.id]=len(seq)
+                refdict["seq_file"][record.id]=disc
+                refdict["big_len"]+=len(seq)
+                refdict["seq_file_len"][disc]=refdict["seq_file_len"].get(disc, 0)+len(seq)
+                store.add(record.id, seq)
+        except Exception, err:
+            reference_error("Error with your reference sequence FASTA file: %s: %s" % (fasta_file,err), temp_ref)
+        if (records == 0):
+            reference_error("Error with your reference sequence FASTA file: %s: It's an empty file" % (fasta_file), temp_ref)
+    return refhash.hexdigest()
+
+def reference_error(err_string, temp_ref):
+    print >>sys.stderr, err_string
+    for path in (temp_ref, temp_ref+".2bit", temp_ref+".2bit.json"):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    sys.exit(1)
+
+def reference_manifest_path():
+    return os.path.join(valid_ref_dir, "reference_manifest.json")
+
+def read_reference_manifest():
+    path=reference_manifest_path()
+    if (os.path.isfile(path) is False):
+        return dict()
+    try:
+        with open(path) as manifest_handle:
+            return json.load(manifest_handle)
+    except ValueError, err:
+        print >>sys.stderr, "Can't read %s, the references will be checked again: %s" % (path, err)
+        return dict()
+
+@contextlib.contextmanager
+def reference_manifest_locked():
+    with reference_manifest_lock: # the threads of this process
+        lockhandle=open(reference_manifest_path()+".lock", "a")
+        try:
+            if (fcntl is not None): # other minup processes
+                fcntl.flock(lockhandle, fcntl.LOCK_EX)
+            yield
+        finally:
+            lockhandle.close()
+
+def write_reference_manifest(manifest):
+    path=reference_manifest_path()
+    handle, temp_path = tempfile.mkstemp(prefix="reference_manifest_", suffix=".json.tmp", dir=valid_ref_dir)
+    with os.fdopen(handle, "w") as manifest_handle:
+        json.dump(manifest, manifest_handle, indent=1, sort_keys=True)
+    if (os.path.exists(path) and oper is "windows"): # rename doesn't replace files on windows
+        os.remove(path)
+    os.rename(temp_path, path)
+
+def update_reference_manifest(refhash, files=None, **fields):
+    with reference_manifest_locked():
+        manifest=read_reference_manifest()
+        entry=manifest.setdefault(refhash, dict())
+        if (files is not None):
+            entry["files"]=sorted(set(entry.get("files", list())+files))
+        entry.update(fields)
+        write_reference_manifest(manifest)
+        return dict(entry)
+
+def start_reference_index(refhash, name, index, marker):
+    ## False if another process has finished this index in the meantime
+    with reference_manifest_locked():
+        manifest=read_reference_manifest()
+        entry=manifest.setdefault(refhash, dict())
+        if (entry.get(name) == index and os.path.isfile(index+marker) is True):
+            return False
+        entry.update({name:None, name+"_failed":None}) # until this build is done
+        write_reference_manifest(manifest)
+        return True
+
+def install_reference_index(build_dir, index, marker):
+    ## the marker file goes last, that's the one an index is checked by
+    files=sorted(os.listdir(build_dir), key=lambda f: f.endswith(marker))
+    for f in files:
+        target=os.path.join(os.path.dirname(index), f)
+        if (os.path.exists(target) and oper is "windows"):
+            os.remove(target)
+        os.rename(os.path.join(build_dir, f), target)
+
+def build_reference_indexes(refhash, builds, ready):
+    ## the LAST and BWA builds run at the same time; each is marked in the manifest
+    ## once it succeeds, or as <name>_failed if it doesn't, so worker processes
+    ## waiting on the manifest stop waiting either way
+    try:
+        procs=list()
+        for name, label, index, marker, cmd in builds:
+            if (start_reference_index(refhash, name, index, marker) is False):
+                print "%s %s has already been built by another minup." % (label, index)
+                continue
+            print "Building %s for reference fasta in the background..." % (label)
+            build_dir=tempfile.mkdtemp(prefix=os.path.basename(index)+"_", suffix=".tmp", dir=os.path.dirname(index))
+            cmd=cmd % (os.path.join(build_dir, os.path.basename(index)))
+            if (args.verbose is True):
+                print cmd
+            try:
+                procs.append((name, label, index, marker, build_dir, subprocess.Popen(cmd, shell=True)))
+            except Exception, err:
+                print >>sys.stderr, "Building the %s %s failed: %s" % (label, index, err)
+                shutil.rmtree(build_dir, True)
+                update_reference_manifest(refhash, **{name+"_failed":index})
+        for name, label, index, marker, build_dir, proc in procs:
+            status=proc.wait()
+            try:
+                if (status == 0):
+                    install_reference_index(build_dir, index, marker)
+                    update_reference_manifest(refhash, **{name:index})
+                    print "finished building %s %s." % (label, index)
+                else:
+                    print >>sys.stderr, "Building the %s %s failed with exit status %s" % (label, index, status)
+                    update_reference_manifest(refhash, **{name+"_failed":index})
+            except Exception, err:
+                print >>sys.stderr, "Installing the %s %s failed: %s" % (label, index, err)
+                update_reference_manifest(refhash, **{name+"_failed":index})
+            finally:
+                shutil.rmtree(build_dir, True)
+    finally:
+        ready.set()
+
+######################################################
+## Reads are uploaded while the indexes build; their alignments are held in
+## the aligner batchers' queues (or the alignment workers' queue with
+## --workers) until the index of their reference is there. Worker processes
+## don't share the main process's event, so they look in the manifest.
+
+reference_waits=set()
+
+def reference_index_ready(refdict):
+    if ("index_ready" in refdict):
+        return refdict["index_ready"].is_set()
+    entry=read_reference_manifest().get(refdict["hash"], dict())
+    for name in ("last_index", "bwa_index"):
+        if (name not in refdict or entry.get(name) == refdict[name]):
+            continue
+        if (entry.get(name+"_failed") == refdict[name]): # the aligner will report the missing index
+            print >>sys.stderr, "the reference index %s couldn't be built, alignments will fail." % (refdict[name])
+            continue
+        return False
+    refdict["index_ready"]=threading.Event() # seen once, so no need to read the manifest again
+    refdict["index_ready"].set()
+    return True
+
+def wait_for_reference_index(dbname):
+    refdict=ref_fasta_hash[dbname]
+    if (reference_index_ready(refdict) is True):
+        return
+    if (dbname not in reference_waits):
+        reference_waits.add(dbname)
+        print "alignments for %s are queued until the reference index has been built." % (dbname)
+    while (reference_index_ready(refdict) is False):
+        time.sleep(1)
+
 
 ########################################################
 
@@ -1945,6 +3610,17 @@ def create_barcode_table(tablename, cursor):
 
 ########################################################
 
+def create_id_blocks_table(tablename, cursor):
+    fields=(
+    'tablename VARCHAR(64) NOT NULL, PRIMARY KEY(tablename)',
+    'next_id INT(10) NOT NULL')
+    colheaders=','.join(fields)
+    sql ="CREATE TABLE IF NOT EXISTS %s (%s) ENGINE=InnoDB" % (tablename, colheaders)
+    #print sql
+    cursor.execute(sql)
+
+########################################################
+
 def create_xml_table(tablename, cursor):
     fields=(
     'xmlindex INT(11) NOT NULL AUTO_INCREMENT, PRIMARY KEY(xmlindex)',
@@ -2064,7 +3740,8 @@ def create_reference_table(tablename, cursor):
     'refname VARCHAR(50), UNIQUE INDEX (refname)',
     'reflen INT(7), INDEX (reflen)',
     'reffile VARCHAR(100), INDEX (reffile)',
-    'ref_total_len VARCHAR(100), INDEX (ref_total_len)')
+    'ref_total_len VARCHAR(100), INDEX (ref_total_len)',
+    'refhash CHAR(40)') # names <refhash>.2bit, the reference store; tables from before it was added don't have it
     colheaders=','.join(fields)
     sql ="CREATE TABLE IF NOT EXISTS %s (%s) ENGINE=InnoDB" % (tablename, colheaders)
     #print sql
@@ -2229,6 +3906,22 @@ def create_caller_table_noindex(tablename, cursor):
     cursor.execute(sql)
 
 
+#########################################################
+def create_telemetry_blob_table(tablename, cursor):
+    fields=(
+    'ID INT(10) NOT NULL AUTO_INCREMENT, PRIMARY KEY(ID)',
+    'basename_id INT(7) NOT NULL, INDEX (basename_id)',
+    'readtype VARCHAR(30) NOT NULL',
+    'caller_table VARCHAR(50) NOT NULL',
+    'row_count INT(10) NOT NULL',
+    'dtype TEXT NOT NULL',
+    'codec VARCHAR(10) NOT NULL',
+    'data LONGBLOB NOT NULL')
+    colheaders=','.join(fields)
+    sql ="CREATE TABLE IF NOT EXISTS %s (%s) ENGINE=InnoDB" % (tablename, colheaders)
+    #print sql
+    cursor.execute(sql)
+
 #########################################################
 def create_2d_alignment_table(tablename, cursor):
     fields=(
@@ -2450,25 +4143,125 @@ def load_ref_kmer_hash(tablename, kmers, refid, cursor):
 
 ######################################################
 
-def kmer_count_fasta(seq, revcompseq, kmer_len):
-    kmerhash =dict()
-    seqs = [seq, revcompseq]
-    for x in range(len(seq)+1-kmer_len):
-        for s in seqs:
-            kmer = str(s[x:x+kmer_len])
-            if kmer in kmerhash:
-                kmerhash[kmer]+=1
+######################################################
+## Reference kmers are counted with numpy. Each sequence is 2-bit encoded once
+## (A=0 C=1 G=2 T=3), the kmer codes of all positions of a strand are built
+## with kmer_len shifts of the whole array, and the codes are counted with
+## bincount (unique for kmers longer than 12). Kmers containing anything
+## other than ACGT are not counted. kmer_len can be up to 16. The encoding is
+## minup_twobit's, the same as the reference store's.
+
+kmer_chunk=1<<24 # positions encoded at a time, so long sequences don't need 4 bytes per base at once
+
+def kmer_codes(codes, kmer_len):
+    n=len(codes)-kmer_len+1
+    if (n <= 0):
+        return numpy.empty(0, dtype=numpy.uint32)
+    kmers=numpy.zeros(n, dtype=numpy.uint32)
+    for i in xrange(kmer_len):
+        kmers<<=2
+        kmers|=(codes[i:i+n] & 3)
+    unknown=numpy.concatenate(([0], numpy.cumsum(codes == 4)))
+    return kmers[(unknown[kmer_len:]-unknown[:n]) == 0]
+
+def count_kmers(codes, kmer_len):
+    ## kmer codes found on either strand of a 2-bit encoded sequence, and how often
+    revcodes=numpy.where(codes == 4, codes, 3-codes)[::-1]
+    counts=None
+    found=list()
+    if (kmer_len <= 12):
+        counts=numpy.zeros(4**kmer_len, dtype=numpy.int64)
+    for strand in (codes, revcodes):
+        for start in xrange(0, max(len(strand)-kmer_len+1, 0), kmer_chunk):
+            kmers=kmer_codes(strand[start:start+kmer_chunk+kmer_len-1], kmer_len)
+            if (counts is not None):
+                counts+=numpy.bincount(kmers, minlength=4**kmer_len)
             else:
-                kmerhash[kmer]=1
-    return kmerhash
+                found.append(kmers)
+    if (counts is not None):
+        present=numpy.nonzero(counts)[0]
+        return present, counts[present]
+    if (len(found) == 0):
+        return numpy.empty(0, dtype=numpy.uint32), numpy.empty(0, dtype=numpy.int64)
+    return numpy.unique(numpy.concatenate(found), return_counts=True)
+
+def decode_kmers(codes, kmer_len):
+    letters=numpy.empty((len(codes), kmer_len), dtype='S1')
+    lookup=numpy.array(list('ACGT'))
+    for i in xrange(kmer_len):
+        letters[:, kmer_len-1-i]=lookup[(codes >> (2*i)) & 3]
+    return letters.view('S%d' % (kmer_len)).ravel()
+
+def kmer_count_dict(found, kmer_len):
+    codes, counts = found
+    return dict(zip(decode_kmers(codes, kmer_len).tolist(), counts.tolist()))
+
+def kmer_count_references(refstore, refnames, kmer_len):
+    ## each sequence of the reference store is counted on its own thread
+    def count(refname):
+        return (refname, kmer_count_dict(count_kmers(refstore.codes(refname), kmer_len), kmer_len))
+    workers=ThreadPool(max(args.kmer_threads, 1))
+    try:
+        return dict(workers.map(count, refnames))
+    finally:
+        workers.close()
+        workers.join()
+
+######################################################
+
+def compact_path_key(filepath):
+    ## 16 byte digest of a path, so the set of processed files stays small on long runs
+    if isinstance(filepath, unicode):
+        filepath=filepath.encode('utf-8')
+    return hashlib.md5(filepath).digest()
+
+######################################################
+## Pending files are kept in a min-heap on their creation time, so a file is
+## scheduled in O(log n). A file that is created again before it is processed
+## gets a new heap entry and its old one is skipped when it comes up.
+
+class ingest_scheduler():
+    def __init__(self):
+        self.heap=list()
+        self.pending=dict()
+        self.processed=set()
+        self.lock=threading.Lock()
+
+    def add(self, filepath, createtime):
+        with self.lock:
+            if (compact_path_key(filepath) in self.processed):
+                return
+            self.pending[filepath]=createtime
+            heapq.heappush(self.heap, (createtime, filepath))
+
+    def pop_ready(self, readytime):
+        with self.lock:
+            while (0 < len(self.heap) and self.heap[0][0] < readytime):
+                createtime, filepath = heapq.heappop(self.heap)
+                if (self.pending.get(filepath) != createtime): # superseded by a later create event
+                    continue
+                del self.pending[filepath]
+                self.processed.add(compact_path_key(filepath))
+                return filepath
+            return None
+
+    def pending_count(self):
+        return len(self.pending)
+
+    def processed_count(self):
+        return len(self.processed)
 
 ######################################################
 
 class MyHandler(FileSystemEventHandler):
     def __init__(self):
-        self.creates=file_dict_of_folder(args.watchdir)
-        self.processed=dict()
+        self.creates=ingest_scheduler()
         self.running = True
+        self.dispatched=list()
+
+        scan = threading.Thread(target=scan_watch_dir, args=(args.watchdir, self.creates))
+        scan.daemon = True
+        scan.start()
 
         t = threading.Thread(target=self.processfiles)
         t.daemon = True
@@ -2484,37 +4277,65 @@ class MyHandler(FileSystemEventHandler):
         while self.running:
             time.sleep(5)
             ts = time.time()
-            print datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S'), "CACHED:", len(self.creates), "PROCESSED:",  len(self.processed)
-            for fast5file, createtime in sorted(self.creates.items(), key=lambda x: x[1]):
-                #tn=time.time()
-                if ( int(createtime)+20 < time.time() ): # file created 20 sec ago, so should be complete
-                    if (fast5file not in self.processed.keys() ):
-                        self.creates.pop(fast5file, None)
-                        self.processed[fast5file]=time.time()
-                        try:
-                            #starttime = time.time()
-                            self.hdf = h5py.File(fast5file, 'r')
-                            self.db_name=check_read(fast5file, self.hdf, cursor)
-                            process_fast5(fast5file, self.hdf, self.db_name, cursor)
-
-                        except Exception, err:
-                            err_string="Error with fast5 file: %s : %s" % (fast5file, err)
-                            print >>sys.stderr, err_string
-                        #    if (dbname is not None):
-                        #        if (dbname in dbcheckhash["dbname"]):
-                        #            with open(dbcheckhash["logfile"][dbname],"a") as logfilehandle:
-                        #                logfilehandle.write(err_string+os.linesep)
-                        #                logfilehandle.close()
-                        everyten+=1
-                        if (everyten==10):
-                            tm = time.time()
-                            if ( (ts+5)<tm ): # just to stop it printing two status messages one after the other.
-                                print  datetime.datetime.fromtimestamp(tm).strftime('%Y-%m-%d %H:%M:%S'), "CACHED:", len(self.creates), "PROCESSED:",  len(self.processed)
-                            everyten=0
+            print datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S'), "CACHED:", self.creates.pending_count(), "PROCESSED:",  self.creates.processed_count()
+            if (ingest_stages is not None and args.verbose is True):
+                print "QUEUES:", ingest_stages.depths()
+            with ingest_lock:
+                try:
+                    flush_bulk_writers(cursor)
+                except Exception, err:
+                    print >>sys.stderr, "Error writing buffered rows: %s" % (err)
+            while (self.running is True):
+                fast5file=self.creates.pop_ready(time.time()-20) # file created 20 sec ago, so should be complete
+                if (fast5file is None):
+                    break
+                if (args.resume is True and get_ingest_journal(dbname_from_filepath(fast5file)).has_path(fast5file) ):
+                    continue
+                if (dbname_from_filepath(fast5file) not in dbcheckhash["dbname"] and scan_metadata.wait(fast5file, 0) is False):
+                    print "waiting for the XML and reference files of %s before setting up a new run." % (downloads_folder(fast5file))
+                    while (scan_metadata.wait(fast5file, 1) is False and self.running is True):
+                        pass
+                try:
+                    #starttime = time.time()
+                    if (ingest_pool is not None):
+                        self.dispatch_to_worker(fast5file)
+                    else:
+                        ingest_stages.parse.put((fast5file,))
+
+                except Exception, err:
+                    err_string="Error with fast5 file: %s : %s" % (fast5file, err)
+                    print >>sys.stderr, err_string
+                #    if (dbname is not None):
+                #        if (dbname in dbcheckhash["dbname"]):
+                #            with open(dbcheckhash["logfile"][dbname],"a") as logfilehandle:
+                #                logfilehandle.write(err_string+os.linesep)
+                #                logfilehandle.close()
+                everyten+=1
+                if (everyten==10):
+                    tm = time.time()
+                    if ( (ts+5)<tm ): # just to stop it printing two status messages one after the other.
+                        print  datetime.datetime.fromtimestamp(tm).strftime('%Y-%m-%d %H:%M:%S'), "CACHED:", self.creates.pending_count(), "PROCESSED:",  self.creates.processed_count()
+                    everyten=0
+
+    def dispatch_to_worker(self, fast5file):
+        ## run-level setup (new database, Gru entries, switching runs) stays in this process
+        self.db_name=dbname_from_filepath(fast5file)
+        if (self.db_name not in dbcheckhash["dbname"] or dbcheckhash["dbname"][self.db_name] is False):
+            with ingest_lock:
+                self.hdf = h5py.File(fast5file, 'r')
+                check_read(fast5file, self.hdf, cursor)
+                self.hdf.close()
+        ## keep at most two files per worker in flight so the queue can't run away from us
+        while (len(self.dispatched) >= 2*args.workers):
+            self.dispatched=[r for r in self.dispatched if not r.ready()]
+            if (len(self.dispatched) >= 2*args.workers):
+                time.sleep(0.05)
+        runstate=ingest_worker_runstate(self.db_name)
+        self.dispatched.append(ingest_pool.apply_async(ingest_worker_process, (fast5file, self.db_name, runstate)))
 
     def on_created(self, event):
         if ("downloads" in event.src_path and "muxscan" not in event.src_path and event.src_path.endswith(".fast5")):
-            self.creates[event.src_path] = time.time()
+            self.creates.add(event.src_path, time.time())
 
 #########################################################
 
@@ -2522,8 +4343,14 @@ if __name__ == "__main__":
     if (args.version==True): # ML
         print "minUP version is "+minup_version # ML
         sys.exit() # ML
+    if (args.workers > 1):
+        ## start the workers before any connections are opened so none are shared with them
+        ingest_pool = multiprocessing.Pool(processes=args.workers, initializer=init_ingest_worker)
+    else:
+        ingest_stages = ingest_pipeline()
+
     try:
-        db = MySQLdb.connect(host=args.dbhost, user=args.dbusername, passwd=args.dbpass, port=args.dbport)
+        db = MySQLdb.connect(host=args.dbhost, user=args.dbusername, passwd=args.dbpass, port=args.dbport, local_infile=1)
         cursor = db.cursor()
 
     except Exception, err:
@@ -2538,6 +4365,13 @@ if __name__ == "__main__":
         print "Both --last-align-true (-last) and --bwa-align-true (-bwa) were set. Select only one and try again."
         sys.exit(1)
 
+    if ( (args.tel_blob is True) and (args.tel_codec == "lz4") and (lz4frame is None) ):
+        print "--telemetry-compression lz4 needs the lz4 python package (pip install lz4). Install it or use zlib."
+        sys.exit(1)
+
+    if (args.drop_templates is True):
+        drop_schema_templates(cursor)
+
     if (args.ref_fasta is not False):
         process_ref_fasta(args.ref_fasta)
 
@@ -2560,6 +4394,21 @@ if __name__ == "__main__":
     except (KeyboardInterrupt, SystemExit):
         print "stopping monitor."
         observer.stop()
+        event_handler.running = False
+        if (ingest_pool is not None):
+            print "waiting for the worker processes to finish."
+            ingest_pool.close()
+            ingest_pool.join()
+        if (ingest_stages is not None):
+            print "waiting for the ingest pipeline to empty."
+            ingest_stages.drain()
+        with ingest_lock:
+            flush_bulk_writers(cursor, True)
+        if (telemetry_writer is not None):
+            print "waiting for the telemetry to be written."
+            flush_telemetry_sink()
+        if (args.verbose is True):
+            print_pool_stats()
         time.sleep(1)
         #if (dbname is not None):
         #    #print "dbname", dbname
@@ -0,0 +1,92 @@
+## minup_twobit: the 2-bit reference store minup writes for a validated
+## reference, and the reader minup and mT_coverage.py (on the minoTour server)
+## both open it with, so the format is defined here only.
+##
+## <hash>.2bit holds the sequences packed four bases to a byte (A=0 C=1 G=2
+## T=3), the first base in the high bits, every sequence starting on a new
+## byte. Anything that isn't ACGT is packed as A and listed as a run of N in
+## <hash>.2bit.json, which gives each sequence's byte offset, length and
+## n_blocks ([start, length] pairs). reference_store maps the file with mmap,
+## so processes reading the same reference share one page-cached copy.
+
+import json
+import mmap
+import numpy
+
+base_codes=numpy.empty(256, dtype=numpy.uint8)
+base_codes.fill(4)
+for i, base in enumerate('ACGT'):
+    base_codes[ord(base)]=i
+    base_codes[ord(base.lower())]=i
+
+def encode_2bit(seq):
+    return base_codes[numpy.frombuffer(seq, dtype=numpy.uint8)]
+
+reference_store_version=1
+
+def pack_2bit(codes):
+    padded=numpy.zeros(((len(codes)+3)//4)*4, dtype=numpy.uint8)
+    padded[:len(codes)]=codes & 3
+    quads=padded.reshape(-1, 4)
+    return ((quads[:,0] << 6) | (quads[:,1] << 4) | (quads[:,2] << 2) | quads[:,3]).astype(numpy.uint8)
+
+def unknown_runs(codes):
+    edges=numpy.flatnonzero(numpy.diff(numpy.concatenate(([0], (codes == 4).view(numpy.int8), [0]))))
+    return [[int(start), int(end-start)] for start, end in zip(edges[0::2], edges[1::2])]
+
+class reference_store_writer():
+    def __init__(self, path):
+        self.path=path
+        self.handle=open(path, "wb")
+        self.offset=0
+        self.seqs=dict()
+
+    def add(self, refname, seq):
+        codes=encode_2bit(seq)
+        packed=pack_2bit(codes)
+        self.handle.write(packed.tostring())
+        self.seqs[refname]={"offset":self.offset, "length":len(codes), "n_blocks":unknown_runs(codes)}
+        self.offset+=len(packed)
+
+    def close(self):
+        self.handle.close()
+        with open(self.path+".json", "w") as index_handle:
+            json.dump({"version":reference_store_version, "seqs":self.seqs}, index_handle)
+
+class reference_store():
+    def __init__(self, path):
+        with open(path+".json") as index_handle:
+            index=json.load(index_handle)
+        if (index["version"] != reference_store_version):
+            raise ValueError("%s is version %s of the 2-bit format, not %s" % (path, index["version"], reference_store_version))
+        self.seqs=index["seqs"]
+        self.handle=open(path, "rb")
+        self.map=mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def length(self, refname):
+        return self.seqs[refname]["length"]
+
+    def codes(self, refname, start=0, end=None):
+        ## the 2-bit codes of refname[start:end], 4 where there's an N
+        seq=self.seqs[refname]
+        if (end is None or seq["length"] < end):
+            end=seq["length"]
+        if (end <= start):
+            return numpy.empty(0, dtype=numpy.uint8)
+        first=seq["offset"]+start//4
+        packed=numpy.frombuffer(self.map, dtype=numpy.uint8, count=seq["offset"]+(end+3)//4-first, offset=first)
+        codes=numpy.empty((len(packed), 4), dtype=numpy.uint8)
+        for i in xrange(4):
+            codes[:,i]=(packed >> (6-2*i)) & 3
+        codes=codes.ravel()[start%4:start%4+(end-start)]
+        for n_start, n_len in seq["n_blocks"]:
+            if (n_start < end and start < n_start+n_len):
+                codes[max(n_start, start)-start:min(n_start+n_len, end)-start]=4
+        return codes
+
+    def bases(self, refname, start=0, end=None):
+        return numpy.array(list('ACGTN'))[self.codes(refname, start, end)].tostring()
+
+    def close(self):
+        self.map.close()
+        self.handle.close()